@@ -1,7 +1,13 @@
 import os
 import streamlit as st
 import pandas as pd
+import numpy as np
 import hashlib
+import app_data
+import simulation_client
+from artifacts import artifact_path, read_table
+from mc_stats import wilson_interval
+from snapshot_index import LiveIndex, read_cohort, INPUT_FILES as WHATIF_FILES
 
 # --- 認証ステートの初期化 ---
 if 'authenticated' not in st.session_state:
@@ -37,7 +43,7 @@ if not st.session_state['authenticated']:
     pwd_input = st.text_input("パスワード", type="password")
     if st.button("ログイン"):
         try:
-            auth_df = pd.read_csv(
+            auth_df = app_data.read_csv(
                 "auth.csv",
                 dtype={'student_id': str, 'password_hash': str, 'role': str}
             )
@@ -69,7 +75,10 @@ st.markdown(
     unsafe_allow_html=True,
 )
 
-@st.cache_data(ttl=300)
+# 元ファイルの内容が変わったときだけ読み直す（全セッション共通のキャッシュ）
+MAIN_FILES = ["responses.csv", "lottery_order.csv", "assignment_matrix.csv", "department_summary.csv",
+              artifact_path("assignment_matrix.csv"), artifact_path("department_summary.csv")]
+
 def load_data():
     responses_df = pd.read_csv("responses.csv", dtype=str)
     responses_df['student_id'] = responses_df['student_id'].str.lstrip('0')
@@ -82,7 +91,7 @@ def load_data():
 
     def load_optional(file):
         try:
-            return pd.read_csv(file)
+            return read_table(file)
         except FileNotFoundError:
             return None
 
@@ -91,12 +100,12 @@ def load_data():
 
     return responses_df, lottery_df, assign_matrix, dept_summary
 
-responses_df, lottery_df, assign_matrix, dept_summary = load_data()
+responses_df, lottery_df, assign_matrix, dept_summary = app_data.load('admin_main', MAIN_FILES, load_data)
 
 st.title("管理者ダッシュボード")
 
 if st.button("🌀 最新データを取得"):
-    st.cache_data.clear()
+    app_data.clear()
     st.experimental_rerun()
 
 answered_ids  = set(responses_df['student_id'])
@@ -130,43 +139,72 @@ else:
     st.warning("department_summary.csv が見つかりません。生成後、再デプロイしてください。")
 
 st.header("🧪 仮希望入力シミュレーション（非公開ツール）")
-prob_df = pd.read_csv("probability_montecarlo_combined.csv", dtype={'student_id': str})
-cap_df = pd.read_csv("department_capacity.csv")
+# 常駐エンジン: 入力ファイルが変わるまで全セッションで共有し、シミュレーション済みの世界を使い回す。
+# simulation_service が起動していればそちらに問い合わせ、手元のエンジンは学生情報の参照にだけ使う
+use_service = simulation_client.available()
+
+def build_whatif_engine():
+    engine = LiveIndex(read_cohort())
+    if not use_service:
+        engine.warm(1000)
+    return engine
+
+engine = app_data.load('whatif_engine', WHATIF_FILES, build_whatif_engine)
+cap_df = app_data.read_csv("department_capacity.csv")
 hd = cap_df["hospital_department"].str.split("-", n=1, expand=True)
 hospital_list   = sorted(hd[0].unique())
 department_list = sorted(hd[1].unique())
 
-student_id     = st.text_input("仮想 Student ID", value="22", disabled=True)
-lottery_number = st.number_input("仮想 抽選順位", min_value=1, max_value=9999, value=101, disabled=True)
-
-st.subheader("🎯 第1〜第10希望を入力（病院＋診療科）")
-input_hopes = []
-for i in range(1, 11):
-    col1, col2 = st.columns(2)
-    with col1:
-        hospital = st.selectbox(f"第{i}希望：病院", [""] + hospital_list, key=f"hospital_{i}")
-    with col2:
-        department = st.selectbox(f"第{i}希望：診療科", [""] + department_list, key=f"dept_{i}")
-    if hospital and department:
-        input_hopes.append(f"{hospital}-{department}")
-
-if st.button("🧮 シミュレーション実行"):
-    for idx, dept in enumerate(input_hopes, start=1):
-        col_name_prob = f"hope_{idx}_確率"
-        if col_name_prob in prob_df.columns:
-            row = prob_df[prob_df['student_id'] == student_id]
-            prob = row.iloc[0][col_name_prob] if not row.empty else None
-            st.write(f"第{idx}希望: {dept} → 通過確率: {prob if prob is not None else '不明'}")
+student_id = st.text_input("仮想 Student ID（ターム・希望ごとのターム指定を引き継ぐ学生）", value="22").strip().lstrip('0')
+rows = np.flatnonzero(engine.cohort.student_ids == student_id)
+if not len(rows):
+    st.error(f"student_id {student_id} は student_terms.csv / lottery_order.csv にありません。")
+else:
+    lottery_number = st.number_input("仮想 抽選順位", min_value=1, max_value=9999,
+                                     value=int(engine.cohort.lottery[rows[0]]))
+
+    st.subheader("🎯 第1〜第10希望を入力（病院＋診療科）")
+    input_hopes = []
+    for i in range(1, 11):
+        col1, col2 = st.columns(2)
+        with col1:
+            hospital = st.selectbox(f"第{i}希望：病院", [""] + hospital_list, key=f"hospital_{i}")
+        with col2:
+            department = st.selectbox(f"第{i}希望：診療科", [""] + department_list, key=f"dept_{i}")
+        if hospital and department:
+            input_hopes.append(f"{hospital}-{department}")
+
+    if st.button("🧮 シミュレーション実行"):
+        if not input_hopes:
+            st.warning("希望を 1 つ以上入力してください。")
         else:
-            st.write(f"第{idx}希望: {dept} → 通過確率データ未整備")
+            # 1 秒以内に、世界を足すたびに途中経過を表示する
+            table = st.empty()
+            progress = st.progress(0.0)
+            status = st.empty()
+            if use_service:
+                results = simulation_client.progressive_whatif(student_id, input_hopes, lottery_number, budget=0.8)
+            else:
+                results = engine.progressive(student_id, input_hopes, lottery_number, budget=0.8)
+            for hits, n in results:
+                hits = np.asarray(hits)
+                lo, hi = wilson_interval(hits, n)
+                table.dataframe(pd.DataFrame({
+                    '希望':       [f"第{i}希望" for i in range(1, len(input_hopes) + 1)],
+                    '病院-診療科': [d if d in engine.cohort.dept_index else f"{d}（定員表になし）"
+                                   for d in input_hopes],
+                    '通過確率':   np.round(hits / n * 100, 1),
+                    '下限':       np.round(lo * 100, 1),
+                    '上限':       np.round(hi * 100, 1),
+                }), use_container_width=True)
+                progress.progress(min(n / engine.max_worlds, 1.0))
+                status.caption(f"{n} 回のシミュレーションに基づく推定（95% 区間）。再実行するほど回数が増えます。")
+            st.markdown("⬇️ 各希望の確率は「最初に配属された希望がその希望になる」確率です（未回答者は人気重み付きで補完）")
 
 st.header("🏁 診療科ごとの通過順位中央値（通過ライン推定）")
 try:
-    assignment_df = pd.read_csv(
-        "initial_assignment_result.csv",
-        dtype={'student_id': str, 'assigned_department': str, 'term': str}
-    )
-    lottery_df    = pd.read_csv(
+    assignment_df = app_data.read_table("initial_assignment_result.csv")
+    lottery_df    = app_data.read_csv(
         "lottery_order.csv",
         dtype={'student_id': str, 'lottery_order': int}
     )
@@ -182,3 +220,15 @@ try:
     st.markdown("⬇️ 抽選順位中央値が小さいほど人気が高い診療科を示します")
 except FileNotFoundError:
     st.warning("initial_assignment_result.csv が見つかりません。生成後、再デプロイしてください。")
+
+st.header("🪑 定員の感度分析（1 席増減したときの期待変化）")
+sensitivity_df = app_data.read_table("capacity_sensitivity.csv", optional=True)
+if sensitivity_df is not None:
+    if st.checkbox("満席になりうる枠だけ表示", value=True):
+        sensitivity_df = sensitivity_df[(sensitivity_df['満席率'] > 0) & (sensitivity_df['定員'] > 0)]
+    st.dataframe(sensitivity_df, use_container_width=True)
+    st.markdown("⬇️ 各値は 1 回の配属あたりの延べ人数（スロット数）の期待変化です。"
+                "増席_第1-3希望が大きい枠ほど、1 席増やしたときに希望が通る学生が増えます"
+                "（満席率はシミュレーションで満席になった割合）")
+else:
+    st.warning("capacity_sensitivity.csv が見つかりません。生成後、再デプロイしてください。")
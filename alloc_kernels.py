@@ -0,0 +1,108 @@
+"""
+配属ループ（シリアル・ディクテーターシップ）のスカラーカーネルと、実行エンジンの切り替え。
+
+  'numpy'  既定。allocation_engine の NumPy 実装（レプリケーション方向をベクトル化）
+  'numba'  下のカーネルを numba で JIT コンパイルして使う。numba が無ければ 'numpy' に戻す
+  'python' 下のカーネルをそのまま Python で実行する（遅い。numba の無い環境でカーネルの検算用）
+
+カーネルは整数配列だけを受け取り、出力配列（dept / rank / slot）と残り定員 cap をその場で
+書き換える。どのエンジンでも配属結果は同じ（乱数は呼び出し側で引き終えている）。
+"""
+try:
+    import numba
+except ImportError:  # numba は任意の依存
+    numba = None
+
+ENGINES = ('numpy', 'numba', 'python')
+
+_ENGINE = {'name': 'numpy'}
+_COMPILED = {}
+
+
+def select(name: str) -> str:
+    """エンジンを切り替えて、実際に使うエンジン名を返す（numba が無ければ 'numpy'）"""
+    if name not in ENGINES:
+        raise ValueError(f"engine は {', '.join(ENGINES)} のいずれかです: {name}")
+    if name == 'numba' and numba is None:
+        print("⚠️ numba がインストールされていないため numpy エンジンを使います")
+        name = 'numpy'
+    _ENGINE['name'] = name
+    return name
+
+
+def current() -> str:
+    return _ENGINE['name']
+
+
+# --- カーネル ---
+
+def slot_kernel(order, prefs, masks, terms, cap, dept, rank, start):
+    """
+    1 スロット分を R レプリケーションについて行う。order の順に各学生の希望を走査し、
+    許可タームで空きのある最初の科に配属する。
+    prefs: (R × 学生 × 希望), masks: (学生 × 希望), terms: (学生,) このスロットのターム,
+    cap: (R × 科), dept/rank: (R × 学生), start: (R,) order の何番目から配属するか
+    """
+    n_reps, _, h = prefs.shape
+    for r in range(n_reps):
+        for j in range(start[r], order.shape[0]):
+            s = order[j]
+            bit = 1 << terms[s]
+            for i in range(h):
+                d = prefs[r, s, i]
+                if d < 0 or (masks[s, i] & bit) == 0:
+                    continue
+                if cap[r, d] > 0:
+                    cap[r, d] -= 1
+                    dept[r, s] = d
+                    rank[r, s] = i + 1
+                    break
+
+
+def first_fit_kernel(order, prefs, masks, slot_terms, cap, term_cols, dept, slot):
+    """
+    simulate_each_as_first の配属ルール: 各学生の term_1→term_4 を順に、最初に空きのある
+    (ターム, 希望) で 1 枠だけ配属する。prefs/masks: (R × 学生 × 希望),
+    cap: (R × 科 × 定員ターム列)。戻り値は走査した希望の延べ数
+    """
+    n_reps, _, h = prefs.shape
+    n_terms = term_cols.shape[0]
+    scanned = 0
+    for r in range(n_reps):
+        for s in order:
+            placed = False
+            for k in range(slot_terms.shape[1]):
+                t = slot_terms[s, k]
+                if t < 0 or t >= n_terms:
+                    continue
+                c = term_cols[t]
+                if c < 0:
+                    continue
+                bit = 1 << t
+                for i in range(h):
+                    scanned += 1
+                    d = prefs[r, s, i]
+                    if d >= 0 and (masks[r, s, i] & bit) != 0 and cap[r, d, c] > 0:
+                        cap[r, d, c] -= 1
+                        dept[r, s] = d
+                        slot[r, s] = k
+                        placed = True
+                        break
+                if placed:
+                    break
+    return scanned
+
+
+_KERNELS = {
+    'slot': slot_kernel,
+    'first_fit': first_fit_kernel,
+}
+
+
+def kernel(name: str):
+    """現在のエンジンでのカーネル。numba では初回の呼び出し時にコンパイルされる"""
+    if _ENGINE['name'] != 'numba':
+        return _KERNELS[name]
+    if name not in _COMPILED:
+        _COMPILED[name] = numba.njit(cache=True)(_KERNELS[name])
+    return _COMPILED[name]
@@ -0,0 +1,491 @@
+"""
+整数エンコード済みの配列上で配属（シリアル・ディクテーターシップ）を行うエンジン。
+
+「病院-診療科」文字列とタームは一度だけ整数 ID に変換し、
+定員は (科 × ターム) の密な整数配列、希望は (学生 × 希望順位) の整数行列として保持する。
+run_simulation（simulate_with_unanswered.py）はこのエンジンの薄いラッパー。
+"""
+import re
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+import alloc_kernels
+from mc_stats import stratified_uniforms
+from preference_model import load_preferences, terms_to_mask
+from perf_trace import count
+
+UNASSIGNED = '未配属'
+
+
+@dataclass
+class EncodedCohort:
+    dept_names:   list        # 科 ID → "病院-診療科"
+    dept_index:   dict        # "病院-診療科" → 科 ID
+    capacity:     np.ndarray  # (科 × 定員ターム列) 初期定員
+    slot_cols:    np.ndarray  # term_k スロット → capacity の列番号
+    cap_terms:    np.ndarray  # capacity の列番号 → ターム番号
+    term_labels:  list        # student_terms の term_ 列名
+    max_hopes:    int
+    student_ids:  np.ndarray  # 行 → student_id（回答者 → 未回答者の順）
+    lottery:      np.ndarray  # 行 → lottery_order
+    slot_terms:   np.ndarray  # (学生 × スロット) ターム番号
+    is_imputed:   np.ndarray  # 行 → 未回答者なら True
+    base_prefs:   np.ndarray  # (学生 × 希望) 科 ID, -1 は無効（未回答者行は未記入）
+    masks:        np.ndarray  # (学生 × 希望) 許可タームのビットマスク
+    unresp_ids:   list        # 補完対象の student_id（乱数消費順）
+    unresp_rows:  np.ndarray  # unresp_ids → 行番号, 抽選順がなければ -1
+    pop_depts:    tuple       # 補完に使う人気科（名前）
+    pop_weights:  list        # 人気スコアの正規化重み
+
+    @property
+    def n_students(self) -> int:
+        return len(self.student_ids)
+
+    def term_cols(self) -> np.ndarray:
+        """ターム番号 → capacity の列番号（定員列がないタームは -1）"""
+        lookup = np.full(int(self.cap_terms.max()) + 1, -1, dtype=np.int64)
+        lookup[self.cap_terms] = np.arange(len(self.cap_terms))
+        return lookup
+
+
+def encode_cohort(responses_base: pd.DataFrame,
+                  lottery_df: pd.DataFrame,
+                  capacity_df: pd.DataFrame,
+                  terms_df: pd.DataFrame) -> EncodedCohort:
+    # --- 希望・ターム（解析済みのモデル） ---
+    model = load_preferences(responses_base, terms_df)
+    MAX_HOPES = model.max_hopes
+    term_labels = model.term_labels
+
+    # --- 科の intern と (科 × ターム) 定員配列 ---
+    cap_cols = [c for c in capacity_df.columns if c.startswith('term_')]
+    dept_index = {}
+    for dept in capacity_df['hospital_department']:
+        dept_index.setdefault(dept, len(dept_index))
+    dept_names = list(dept_index)
+    cap_values = (capacity_df[cap_cols]
+                  .apply(pd.to_numeric, errors='coerce')
+                  .fillna(0).astype(int).to_numpy())
+    capacity = np.zeros((len(dept_names), len(cap_cols)), dtype=np.int64)
+    for dept, row in zip(capacity_df['hospital_department'], cap_values):
+        capacity[dept_index[dept]] = row  # 重複行は後勝ち
+    # 既存挙動: スロット term_k は定員表の同名列 term_k を参照する
+    slot_cols = np.array([cap_cols.index(label) for label in term_labels], dtype=np.int64)
+
+    term_row = model.term_row
+    lottery_map = dict(zip(lottery_df['student_id'].astype(str).str.strip(),
+                           lottery_df['lottery_order'].astype(int)))
+
+    # --- 回答者の希望: モデルの語彙番号 → 科 ID（定員表にない科は -1） ---
+    real = [r for r, sid in enumerate(model.student_ids) if sid in term_row and sid in lottery_map]
+    real_ids = model.student_ids[real].tolist()
+    to_dept = np.array([dept_index.get(d, -1) for d in model.names] + [-1], dtype=np.int64)
+    real_prefs = to_dept[model.hopes[real]]
+
+    # --- popularity scoring (既存) ---
+    pop = model.popularity()
+    dept_list, counts = zip(*pop.items())
+    weights = [c / sum(counts) for c in counts]
+
+    answered_ids = set(model.student_ids)
+    all_ids      = set(model.term_ids)
+    # set の反復順は PYTHONHASHSEED 依存なので、シード固定時の再現性のため整列する
+    unresp_ids   = sorted(all_ids - answered_ids)
+
+    # --- 未回答者は希望が毎回変わるので行だけ確保 ---
+    imp_ids = [sid for sid in unresp_ids if sid in lottery_map]
+    student_ids = real_ids + imp_ids
+    row_of = {sid: r for r, sid in enumerate(imp_ids, start=len(real_ids))}
+    unresp_rows = np.array([row_of.get(sid, -1) for sid in unresp_ids], dtype=np.int64)
+
+    n_real = len(real_ids)
+    base_prefs = np.full((len(student_ids), MAX_HOPES), -1, dtype=np.int64)
+    masks      = np.zeros((len(student_ids), MAX_HOPES), dtype=np.int64)
+    if n_real:
+        base_prefs[:n_real] = real_prefs
+        masks[:n_real]      = model.masks[real]
+    for r, sid in enumerate(imp_ids, start=n_real):
+        masks[r] = terms_to_mask(model.default_terms(term_row[sid]))
+    slot_terms = model.slot_terms[[term_row[sid] for sid in student_ids]]
+
+    return EncodedCohort(
+        dept_names=dept_names,
+        dept_index=dept_index,
+        capacity=capacity,
+        slot_cols=slot_cols,
+        cap_terms=np.array([int(re.search(r'\d+', c).group()) for c in cap_cols], dtype=np.int64),
+        term_labels=term_labels,
+        max_hopes=MAX_HOPES,
+        student_ids=np.array(student_ids, dtype=object),
+        lottery=np.array([lottery_map[sid] for sid in student_ids], dtype=np.int64),
+        slot_terms=slot_terms.reshape(len(student_ids), len(term_labels)),
+        is_imputed=np.arange(len(student_ids)) >= n_real,
+        base_prefs=base_prefs,
+        masks=masks,
+        unresp_ids=unresp_ids,
+        unresp_rows=unresp_rows,
+        pop_depts=dept_list,
+        pop_weights=weights,
+    )
+
+
+# --- 未回答者の希望補完 ---
+
+def sample_weighted_hopes(pool: np.ndarray, weights, k: int, uniforms: np.ndarray) -> np.ndarray:
+    """
+    pool（科 ID）から重み weights に比例して重複なしで k 件ずつ順に選ぶ（Gumbel-top-k）。
+    uniforms は (...) + (len(pool),) の一様乱数で、各科のキー log(重み) + Gumbel(u) の
+    大きい順に k 件を取る。重み比例の逐次非復元抽出と同じ分布になり、全学生・全レプリケーションを
+    1 回の配列演算で引ける。uniforms に層別乱数や共通乱数を渡せばそのまま分散低減に使える。
+    戻り値: (...) + (min(k, len(pool)),) の科 ID。重み 0 の科しか残っていない位置は -1
+    """
+    pool = np.asarray(pool, dtype=np.int64)
+    with np.errstate(divide='ignore'):
+        log_w = np.log(np.asarray(weights, dtype=float))
+    u = np.clip(uniforms, np.finfo(float).tiny, 1.0 - np.finfo(float).epsneg)
+    keys = log_w - np.log(-np.log(u))
+    k = min(k, len(pool))
+    if k < len(pool):
+        top = np.argpartition(-keys, k - 1, axis=-1)[..., :k]
+    else:
+        top = np.broadcast_to(np.arange(len(pool)), keys.shape)
+    top_keys = np.take_along_axis(keys, top, axis=-1)
+    order = np.argsort(-top_keys, axis=-1, kind='stable')
+    top = np.take_along_axis(top, order, axis=-1)
+    valid = np.isfinite(np.take_along_axis(top_keys, order, axis=-1))
+    count('impute.rankings', int(np.prod(keys.shape[:-1])))
+    return np.where(valid, pool[top], -1)
+
+
+def pop_ids(cohort: EncodedCohort) -> np.ndarray:
+    """補完に使う人気科の科 ID（定員表にない科は -1 = 無効な希望）"""
+    return np.array([cohort.dept_index.get(d, -1) for d in cohort.pop_depts], dtype=np.int64)
+
+
+def impute_prefs(cohort: EncodedCohort) -> np.ndarray:
+    """未回答者の希望を人気重み付きで補完した (学生 × 希望) 行列を返す"""
+    prefs = cohort.base_prefs.copy()
+    rows = cohort.unresp_rows[cohort.unresp_rows >= 0]
+    # simulate_once のジッターと同じく numpy のグローバル乱数を使う
+    u = np.random.random_sample((len(rows), len(cohort.pop_depts)))
+    picks = sample_weighted_hopes(pop_ids(cohort), cohort.pop_weights, cohort.max_hopes, u)
+    prefs[rows, :picks.shape[-1]] = picks
+    return prefs
+
+
+def allocate_slot(order, prefs, masks, terms, cap):
+    """
+    1 スロット分のシリアル・ディクテーターシップ。
+    order: 処理する行番号（抽選順）
+    prefs/masks: (学生 × 希望) 科 ID と許可タームのビットマスク
+    terms: 各学生のこのスロットでのターム番号
+    cap: (科,) 残り定員（その場で減算される）
+    戻り値: (配属科 ID, 希望順位) 配属なしは (-1, 0)
+    """
+    n, h = prefs.shape
+    dept = np.full(n, -1, dtype=np.int64)
+    rank = np.zeros(n, dtype=np.int64)
+    if alloc_kernels.current() != 'numpy':
+        cap2 = cap.reshape(1, -1)
+        alloc_kernels.kernel('slot')(order, prefs[None], masks, terms, cap2, dept[None], rank[None],
+                                     np.zeros(1, dtype=np.int64))
+        cap[:] = cap2[0]
+        _count_scans('alloc.slot', dept[order], rank[order], h)
+        return dept, rank
+    prefs_l, masks_l, terms_l = prefs.tolist(), masks.tolist(), terms.tolist()
+    cap_l = cap.tolist()
+    for s in order.tolist():
+        bit = 1 << terms_l[s]
+        row_p, row_m = prefs_l[s], masks_l[s]
+        for i in range(h):
+            d = row_p[i]
+            if d < 0 or not row_m[i] & bit:
+                continue
+            if cap_l[d] > 0:
+                cap_l[d] -= 1
+                dept[s] = d
+                rank[s] = i + 1
+                break
+    cap[:] = cap_l
+    _count_scans('alloc.slot', dept[order], rank[order], h)
+    return dept, rank
+
+
+def _count_scans(prefix: str, dept: np.ndarray, rank: np.ndarray, h: int):
+    """
+    配属ループの作業量。配属された学生は希望順位までの、されなかった学生は全希望を走査したので
+    ループ内で数えなくても結果から求まる
+    """
+    placed = dept >= 0
+    count(prefix + '.students', dept.size)
+    count(prefix + '.placed', int(placed.sum()))
+    count(prefix + '.hopes_scanned', int(np.where(placed, rank, h).sum()))
+
+
+# --- 抽選順の決定的な先頭部分 ---
+#
+# ジッター（< 0.01）は整数の抽選番号が異なる学生の順序を入れ替えないので、抽選順で最初の
+# 未回答者（毎回希望が変わる）や同順位（ジッターで順序が変わる）より前の学生は、どの
+# レプリケーションでも同じ順に同じ希望で処理され、配属と残り定員も毎回同じになる。
+# この先頭部分を一度だけ配属しておき、各レプリケーションはその後ろ（尾部）だけを処理する。
+
+def deterministic_prefix(cohort: EncodedCohort, order: np.ndarray, stop_row: int = -1) -> int:
+    """
+    抽選順 order の先頭から、全レプリケーションで配属が変わらない学生の数。
+    未回答者・同順位の学生・stop_row（希望を差し替える本人）の手前で止まる。
+    """
+    lottery = cohort.lottery[order]
+    tied = np.zeros(len(order), dtype=bool)
+    same = lottery[1:] == lottery[:-1]
+    tied[1:] |= same
+    tied[:-1] |= same
+    varies = cohort.is_imputed[order] | tied | (order == stop_row)
+    return int(np.argmax(varies)) if varies.any() else len(order)
+
+
+@dataclass
+class SlotPrefix:
+    rows:     np.ndarray  # 先頭部分の行番号（抽選順）
+    dept:     np.ndarray  # (学生 × スロット) 先頭部分の配属科 ID（それ以外の行は -1）
+    rank:     np.ndarray  # (学生 × スロット) 先頭部分の希望順位（それ以外の行は 0）
+    capacity: np.ndarray  # (科 × スロット) 先頭部分を配属した後の残り定員
+
+    @property
+    def length(self) -> int:
+        return len(self.rows)
+
+
+def slot_prefix(cohort: EncodedCohort) -> SlotPrefix:
+    """'slot' ルール（スロットごとに定員を張り直す）で先頭部分を一度だけ配属する"""
+    order = np.argsort(cohort.lottery, kind='stable')
+    rows = order[:deterministic_prefix(cohort, order)]
+    n_slots = len(cohort.term_labels)
+    dept = np.empty((cohort.n_students, n_slots), dtype=np.int64)
+    rank = np.empty((cohort.n_students, n_slots), dtype=np.int64)
+    capacity = cohort.capacity[:, cohort.slot_cols].copy()
+    for k in range(n_slots):
+        dept[:, k], rank[:, k] = allocate_slot(
+            rows, cohort.base_prefs, cohort.masks, cohort.slot_terms[:, k], capacity[:, k]
+        )
+    return SlotPrefix(rows=rows, dept=dept, rank=rank, capacity=capacity)
+
+
+def first_fit_prefix(cohort: EncodedCohort, order: np.ndarray, term_cols: np.ndarray,
+                     stop_row: int = -1):
+    """
+    'first_fit' ルールで先頭部分を一度だけ配属する。
+    戻り値: (先頭部分の学生数, 残り定員 (科 × 定員ターム列))
+    """
+    m = deterministic_prefix(cohort, order, stop_row)
+    cap = cohort.capacity.copy()[None]
+    allocate_first_fit_batch(order[:m], cohort.base_prefs[None], cohort.masks[None],
+                             cohort.slot_terms, cap, term_cols)
+    return m, cap[0]
+
+
+def simulate_once(cohort: EncodedCohort, prefs: np.ndarray, prefix: SlotPrefix = None):
+    """
+    全スロットを 1 回シミュレーションする。
+    prefix（slot_prefix の戻り値）を渡すと、決定的な先頭部分はその配属と残り定員から始める。
+    繰り返し呼ぶときは一度だけ作って使い回す。
+    戻り値: orders (スロット × 学生), dept (学生 × スロット), rank (学生 × スロット)
+    """
+    if prefix is None:
+        prefix = slot_prefix(cohort)
+    m = prefix.length
+    n_slots = len(cohort.term_labels)
+    orders = np.empty((n_slots, cohort.n_students), dtype=np.int64)
+    dept   = np.empty((cohort.n_students, n_slots), dtype=np.int64)
+    rank   = np.empty((cohort.n_students, n_slots), dtype=np.int64)
+    for k in range(n_slots):
+        # 既存と同じく同順位のみを崩す微小ジッター（先頭部分の順序は変わらない）
+        jitter = cohort.lottery.astype(float) + np.random.rand(cohort.n_students)*0.01
+        orders[k] = np.argsort(jitter)
+        cap = prefix.capacity[:, k].copy()
+        dept[:, k], rank[:, k] = allocate_slot(
+            orders[k][m:], prefs, cohort.masks, cohort.slot_terms[:, k], cap
+        )
+        dept[prefix.rows, k] = prefix.dept[prefix.rows, k]
+        rank[prefix.rows, k] = prefix.rank[prefix.rows, k]
+    count('alloc.prefix_reused', m * n_slots)
+    return orders, dept, rank
+
+
+def assignment_frame(cohort: EncodedCohort, orders, dept, rank) -> pd.DataFrame:
+    """simulate_once の結果を run_simulation 互換の DataFrame に変換する"""
+    names = np.array(cohort.dept_names + [UNASSIGNED], dtype=object)
+    frames = []
+    for k, order in enumerate(orders):
+        d = dept[order, k]
+        r = rank[order, k].astype(float)
+        r[d < 0] = np.nan
+        frames.append(pd.DataFrame({
+            'student_id':          cohort.student_ids[order],
+            'term':                cohort.slot_terms[order, k],
+            'assigned_department': names[d],
+            'hope_rank':           r,
+            'is_imputed':          cohort.is_imputed[order],
+        }))
+    return pd.concat(frames, ignore_index=True)
+
+
+# --- 複数レプリケーション一括実行 ---
+
+def impute_prefs_batch(cohort: EncodedCohort, n_reps: int, rng: np.random.Generator,
+                       sampling: str = 'iid', groups: int = 1) -> np.ndarray:
+    """
+    (R × 学生 × 希望) の希望テンソルを返す。回答者行は全レプリケーション共通で、
+    未回答者行のみ人気重み付き・重複なしで補完する（既存の棄却サンプリングと同分布）。
+    sampling='lhs' なら Gumbel キーの一様乱数を、groups 個のブロックごとに
+    レプリケーション方向でラテン超方格に層別する（分布は同じで推定の分散が下がる）。
+    """
+    prefs = np.broadcast_to(cohort.base_prefs, (n_reps,) + cohort.base_prefs.shape).copy()
+    rows = cohort.unresp_rows[cohort.unresp_rows >= 0]
+    shape = (len(rows), len(cohort.pop_depts))
+    if sampling == 'lhs':
+        u = stratified_uniforms(rng, n_reps, shape, groups)
+    else:
+        u = rng.random((n_reps,) + shape)
+    picks = sample_weighted_hopes(pop_ids(cohort), cohort.pop_weights, cohort.max_hopes, u)
+    prefs[:, rows, :picks.shape[-1]] = picks
+    return prefs
+
+
+def allocate_slot_batch(order, prefs, masks, terms, cap, is_imputed, start=None):
+    """
+    allocate_slot の R レプリケーション一括版。抽選順は全レプリケーション共通なので
+    学生を一度だけ順に処理し、各希望の判定を R 方向にベクトル化する。
+    prefs: (R × 学生 × 希望), cap: (R × 科) 残り定員（その場で減算される）
+    start: (R,) レプリケーションごとに order の何番目から配属するか（省略時は先頭から）。
+    それより前の学生は配属しない（dept=-1, rank=0 のまま）
+    戻り値: (配属科 ID, 希望順位) の (R × 学生) 配列
+    """
+    n_reps, n, h = prefs.shape
+    dept = np.full((n_reps, n), -1, dtype=np.int64)
+    rank = np.zeros((n_reps, n), dtype=np.int64)
+    if start is None:
+        start = np.zeros(n_reps, dtype=np.int64)
+    done = np.arange(len(order))[None] >= start[:, None]  # (R × order) 配属を行った位置
+    if alloc_kernels.current() != 'numpy':
+        alloc_kernels.kernel('slot')(order, prefs, masks, terms, cap, dept, rank, start)
+        _count_scans('alloc.slot_batch', dept[:, order][done], rank[:, order][done], h)
+        return dept, rank
+    reps = np.arange(n_reps)
+    for j, s in enumerate(order.tolist()):
+        bit = 1 << int(terms[s])
+        todo = reps[done[:, j]]
+        if not len(todo):
+            continue
+        for i in range(h):
+            if not masks[s, i] & bit:
+                continue
+            if is_imputed[s]:
+                d = prefs[todo, s, i]
+                ok = (d >= 0) & (cap[todo, np.maximum(d, 0)] > 0)
+                hit, d = todo[ok], d[ok]
+            else:
+                d = prefs[0, s, i]
+                if d < 0:
+                    continue
+                hit = todo[cap[todo, d] > 0]
+            if not len(hit):
+                continue
+            cap[hit, d] -= 1
+            dept[hit, s] = d
+            rank[hit, s] = i + 1
+            todo = todo[dept[todo, s] < 0]
+            if not len(todo):
+                break
+    _count_scans('alloc.slot_batch', dept[:, order][done], rank[:, order][done], h)
+    return dept, rank
+
+
+def simulate_batch(cohort: EncodedCohort, prefs: np.ndarray, prefix: SlotPrefix = None):
+    """
+    R レプリケーションを一括でシミュレーションする。
+    決定的な先頭部分（slot_prefix。未指定ならここで作る）は一度だけ配属した結果を全
+    レプリケーションに配り、定員はその残りを (R × 科) に複製して尾部だけを処理する。
+    戻り値: dept, rank の (R × 学生 × スロット) 配列
+    """
+    if prefix is None:
+        prefix = slot_prefix(cohort)
+    n_reps = prefs.shape[0]
+    n_slots = len(cohort.term_labels)
+    order = np.argsort(cohort.lottery, kind='stable')
+    tail = order[prefix.length:]
+    dept = np.empty((n_reps, cohort.n_students, n_slots), dtype=np.int64)
+    rank = np.empty((n_reps, cohort.n_students, n_slots), dtype=np.int64)
+    for k in range(n_slots):
+        cap = np.broadcast_to(prefix.capacity[:, k], (n_reps, len(cohort.dept_names))).copy()
+        dept[:, :, k], rank[:, :, k] = allocate_slot_batch(
+            tail, prefs, cohort.masks, cohort.slot_terms[:, k], cap, cohort.is_imputed
+        )
+    dept[:, prefix.rows] = prefix.dept[prefix.rows]
+    rank[:, prefix.rows] = prefix.rank[prefix.rows]
+    count('alloc.prefix_reused', n_reps * prefix.length * n_slots)
+    return dept, rank
+
+
+def first_matched_hope(prefs: np.ndarray, dept: np.ndarray) -> np.ndarray:
+    """
+    各学生の希望リストのうち、いずれかのタームで配属された最初の希望位置を返す。
+    prefs: (学生 × 希望), dept: (R × 学生 × スロット)
+    戻り値: (R × 学生) 0 始まりの希望位置, 一致なしは -1
+    """
+    hit = (dept[:, :, None, :] == prefs[None, :, :, None]).any(axis=3)
+    hit &= prefs[None] >= 0
+    first = hit.argmax(axis=2)
+    first[~hit.any(axis=2)] = -1
+    return first
+
+
+def allocate_first_fit_batch(order, prefs, masks, slot_terms, cap, term_cols):
+    """
+    simulate_each_as_first の配属ルール: 抽選順に各学生の term_1→term_4 を走査し、
+    最初に空きのある (ターム, 希望) で 1 枠だけ配属する。
+    prefs/masks: (R × 学生 × 希望), cap: (R × 科 × 定員ターム列) 残り定員（その場で減算）
+    term_cols: ターム番号 → cap の列番号（EncodedCohort.term_cols）
+    戻り値: (配属科 ID, 配属スロット) の (R × 学生) 配列, 配属なしは (-1, -1)
+    """
+    n_reps, n, h = prefs.shape
+    dept = np.full((n_reps, n), -1, dtype=np.int64)
+    slot = np.full((n_reps, n), -1, dtype=np.int64)
+    if alloc_kernels.current() != 'numpy':
+        scanned = alloc_kernels.kernel('first_fit')(order, prefs, masks, slot_terms, cap, term_cols,
+                                                    dept, slot)
+        _count_first_fit(n_reps * len(order), dept, scanned)
+        return dept, slot
+    reps = np.arange(n_reps)
+    scanned = 0
+    for s in order.tolist():
+        todo = reps
+        for k, t in enumerate(slot_terms[s].tolist()):
+            c = term_cols[t] if 0 <= t < len(term_cols) else -1
+            if c < 0:
+                continue
+            bit = 1 << t
+            for i in range(h):
+                scanned += len(todo)
+                d = prefs[todo, s, i]
+                ok = (d >= 0) & (masks[todo, s, i] & bit != 0)
+                ok[ok] = cap[todo[ok], d[ok], c] > 0
+                if ok.any():
+                    hit = todo[ok]
+                    cap[hit, d[ok], c] -= 1
+                    dept[hit, s] = d[ok]
+                    slot[hit, s] = k
+                    todo = todo[~ok]
+                    if not len(todo):
+                        break
+            if not len(todo):
+                break
+    _count_first_fit(n_reps * len(order), dept, scanned)
+    return dept, slot
+
+
+def _count_first_fit(students: int, dept: np.ndarray, scanned: int):
+    count('alloc.first_fit.students', students)
+    count('alloc.first_fit.placed', int((dept >= 0).sum()))
+    count('alloc.first_fit.hopes_scanned', scanned)
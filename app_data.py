@@ -0,0 +1,81 @@
+"""
+Streamlit アプリ（student_viewer / admin_dashboard）共通のデータ読み込み層。
+
+読み込み結果はプロセス全体（全セッション共通）で 1 つだけ保持し、元ファイルの
+内容が変わったときだけ作り直す。ファイルの版は (mtime, サイズ) が変わったときに
+内容の SHA-256 を取り直して判定するので、内容が同じままの上書きでは再パースしない。
+固定 TTL は使わない。
+
+返り値は全セッションで共有されるオブジェクトなので、呼び出し側で変更しないこと
+（加工が必要なら build の中で行う）。
+"""
+import os
+import hashlib
+import threading
+
+import pandas as pd
+
+import artifacts
+
+_lock = threading.RLock()
+_versions = {}  # path -> ((mtime_ns, size), digest)
+_values = {}    # key  -> (ファイル版のタプル, 値)
+
+
+def file_version(path: str):
+    """ファイル内容のハッシュ。(mtime, サイズ) が前回と同じならハッシュを取り直さない。無ければ None"""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        _versions.pop(path, None)
+        return None
+    stat_key = (st.st_mtime_ns, st.st_size)
+    cached = _versions.get(path)
+    if cached and cached[0] == stat_key:
+        return cached[1]
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    _versions[path] = (stat_key, h.hexdigest())
+    return _versions[path][1]
+
+
+def load(key, paths, build):
+    """
+    paths の内容が前回と同じなら前回の build() の結果を返し、変わっていれば作り直す。
+    key は用途ごとに一意な名前（同じ key は同じ build を指すこと）。
+    """
+    with _lock:
+        version = tuple(file_version(p) for p in paths)
+        cached = _values.get(key)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        value = build()
+        _values[key] = (version, value)
+        return value
+
+
+def read_csv(path: str, optional: bool = False, **kwargs):
+    """共有キャッシュ付きの pd.read_csv。optional=True ならファイルが無いとき None"""
+    def build():
+        if optional and not os.path.exists(path):
+            return None
+        return pd.read_csv(path, **kwargs)
+    return load(('csv', path, repr(sorted(kwargs.items()))), [path], build)
+
+
+def read_table(path: str, optional: bool = False):
+    """パイプライン成果物の共有キャッシュ付き読み込み（型付き .npz があればそちら、無ければ CSV）"""
+    def build():
+        if optional and not (os.path.exists(path) or os.path.exists(artifacts.artifact_path(path))):
+            return None
+        return artifacts.read_table(path)
+    return load(('table', path), [path, artifacts.artifact_path(path)], build)
+
+
+def clear():
+    """キャッシュを全て捨てる（「最新データを取得」ボタン用）"""
+    with _lock:
+        _versions.clear()
+        _values.clear()
@@ -0,0 +1,301 @@
+"""
+中間成果物（パイプラインの出力表）の型付き列指向フォーマット。
+
+各成果物は SCHEMAS で列の型を宣言し、CSV と同じ名前の .npz（非圧縮）に列ごとの配列として保存する。
+  'id'        student_id。先頭ゼロを除いた文字列
+  'str'       文字列
+  'int'       整数（欠損不可）
+  'optint'    整数（欠損可）。欠損は INT_NA で保存し、pandas の Int64 で復元
+  'float'     float64（欠損は NaN）
+  'category'  科名などの文字列。語彙番号（-1 は欠損）で保存
+  'sparse'    float64 をほとんどの行が取る値（fill）と、それ以外の (行, 値) だけで保存
+
+非圧縮 npz なので、読み込み側は zip 内の各配列をファイルから直接メモリマップできる。
+CSV は人が見る・既存ツールに渡すための公開用出力として引き続き書き出せる（publish）。
+"""
+import io
+import os
+import json
+import hashlib
+import zipfile
+import fnmatch
+
+import numpy as np
+import pandas as pd
+
+SCHEMA_VERSION = 2
+INT_NA = np.iinfo(np.int64).min  # 'optint' の欠損
+
+SCHEMAS = {
+    "initial_assignment_result.csv": [
+        ("student_id", "id"), ("term", "int"),
+        ("assigned_department", "category"), ("matched_priority", "optint"),
+    ],
+    "probability_montecarlo_combined.csv": [
+        ("student_id", "id"), ("hope_*_確率", "sparse"),
+        ("hope_*_下限", "sparse"), ("hope_*_上限", "sparse"), ("hope_*_標準誤差", "sparse"),
+        ("試行回数", "int"),
+    ],
+    "popular_departments_rank_by_term.csv": [
+        ("assigned_department", "category"), ("term", "int"),
+        ("抽選順位推定ライン", "float"), ("抽選順位_p*", "float"), ("試行回数", "int"),
+    ],
+    "assignment_matrix.csv": [
+        ("student_id", "id"), ("term_*", "category"),
+    ],
+    "department_summary.csv": [
+        ("病院-診療科", "category"), ("Term*", "float"),
+    ],
+    "capacity_sensitivity.csv": [
+        ("順位", "int"), ("hospital_department", "category"), ("term", "int"),
+        ("定員", "int"), ("満席率", "float"), ("増席_*", "float"), ("減席_*", "float"),
+        ("試行回数", "int"),
+    ],
+    "first_choice_probabilities.csv": [
+        ("student_id", "id"), ("希望科", "category"), ("通過確率", "float"),
+        ("下限", "float"), ("上限", "float"), ("標準誤差", "float"), ("試行回数", "int"),
+    ],
+}
+
+
+def artifact_path(csv_path: str) -> str:
+    """CSV 名に対応する成果物ファイル名（x.csv → x.npz）"""
+    return os.path.splitext(csv_path)[0] + ".npz"
+
+
+def column_types(df: pd.DataFrame, schema) -> dict:
+    """df の各列に schema の型を割り当てる。宣言のない列があればエラー"""
+    types = {}
+    for col in df.columns:
+        for pattern, kind in schema:
+            if fnmatch.fnmatchcase(str(col), pattern):
+                types[col] = kind
+                break
+        else:
+            raise ValueError(f"列 {col!r} はスキーマに宣言されていません")
+    return types
+
+
+def conform(df: pd.DataFrame, schema) -> pd.DataFrame:
+    """
+    df の列を schema の型に揃えた（read_artifact が返すのと同じ）DataFrame。
+    公開用 CSV もこれから書くので、成果物から復元した CSV はバイト単位で元の CSV と一致する
+    """
+    out = df.copy()
+    for col, kind in column_types(df, schema).items():
+        values = df[col]
+        if kind == 'id':
+            text = values.astype(object)
+            out[col] = text.where(text.isna(), text.astype(str).str.lstrip('0'))
+        elif kind == 'int':
+            if values.isna().any():
+                raise ValueError(f"int 列 {col!r} に欠損があります")
+            out[col] = pd.to_numeric(values).astype(np.int64)
+        elif kind == 'optint':
+            out[col] = pd.to_numeric(values).astype("Int64")
+        elif kind in ('float', 'sparse'):
+            out[col] = pd.to_numeric(values).astype(np.float64)
+    return out
+
+
+# --- 書き出し ---
+#
+# 文字列（id / str / category）はファイル全体で 1 つの語彙（UTF-8 の連結バイト列＋オフセット）に
+# まとめ、列は語彙番号（-1 は欠損）の 2 次元ブロック codes に入れる。数値は型ごとの 2 次元ブロック
+# ints / floats、'sparse' 列は fill 値と COO（行, 列, 値）で持つ。
+
+def _vocab_arrays(vocab: list) -> dict:
+    encoded = [v.encode('utf-8') for v in vocab]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(e) for e in encoded])
+    return {"strings": np.frombuffer(b"".join(encoded), dtype=np.uint8),
+            "offsets": offsets}
+
+
+def _narrow(block: np.ndarray) -> np.ndarray:
+    """値を失わずに収まる最小の型に落とす（整数は int8〜int64、実数は float32 で表せれば float32）"""
+    if block.dtype.kind == 'i':
+        lo, hi = (int(block.min()), int(block.max())) if block.size else (0, 0)
+        return block.astype(np.result_type(np.min_scalar_type(lo), np.min_scalar_type(hi), np.int8))
+    narrow = block.astype(np.float32)
+    same = (narrow == block) | (np.isnan(narrow) & np.isnan(block))
+    return narrow if same.all() else block
+
+
+def artifact_bytes(df: pd.DataFrame, schema) -> bytes:
+    """df をスキーマに従って非圧縮 npz のバイト列にする"""
+    df = conform(df, schema)
+    types = column_types(df, schema)
+    n = len(df)
+    vocab, vocab_index = [], {}
+    blocks = {"codes": [], "ints": [], "floats": []}
+    sparse_fill, sp_row, sp_col, sp_val = [], [], [], []
+    layout = []
+    for col in df.columns:
+        kind, values = types[col], df[col]
+        if kind in ('id', 'str', 'category'):
+            text = values.astype(object)
+            codes = np.full(n, -1, dtype=np.int64)
+            for i, v in enumerate(text):
+                if not pd.isna(v):
+                    v = str(v)
+                    if v not in vocab_index:
+                        vocab_index[v] = len(vocab)
+                        vocab.append(v)
+                    codes[i] = vocab_index[v]
+            block, data = "codes", codes
+        elif kind == 'int':
+            block, data = "ints", values.to_numpy(dtype=np.int64)
+        elif kind == 'optint':
+            block, data = "ints", values.to_numpy(dtype=np.int64, na_value=INT_NA)
+        elif kind == 'float':
+            block, data = "floats", values.to_numpy(dtype=np.float64)
+        elif kind == 'sparse':
+            x = values.to_numpy(dtype=np.float64)
+            uniq, counts = np.unique(x, return_counts=True)  # NaN は末尾にまとまる
+            fill = uniq[np.argmax(counts)] if n else 0.0
+            keep = np.flatnonzero(~((x == fill) | (np.isnan(x) & np.isnan(fill))))
+            layout.append([str(col), kind, len(sparse_fill)])
+            sparse_fill.append(fill)
+            sp_row.append(keep)
+            sp_col.append(np.full(len(keep), len(sparse_fill) - 1))
+            sp_val.append(x[keep])
+            continue
+        else:
+            raise ValueError(f"未知の列型: {kind}")
+        layout.append([str(col), kind, len(blocks[block])])
+        blocks[block].append(data)
+
+    header = {"version": SCHEMA_VERSION, "rows": n, "columns": layout,
+              "csv_sha256": hashlib.sha256(df.to_csv(index=False).encode('utf-8')).hexdigest()}
+    arrays = {"__schema__": np.array(json.dumps(header, ensure_ascii=False))}
+    arrays.update(_vocab_arrays(vocab))
+    for name, dtype in (("codes", np.int64), ("ints", np.int64), ("floats", np.float64)):
+        block = np.stack(blocks[name], axis=1) if blocks[name] else np.zeros((n, 0), dtype=dtype)
+        arrays[name] = _narrow(block.astype(dtype))
+    if sparse_fill:
+        arrays["sp_fill"] = np.array(sparse_fill, dtype=np.float64)
+        arrays["sp_row"] = np.concatenate(sp_row).astype(np.int32)
+        arrays["sp_col"] = np.concatenate(sp_col).astype(np.int16)
+        arrays["sp_val"] = np.concatenate(sp_val)
+    buf = io.BytesIO()
+    np.savez(buf, **arrays)
+    return buf.getvalue()
+
+
+def write_artifact(csv_path: str, df: pd.DataFrame):
+    with open(artifact_path(csv_path), 'wb') as f:
+        f.write(artifact_bytes(df, SCHEMAS[csv_path]))
+
+
+def publish(df: pd.DataFrame, csv_path: str, csv: bool = True):
+    """成果物（.npz）を書き、csv=True なら公開用の CSV も書く"""
+    if csv_path in SCHEMAS:
+        df = conform(df, SCHEMAS[csv_path])
+    if csv or csv_path not in SCHEMAS:
+        df.to_csv(csv_path, index=False)
+    if csv_path in SCHEMAS:
+        write_artifact(csv_path, df)
+
+
+# --- 読み込み ---
+
+def _member_arrays(path: str, mmap: bool) -> dict:
+    """npz の各配列。mmap=True なら非圧縮メンバーをファイル上の位置から直接メモリマップする"""
+    if not mmap:
+        with np.load(path) as z:
+            return {k: z[k] for k in z.files}
+    arrays = {}
+    with zipfile.ZipFile(path) as zf, open(path, 'rb') as f:
+        for info in zf.infolist():
+            name = info.filename[:-len(".npy")]
+            f.seek(info.header_offset)
+            local = f.read(30)
+            start = info.header_offset + 30 + int.from_bytes(local[26:28], 'little') \
+                + int.from_bytes(local[28:30], 'little')
+            f.seek(start)
+            version = np.lib.format.read_magic(f)
+            read_header = (np.lib.format.read_array_header_1_0 if version == (1, 0)
+                           else np.lib.format.read_array_header_2_0)
+            shape, fortran, dtype = read_header(f)
+            if info.compress_type != zipfile.ZIP_STORED or dtype.hasobject or not np.prod(shape):
+                arrays[name] = np.load(zf.open(info.filename))
+                continue
+            arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=f.tell(), shape=shape,
+                                     order='F' if fortran else 'C')
+    return arrays
+
+
+def read_schema(path: str) -> dict:
+    with np.load(path) as z:
+        return json.loads(str(z["__schema__"]))
+
+
+def read_artifact(path: str, columns=None, mmap: bool = True, categorical: bool = False) -> pd.DataFrame:
+    """
+    成果物を DataFrame として読む。columns を指定するとその列だけ復元する。
+    categorical=True ならカテゴリ列を pd.Categorical のまま返す（既定は文字列に戻す）。
+    """
+    arrays = _member_arrays(path, mmap)
+    header = json.loads(str(arrays["__schema__"]))
+    n = header["rows"]
+    blob, offsets = bytes(arrays["strings"]), arrays["offsets"]
+    vocab = np.array([blob[offsets[i]:offsets[i + 1]].decode('utf-8')
+                      for i in range(len(offsets) - 1)] + [np.nan], dtype=object)
+    out = {}
+    for col, kind, pos in header["columns"]:
+        if columns is not None and col not in columns:
+            continue
+        if kind in ('id', 'str', 'category'):
+            codes = np.asarray(arrays["codes"][:, pos], dtype=np.int64)
+            if kind == 'category' and categorical:
+                used = np.unique(codes[codes >= 0])
+                values = pd.Categorical.from_codes(np.searchsorted(used, codes) * (codes >= 0)
+                                                   - (codes < 0), categories=list(vocab[used]))
+            else:
+                values = vocab[codes]  # -1 は末尾の NaN を指す
+        elif kind == 'int':
+            values = np.asarray(arrays["ints"][:, pos], dtype=np.int64)
+        elif kind == 'optint':
+            ints = np.array(arrays["ints"][:, pos], dtype=np.int64)
+            values = pd.arrays.IntegerArray(ints, ints == INT_NA)
+        elif kind == 'float':
+            values = np.asarray(arrays["floats"][:, pos], dtype=np.float64)
+        else:
+            values = np.full(n, arrays["sp_fill"][pos])
+            sel = np.asarray(arrays["sp_col"]) == pos
+            values[np.asarray(arrays["sp_row"])[sel]] = np.asarray(arrays["sp_val"])[sel]
+        out[col] = values
+    return pd.DataFrame(out, index=pd.RangeIndex(n))
+
+
+def csv_matches_artifact(csv_path: str) -> bool:
+    """CSV と成果物の両方があり、CSV が成果物を書いたときの内容のまま（ハッシュが一致）か"""
+    npz = artifact_path(csv_path)
+    if not (os.path.exists(npz) and os.path.exists(csv_path)):
+        return False
+    with open(csv_path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest() == read_schema(npz).get("csv_sha256")
+
+
+def has_fresh_artifact(csv_path: str) -> bool:
+    """
+    成果物があり、CSV と同じ内容か CSV より新しい（CSV だけ手で更新された場合は使わない）。
+    git の checkout では更新時刻が当てにならないので、まず内容ハッシュで比べる。
+    """
+    npz = artifact_path(csv_path)
+    if not os.path.exists(npz):
+        return False
+    if not os.path.exists(csv_path) or csv_matches_artifact(csv_path):
+        return True
+    return os.path.getmtime(npz) > os.path.getmtime(csv_path)
+
+
+def read_table(csv_path: str, **kwargs) -> pd.DataFrame:
+    """成果物があればそれを、無ければ CSV を読む（kwargs は read_artifact に渡す）"""
+    if csv_path in SCHEMAS and has_fresh_artifact(csv_path):
+        return read_artifact(artifact_path(csv_path), **kwargs)
+    df = pd.read_csv(csv_path, dtype={'student_id': str})
+    if 'student_id' in df.columns:
+        df['student_id'] = df['student_id'].str.lstrip('0')
+    return df
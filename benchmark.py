@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+"""
+合成コホートでの規模別ベンチマーク。
+
+各規模（synthetic_cohort.CohortSpec）ごとに一時ディレクトリへ入力 CSV を生成し、
+initial_assignment / run_simulation / generate_probability / simulate_each_as_first の
+計算部分（入力の読み込み・エンコードは計測外）の時間とピークメモリを JSON に記録する。
+各ケースは別プロセスで実行するので、メモリ不足による強制終了やタイムアウトも結果として残る。
+保存済みのベースラインと比べて遅くなったケースを回帰として表示する。
+
+ある規模で 1 回の実行が --budget 秒を超えたケースは、それより大きい規模では実行しない
+（どの規模で破綻するかを記録するため、結果には status を残す）。
+
+--check-engines は計測の代わりに、各規模の合成コホートで python（と、入っていれば numba）の
+配属カーネルが numpy 実装と同じ配属を返すかを確かめる（不一致があれば終了コード 1）。
+"""
+import os
+import sys
+import json
+import time
+import signal
+import platform
+import argparse
+import resource
+import tempfile
+import contextlib
+import subprocess
+import multiprocessing
+from queue import Empty
+from dataclasses import asdict
+
+import numpy as np
+import pandas as pd
+
+import alloc_kernels
+import initial_assignment
+import generate_probability
+import simulate_each_as_first
+from allocation_engine import (encode_cohort, impute_prefs_batch, simulate_batch, slot_prefix,
+                               allocate_slot_batch, allocate_first_fit_batch)
+from perf_trace import counters_snapshot, counters_since, students_allocated
+from preference_model import load_preferences
+from simulate_with_unanswered import run_simulation
+from synthetic_cohort import CohortSpec, generate_cohort, write_cohort
+
+RESULTS_PATH = "benchmark_results.json"
+BASELINE_PATH = "benchmark_baseline.json"
+
+# 名前付きの規模（実データはおよそ current）
+SCALES = {
+    "current": CohortSpec(students=110, departments=92),
+    "x5":      CohortSpec(students=500, departments=200),
+    "x20":     CohortSpec(students=2000, departments=400),
+    "x50":     CohortSpec(students=5000, departments=800),
+}
+
+
+def parse_scale(text: str) -> CohortSpec:
+    """名前付きの規模、または「学生数x科数[xターム数]」"""
+    if text in SCALES:
+        return SCALES[text]
+    try:
+        nums = [int(v) for v in text.split("x")]
+        return CohortSpec(*nums)
+    except (TypeError, ValueError):
+        raise argparse.ArgumentTypeError(
+            f"規模は {', '.join(SCALES)} または 学生数x科数[xターム数] で指定してください: {text}")
+
+
+def positive_int(text: str) -> int:
+    value = int(text)
+    if value < 1:
+        raise argparse.ArgumentTypeError(f"1 以上の整数を指定してください: {text}")
+    return value
+
+
+@contextlib.contextmanager
+def working_directory(path: str):
+    """contextlib.chdir（Python 3.11+）の代わり。CI は 3.9 で動かす"""
+    previous = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+
+# --- 計測ケース ---
+#
+# 各ケースは setup(args) -> (run, 処理学生数)。setup はカレントディレクトリの入力を読み、
+# run() が計測対象の計算だけを行う。
+
+def case_initial_assignment(args):
+    inputs = initial_assignment.read_inputs()
+    return (lambda: initial_assignment.initial_assignment(*inputs)), len(inputs[0])
+
+
+def case_run_simulation(args):
+    responses, lottery, capacity_df, terms_df, _ = generate_probability.read_inputs()
+    return (lambda: run_simulation(responses, lottery, capacity_df, terms_df)), len(terms_df)
+
+
+def case_generate_probability(args):
+    inputs = generate_probability.read_inputs()
+    def run():
+        return generate_probability.generate_probability(
+            *inputs, N=args.iterations, batch_size=args.batch_size, seed=0)
+    return run, len(inputs[0])
+
+
+def case_simulate_each_as_first(args):
+    """回答者の先頭 --sample 人分。全員分の見積もりは学生あたりの時間 × 回答者数"""
+    responses, lottery, terms_df, capacity = simulate_each_as_first.load_inputs()
+    cohort = encode_cohort(responses, lottery, capacity, terms_df)
+    students = responses["student_id"].tolist()[:args.sample]
+    tasks = simulate_each_as_first.build_tasks(load_preferences(responses, terms_df), students, seed=0)
+    def run():
+        for sid, targets, pool, seed_seq in tasks:
+            simulate_each_as_first.first_choice_probabilities(
+                cohort, sid, targets, pool, simulate_each_as_first.N_SIMULATIONS,
+                np.random.default_rng(seed_seq))
+    return run, len(students)
+
+
+def case_allocation_kernel(args):
+    """配属ループだけ（補完済みの --batch-size レプリケーションを simulate_batch で配属）"""
+    responses, lottery, capacity_df, terms_df, _ = generate_probability.read_inputs()
+    cohort = encode_cohort(responses, lottery, capacity_df, terms_df)
+    prefs = impute_prefs_batch(cohort, args.batch_size, np.random.default_rng(0))
+    prefix = slot_prefix(cohort)
+    return (lambda: simulate_batch(cohort, prefs, prefix)), cohort.n_students
+
+
+CASES = {
+    "initial_assignment":     case_initial_assignment,
+    "run_simulation":         case_run_simulation,
+    "generate_probability":   case_generate_probability,
+    "simulate_each_as_first": case_simulate_each_as_first,
+    "allocation_kernel":      case_allocation_kernel,
+}
+
+
+def time_case(name: str, args, engine: str, queue):
+    """
+    子プロセスで 1 ケースを計測し、結果を queue に入れる。
+    allocated_per_second は配属カーネルが処理した延べ学生数（レプリケーション × 学生）の毎秒値
+    """
+    try:
+        with contextlib.redirect_stdout(None):
+            engine = alloc_kernels.select(engine)
+        run, n_students = CASES[name](args)
+        times = []
+        for _ in range(args.repeat):
+            before = counters_snapshot()
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(None):  # 進捗表示や警告は出さない
+                run()
+            times.append(time.perf_counter() - start)
+            allocated = students_allocated(counters_since(before))
+            if times[-1] > args.budget:
+                break
+        best = min(times)
+        queue.put({"status": "ok", "engine": engine, "seconds": best,
+                   "seconds_median": float(np.median(times)),
+                   "repeats": len(times), "students": n_students,
+                   "students_per_second": n_students / best if best > 0 else None,
+                   "allocated": allocated,
+                   "allocated_per_second": allocated / best if best > 0 else None,
+                   "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024})
+    except MemoryError:
+        queue.put({"status": "error: MemoryError"})
+    except Exception as e:
+        queue.put({"status": f"error: {type(e).__name__}: {e}"})
+
+
+def run_isolated(name: str, args, engine: str = "numpy") -> dict:
+    """
+    ケースを別プロセスで実行する。メモリ不足で強制終了されたりタイムアウトしたりしても
+    ベンチマーク全体は止めずに、その旨を status に残す。
+    """
+    ctx = multiprocessing.get_context("fork")
+    queue = ctx.Queue()
+    proc = ctx.Process(target=time_case, args=(name, args, engine, queue))
+    proc.start()
+    deadline = time.monotonic() + args.timeout
+    while True:
+        try:
+            result = queue.get(timeout=0.5 if proc.is_alive() else 1.0)
+            proc.join()
+            return result
+        except Empty:
+            if not proc.is_alive():
+                proc.join()
+                if proc.exitcode == -signal.SIGKILL:
+                    return {"status": "error: killed (SIGKILL, likely out of memory)"}
+                return {"status": f"error: worker exited with code {proc.exitcode}"}
+            if time.monotonic() > deadline:
+                proc.kill()
+                proc.join()
+                return {"status": f"error: timeout after {args.timeout:g}s"}
+
+
+def run_benchmarks(scales, cases, args) -> list:
+    results = []
+    over_budget = {}  # (ケース, エンジン) → 予算を超えた（または失敗した）規模
+    for spec in scales:
+        with tempfile.TemporaryDirectory() as tmp:
+            write_cohort(generate_cohort(spec), tmp)
+            with working_directory(tmp):
+                for name in cases:
+                    for engine in args.engines:
+                        entry = {"scale": spec.label(), "case": name, "engine": engine,
+                                 "spec": asdict(spec)}
+                        if (name, engine) in over_budget:
+                            entry.update(status=f"skipped (over budget at {over_budget[name, engine]})")
+                        else:
+                            entry.update(run_isolated(name, args, engine))
+                            if entry["status"] != "ok" or entry["seconds"] > args.budget:
+                                over_budget[name, engine] = spec.label()
+                        results.append(entry)
+                        print(format_row(entry), flush=True)
+    return results
+
+
+# --- 結果の保存とベースライン比較 ---
+
+def environment() -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                                text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ""
+    return {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "commit": commit,
+            "python": platform.python_version(), "numpy": np.__version__, "pandas": pd.__version__,
+            "machine": platform.machine(), "processor": platform.processor(),
+            "cpu_count": os.cpu_count()}
+
+
+def save_results(results: list, path: str, args):
+    settings = {"iterations": args.iterations, "batch_size": args.batch_size,
+                "sample": args.sample, "repeat": args.repeat, "budget": args.budget,
+                "engines": args.engines}
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"environment": environment(), "settings": settings, "results": results},
+                  f, ensure_ascii=False, indent=2)
+        f.write("\n")
+
+
+def compare(results: list, baseline_path: str, tolerance: float, min_delta: float) -> list:
+    """
+    ベースラインと同じ (規模, ケース, エンジン) の計測時間を比べ、(1 + tolerance) 倍を超えて
+    かつ min_delta 秒以上遅くなったものを回帰として返す。各結果に ratio / regression を書き込む。
+    """
+    if not os.path.exists(baseline_path):
+        return []
+    with open(baseline_path, encoding="utf-8") as f:
+        base = {(r["scale"], r["case"], r.get("engine", "numpy")): r
+                for r in json.load(f)["results"] if r.get("status") == "ok"}
+    regressions = []
+    for r in results:
+        b = base.get((r["scale"], r["case"], r.get("engine", "numpy")))
+        if not b or r.get("status") != "ok":
+            continue
+        r["baseline_seconds"] = b["seconds"]
+        r["ratio"] = r["seconds"] / b["seconds"] if b["seconds"] > 0 else None
+        r["regression"] = (r["seconds"] > b["seconds"] * (1 + tolerance)
+                           and r["seconds"] - b["seconds"] >= min_delta)
+        if r["regression"]:
+            regressions.append(r)
+    return regressions
+
+
+def format_row(r: dict) -> str:
+    head = f"{r['scale']:>16} {r['case']:<24} {r.get('engine', 'numpy'):<7}"
+    if r.get("status") != "ok":
+        return f"{head} {r['status']}"
+    line = (f"{head} {r['seconds']:9.3f}s  {r['students_per_second'] or 0:10.1f} students/s"
+            f"  {r.get('allocated_per_second') or 0:12,.0f} allocated/s  {r['peak_rss_mb']:7.0f} MB")
+    if r.get("ratio") is not None:
+        line += f"  x{r['ratio']:.2f} vs baseline" + ("  ⚠️ REGRESSION" if r["regression"] else "")
+    return line
+
+
+# --- エンジン間の一致確認 ---
+
+def engine_outputs(cohort, prefs, starts) -> dict:
+    """現在のエンジンでの配属結果（simulate_batch / 開始位置つき allocate_slot_batch / first-fit）"""
+    n_reps = prefs.shape[0]
+    order = np.argsort(cohort.lottery, kind='stable')
+    dept, rank = simulate_batch(cohort, prefs)
+    cap = np.broadcast_to(cohort.capacity[:, cohort.slot_cols[0]],
+                          (n_reps, len(cohort.dept_names))).copy()
+    start_dept, start_rank = allocate_slot_batch(order, prefs, cohort.masks, cohort.slot_terms[:, 0],
+                                                 cap, cohort.is_imputed, start=starts)
+    ff_cap = np.broadcast_to(cohort.capacity, (n_reps,) + cohort.capacity.shape).copy()
+    masks = np.broadcast_to(cohort.masks, prefs.shape).copy()
+    ff_dept, ff_slot = allocate_first_fit_batch(order, prefs, masks, cohort.slot_terms, ff_cap,
+                                                cohort.term_cols())
+    return {"simulate_batch": (dept, rank),
+            "allocate_slot_batch(start)": (start_dept, start_rank, cap),
+            "allocate_first_fit_batch": (ff_dept, ff_slot, ff_cap)}
+
+
+def check_engines(spec: CohortSpec, n_reps: int = 20, seed: int = 0) -> list:
+    """
+    合成コホートで各エンジンの配属結果を numpy エンジンと比べる。
+    numba が無ければ numba は飛ばす。戻り値は一致しなかった (エンジン, 関数) のリスト
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        write_cohort(generate_cohort(spec), tmp)
+        with working_directory(tmp), contextlib.redirect_stdout(None):
+            responses, lottery, capacity_df, terms_df, _ = generate_probability.read_inputs()
+            cohort = encode_cohort(responses, lottery, capacity_df, terms_df)
+    rng = np.random.default_rng(seed)
+    prefs = impute_prefs_batch(cohort, n_reps, rng)
+    starts = rng.integers(0, cohort.n_students + 1, size=n_reps)
+
+    engines = ["python"] + (["numba"] if alloc_kernels.numba is not None else [])
+    previous = alloc_kernels.current()
+    try:
+        alloc_kernels.select("numpy")
+        expected = engine_outputs(cohort, prefs, starts)
+        mismatches = []
+        for engine in engines:
+            alloc_kernels.select(engine)
+            for name, arrays in engine_outputs(cohort, prefs, starts).items():
+                if not all(np.array_equal(a, b) for a, b in zip(arrays, expected[name])):
+                    mismatches.append((engine, name))
+    finally:
+        alloc_kernels.select(previous)
+    status = "❌ 不一致: " + ", ".join(f"{e}/{n}" for e, n in mismatches) if mismatches else "✅ 一致"
+    print(f"{spec.label():>16} {', '.join(engines)} vs numpy: {status}", flush=True)
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Scaling benchmark on synthetic cohorts")
+    parser.add_argument("--scales", nargs="+", type=parse_scale,
+                        default=[SCALES["current"], SCALES["x5"], SCALES["x20"]],
+                        help=f"Named scales ({', '.join(SCALES)}) or STUDENTSxDEPARTMENTS[xTERMS] "
+                             "(default: current x5 x20)")
+    parser.add_argument("--cases", nargs="+", choices=list(CASES), default=list(CASES),
+                        help="Cases to run (default: all)")
+    parser.add_argument("--engines", nargs="+", choices=alloc_kernels.ENGINES, default=["numpy"],
+                        help="Allocation kernels to time each case with; numba falls back to numpy "
+                             "when it is not installed (default: numpy)")
+    parser.add_argument("--iterations", type=int, default=100,
+                        help="Monte Carlo iterations for generate_probability (default: %(default)s)")
+    parser.add_argument("--batch-size", type=int, default=500,
+                        help="Batch size for generate_probability (default: %(default)s)")
+    parser.add_argument("--sample", type=int, default=5,
+                        help="Students timed in simulate_each_as_first (default: %(default)s)")
+    parser.add_argument("--repeat", type=positive_int, default=3,
+                        help="Repetitions per case; the fastest is recorded (default: %(default)s)")
+    parser.add_argument("--budget", type=float, default=60.0,
+                        help="Seconds per run above which larger scales are skipped for that case "
+                             "(default: %(default)s)")
+    parser.add_argument("--timeout", type=float, default=600.0,
+                        help="Hard limit in seconds for one case including repeats (default: %(default)s)")
+    parser.add_argument("--output", default=RESULTS_PATH, help="Results JSON (default: %(default)s)")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="Baseline JSON (default: %(default)s)")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="Allowed slowdown ratio before flagging a regression (default: %(default)s)")
+    parser.add_argument("--min-delta", type=float, default=0.05,
+                        help="Ignore slowdowns smaller than this many seconds (default: %(default)s)")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="Also write the results as the new baseline")
+    parser.add_argument("--fail-on-regression", action="store_true",
+                        help="Exit with status 1 when a regression is flagged")
+    parser.add_argument("--check-engines", action="store_true",
+                        help="Instead of timing, check that the python (and numba, if installed) "
+                             "allocation kernels give the same allocations as numpy on each scale")
+    args = parser.parse_args()
+
+    if args.check_engines:
+        if alloc_kernels.numba is None:
+            print("ℹ️ numba がインストールされていないため numba エンジンの確認は飛ばします")
+        mismatches = [m for spec in args.scales for m in check_engines(spec)]
+        sys.exit(1 if mismatches else 0)
+
+    results = run_benchmarks(args.scales, args.cases, args)
+    regressions = compare(results, args.baseline, args.tolerance, args.min_delta)
+    if os.path.exists(args.baseline):
+        print("\n--- ベースライン比較 ---")
+        for r in results:
+            print(format_row(r))
+    save_results(results, args.output, args)
+    print(f"✅ {args.output} に結果を保存しました")
+    if args.save_baseline:
+        save_results(results, args.baseline, args)
+        print(f"✅ {args.baseline} をベースラインとして保存しました")
+    if regressions:
+        print(f"⚠️ {len(regressions)} 件の回帰があります")
+        if args.fail_on_regression:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
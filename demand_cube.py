@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+抽選順位 × 希望順位 × 科 × ターム の累積希望人数キューブ（student_viewer の機能3用）。
+
+counts[p, h, d, t] = 抽選順で先頭 p 人の学生のうち、第1～第(h+1)希望に科 d をターム t で
+挙げた延べ人数。抽選順位・希望順位の両方向に累積和を取ってあるので、
+「自分より抽選順位が高い学生の第1～5希望人数」は counts[自分の順位, 4] を切り出すだけで求まる。
+
+ターム指定の扱いは既存の機能3と同じ（hope_i_terms のうち自分のタームに含まれるもの、
+無ければ自分の全ターム）。
+"""
+import io
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+from preference_model import normalize_hope, parse_term_list
+
+HOPE_RANKS = 5
+CUBE_PATH = "demand_cube.npz"
+
+
+@dataclass
+class DemandCube:
+    dept_names:     np.ndarray  # (科,) 名前順
+    lottery_sorted: np.ndarray  # (学生,) 昇順の lottery_order
+    counts:         np.ndarray  # (学生+1 × 希望順位 × 科 × ターム) 累積人数
+
+    def position_of(self, lottery_order: int) -> int:
+        """lottery_order より抽選順位が高い（番号が小さい）学生の数"""
+        return int(np.searchsorted(self.lottery_sorted, lottery_order, side='left'))
+
+    def table(self, lottery_order: int, max_hope: int = HOPE_RANKS) -> pd.DataFrame:
+        """自分より抽選順位が高い学生の第1～max_hope希望人数（行: 診療科, 列: Term）"""
+        sub = self.counts[self.position_of(lottery_order), max_hope - 1]
+        rows = np.flatnonzero(sub.any(axis=1))
+        cols = np.flatnonzero(sub.any(axis=0))
+        return pd.DataFrame(sub[np.ix_(rows, cols)],
+                            index=pd.Index(self.dept_names[rows], name='診療科'),
+                            columns=pd.Index(cols, name='Term'))
+
+    def to_bytes(self) -> bytes:
+        buf = io.BytesIO()
+        np.savez_compressed(buf, dept_names=self.dept_names,
+                            lottery_sorted=self.lottery_sorted, counts=self.counts)
+        return buf.getvalue()
+
+    @classmethod
+    def load(cls, path: str = CUBE_PATH) -> 'DemandCube':
+        with np.load(path) as z:
+            return cls(dept_names=z['dept_names'], lottery_sorted=z['lottery_sorted'],
+                       counts=z['counts'])
+
+
+def build_demand_cube(responses: pd.DataFrame, lottery_df: pd.DataFrame,
+                      terms_df: pd.DataFrame) -> DemandCube:
+    responses = responses.assign(student_id=responses['student_id'].str.lstrip('0'))
+    responses = responses.drop_duplicates('student_id', keep='last').set_index('student_id')
+    lottery_df = lottery_df.assign(student_id=lottery_df['student_id'].str.lstrip('0'))
+    lottery_df = lottery_df.sort_values('lottery_order', kind='stable')
+    term_map = {
+        str(sid).lstrip('0'): [int(t) for t in terms]
+        for sid, *terms in terms_df[['student_id', 'term_1', 'term_2', 'term_3', 'term_4']]
+        .itertuples(index=False)
+    }
+
+    # 学生ごとの (順位, 希望順位, 科, ターム) を列挙
+    events = []
+    for pos, uid in enumerate(lottery_df['student_id']):
+        if uid not in responses.index or uid not in term_map:
+            continue
+        default_terms = term_map[uid]
+        row = responses.loc[uid]
+        for i in range(1, HOPE_RANKS + 1):
+            dept, _ = normalize_hope(row.get(f'hope_{i}'))
+            if dept is None:
+                continue
+            term_list = parse_term_list(row.get(f'hope_{i}_terms', ''), default_terms)
+            for t in term_list or default_terms:
+                events.append((pos, i - 1, dept, t))
+
+    dept_names = np.array(sorted({e[2] for e in events}), dtype=str)
+    dept_index = {d: k for k, d in enumerate(dept_names)}
+    n_terms = max([e[3] for e in events] + [0]) + 1
+    counts = np.zeros((len(lottery_df) + 1, HOPE_RANKS, len(dept_names), n_terms), dtype=np.int32)
+    for pos, h, dept, t in events:
+        counts[pos + 1, h, dept_index[dept], t] += 1
+    counts = counts.cumsum(axis=0).cumsum(axis=1).astype(np.int32)
+
+    return DemandCube(dept_names=dept_names,
+                      lottery_sorted=lottery_df['lottery_order'].to_numpy(dtype=np.int64),
+                      counts=counts)
+
+
+def read_inputs(read_csv=pd.read_csv):
+    responses = read_csv("responses.csv", dtype={'student_id': str})
+    lottery_df = read_csv("lottery_order.csv", dtype={'student_id': str, 'lottery_order': int})
+    terms_df = read_csv("student_terms.csv", dtype={'student_id': str})
+    return responses, lottery_df, terms_df
+
+
+if __name__ == '__main__':
+    cube = build_demand_cube(*read_inputs())
+    with open(CUBE_PATH, 'wb') as f:
+        f.write(cube.to_bytes())
+    print(f"✅ {CUBE_PATH} を生成しました（{cube.counts.shape}）")
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+オフライン検証用の Google Sheets API もどき（values の読み取りだけ）。
+
+  GET  /v4/spreadsheets/{id}/values/{range}             values.get
+  GET  /v4/spreadsheets/{id}/values:batchGet?ranges=... values.batchGet
+  POST /_fake/append   {"rows": [[...], ...]}            行を末尾に追加（回答の到着を模擬）
+  POST /_fake/update   {"row": n, "values": [...]}       シート行番号 n を書き換え（回答の編集）
+  GET  /_fake/stats                                      リクエスト数・返したセル数
+
+本物の API と同様に、各行の末尾の空セルと範囲末尾の空行は返さない。
+googleapiclient からは client_options={"api_endpoint": URL} で、
+sheets_ingest.http_fetcher からは URL をそのまま渡して使える。
+"""
+import re
+import json
+import time
+import argparse
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pandas as pd
+
+
+def col_index(letters: str) -> int:
+    """列記号 → 0 始まりの列番号（A → 0, AZ → 51）"""
+    n = 0
+    for ch in letters:
+        n = n * 26 + ord(ch) - ord('A') + 1
+    return n - 1
+
+
+class FakeSheet:
+    """シート 1 枚分の値（ヘッダー行を含む行のリスト）"""
+
+    def __init__(self, values=None, title="フォームの回答"):
+        self.values = [list(r) for r in values or []]
+        self.title = title
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.cells = 0
+
+    @classmethod
+    def from_csv(cls, path: str, **kwargs) -> 'FakeSheet':
+        df = pd.read_csv(path, dtype=str, keep_default_na=False)
+        return cls([list(df.columns)] + df.values.tolist(), **kwargs)
+
+    def get(self, range_name: str) -> dict:
+        sheet, _, cells = range_name.rpartition('!')
+        m = re.fullmatch(r"([A-Z]+)(\d*)(?::([A-Z]+)(\d*))?", cells)
+        if not m:
+            raise ValueError(f"Unable to parse range: {range_name}")
+        c0, r0 = col_index(m.group(1)), int(m.group(2) or 1)
+        c1 = col_index(m.group(3) or m.group(1))
+        with self.lock:
+            self.requests += 1
+            r1 = int(m.group(4)) if m.group(4) else len(self.values)
+            rows = []
+            for row in self.values[r0 - 1:r1]:
+                cut = row[c0:c1 + 1]
+                while cut and cut[-1] == "":
+                    cut.pop()
+                rows.append(cut)
+            while rows and not rows[-1]:
+                rows.pop()
+            self.cells += sum(len(r) for r in rows)
+        body = {"range": range_name, "majorDimension": "ROWS"}
+        if rows:
+            body["values"] = rows
+        return body
+
+    def append(self, rows):
+        with self.lock:
+            self.values.extend(list(r) for r in rows)
+
+    def update(self, row: int, values):
+        with self.lock:
+            self.values[row - 1] = list(values)
+
+
+def make_handler(sheet: FakeSheet, latency: float = 0.0):
+    """latency 秒だけ各応答を遅らせる（本物の API の往復時間を模擬）"""
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, status, body):
+            if latency:
+                time.sleep(latency)
+            data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=UTF-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            url = urllib.parse.urlsplit(self.path)
+            path = urllib.parse.unquote(url.path)
+            try:
+                if path == "/_fake/stats":
+                    return self._send(200, {"requests": sheet.requests, "cells": sheet.cells,
+                                            "rows": len(sheet.values)})
+                m = re.fullmatch(r"/v4/spreadsheets/[^/]+/values(?::batchGet|/(.+))", path)
+                if not m:
+                    return self._send(404, {"error": {"code": 404, "message": "Not found"}})
+                if m.group(1):
+                    return self._send(200, sheet.get(m.group(1)))
+                ranges = urllib.parse.parse_qs(url.query).get("ranges", [])
+                return self._send(200, {"valueRanges": [sheet.get(r) for r in ranges]})
+            except ValueError as e:
+                self._send(400, {"error": {"code": 400, "message": str(e)}})
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            if self.path == "/_fake/append":
+                sheet.append(body["rows"])
+            elif self.path == "/_fake/update":
+                sheet.update(body["row"], body["values"])
+            else:
+                return self._send(404, {"error": {"code": 404, "message": "Not found"}})
+            self._send(200, {"rows": len(sheet.values)})
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def serve(sheet: FakeSheet, host="127.0.0.1", port=0, latency: float = 0.0):
+    """バックグラウンドスレッドでサーバーを起動し (server, URL) を返す。止めるときは server.shutdown()"""
+    server = ThreadingHTTPServer((host, port), make_handler(sheet, latency))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve a CSV as a fake Google Sheets values API")
+    parser.add_argument('--csv', default="form_responses_final.csv",
+                        help='Sheet contents, first line is the header (default: form_responses_final.csv)')
+    parser.add_argument('--port', type=int, default=8765, help='Port (default: 8765)')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds added to every response to mimic network round trips (default: 0)')
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", args.port),
+                                 make_handler(FakeSheet.from_csv(args.csv), args.latency))
+    print(f"🧪 fake Sheets API: http://127.0.0.1:{args.port}  (SHEETS_ENDPOINT に指定)")
+    server.serve_forever()
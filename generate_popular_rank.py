@@ -1,69 +1,138 @@
 #!/usr/bin/env python3
+"""
+部門×タームごとの「抽選順位推定ライン」（最後に配属された学生の抽選順位）の分布を推定する。
+
+モンテカルロの各反復で未回答者の希望を補完して配属し、(科, ターム) ごとに配属された学生の
+最大の抽選順位をその反復のラインとして mc_stats.QuantileSketch に足し込む。
+反復ごとの配属結果は保持しないので、メモリは反復回数によらず一定。
+出力はラインの中央値と分位点の帯（10〜90%）。
+"""
+import argparse
+
 import pandas as pd
 import numpy as np
 
-def weighted_quantile(values: np.ndarray, weights: np.ndarray, q: float) -> float:
+import alloc_kernels
+from allocation_engine import encode_cohort, impute_prefs_batch, simulate_batch
+from parallel_mc import run_tasks, spawn_seeds, worker_cohort
+from mc_stats import QuantileSketch
+from artifacts import publish
+
+BANDS = [0.1, 0.25, 0.75, 0.9]  # 中央値の前後に出す分位点
+COMPRESSION = 100.0
+
+
+def read_inputs(read_csv=pd.read_csv):
+    responses  = read_csv("responses.csv", dtype={'student_id': str})
+    terms_df   = read_csv("student_terms.csv", dtype={'student_id': str})
+    lottery_df = read_csv("lottery_order.csv", dtype={'student_id': str, 'lottery_order': int})
+    cap_df     = read_csv("department_capacity.csv")
+    return responses, terms_df, lottery_df, cap_df
+
+
+def answered_ratio(responses: pd.DataFrame, terms_df: pd.DataFrame) -> float:
+    return len(set(responses['student_id'])) / len(terms_df)
+
+
+def n_groups(cohort) -> tuple:
+    """(科 × ターム) のグループ数と、グループ番号 = 科 ID × n_terms + ターム の n_terms"""
+    n_terms = int(cohort.slot_terms.max(initial=0)) + 1
+    return len(cohort.dept_names) * n_terms, n_terms
+
+
+def cutoffs(cohort, dept: np.ndarray) -> tuple:
     """
-    重み付き分位数を計算します。
-    values: 値の配列
-    weights: 各値の重みの配列（同じ長さの配列）
-    q: 0〜1 の分位点（例：0.3 なら30%点、0.5なら中央値）
+    simulate_batch の dept（R × 学生 × スロット）から、反復ごと・(科, ターム) ごとの
+    最後に配属された学生の抽選順位を求める。戻り値は配属のあった (グループ番号, 抽選順位) の組
     """
-    idx = np.argsort(values)
-    sorted_vals = values[idx]
-    sorted_w    = weights[idx]
-    cum_w = np.cumsum(sorted_w)
-    cum_w /= cum_w[-1]
-    return float(sorted_vals[cum_w >= q][0])
+    n_reps = dept.shape[0]
+    size, n_terms = n_groups(cohort)
+    last = np.full((n_reps, size), -1, dtype=np.int64)  # -1 は配属なし（抽選順位 0 もありうる）
+    for k in range(dept.shape[2]):
+        rep, student = np.nonzero(dept[:, :, k] >= 0)
+        group = dept[rep, student, k] * n_terms + cohort.slot_terms[student, k]
+        np.maximum.at(last, (rep, group), cohort.lottery[student])
+    rep, group = np.nonzero(last >= 0)
+    return group, last[rep, group]
+
+
+def _cutoff_chunk(task):
+    """1 チャンク分（n_reps 反復）を実行し、ラインを足し込んだスケッチを返す（ワーカーから呼ばれる）"""
+    n_reps, seed_seq, compression = task
+    cohort = worker_cohort()
+    rng = np.random.default_rng(seed_seq)
+    dept, _ = simulate_batch(cohort, impute_prefs_batch(cohort, n_reps, rng))
+    sketch = QuantileSketch(n_groups(cohort)[0], compression)
+    sketch.add(*cutoffs(cohort, dept))
+    return sketch
+
+
+def popular_rank_by_term(responses: pd.DataFrame,
+                         terms_df: pd.DataFrame,
+                         lottery_df: pd.DataFrame,
+                         cap_df: pd.DataFrame,
+                         N: int = 1000, batch_size: int = 500, seed=None, workers: int = 1,
+                         compression: float = COMPRESSION) -> pd.DataFrame:
+    """
+    N 回のモンテカルロで (科, ターム) ごとのライン分布をスケッチに集め、中央値を
+    「抽選順位推定ライン」、BANDS の分位点を帯として返す。試行回数はそのグループに
+    配属があった反復の数。チャンクごとのスケッチはマージするだけなので、workers に依存しない。
+    """
+    cohort = encode_cohort(responses, lottery_df, cap_df, terms_df)
+    size, n_terms = n_groups(cohort)
+    sizes = [min(batch_size, N - start) for start in range(0, N, batch_size)]
+    tasks = [(s, seq, compression) for s, seq in zip(sizes, spawn_seeds(seed, len(sizes)))]
+    sketch = QuantileSketch(size, compression)
+    for part in run_tasks(cohort, _cutoff_chunk, tasks, workers):
+        sketch.merge(part)
+
+    n = sketch.count()
+    groups = np.flatnonzero(n > 0)
+    qs = sketch.quantile([0.5] + BANDS)[groups]
+    out = pd.DataFrame({
+        'assigned_department': np.array(cohort.dept_names, dtype=object)[groups // n_terms],
+        'term': groups % n_terms,
+        '抽選順位推定ライン': qs[:, 0],
+    })
+    for j, q in enumerate(BANDS, start=1):
+        out[f'抽選順位_p{int(q * 100)}'] = qs[:, j]
+    out = out.round({c: 1 for c in out.columns if c.startswith('抽選順位')})
+    out['試行回数'] = n[groups].round().astype(int)
+    return out.sort_values(['assigned_department', 'term'], ignore_index=True)
 
 
 def main():
+    parser = argparse.ArgumentParser(
+        description="Monte Carlo distribution of the last admitted lottery order per department and term"
+    )
+    parser.add_argument('--iterations', type=int, default=1000,
+                        help='Number of Monte Carlo simulations (default: %(default)s)')
+    parser.add_argument('--batch-size', type=int, default=500,
+                        help='Replications simulated at once (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=None, help='Master random seed (default: random)')
+    parser.add_argument('--workers', type=int, default=1, help='Worker processes (default: %(default)s)')
+    parser.add_argument('--compression', type=float, default=COMPRESSION,
+                        help='t-digest compression; centroids per group stay below about half of it '
+                             '(default: %(default)s)')
+    parser.add_argument('--engine', choices=alloc_kernels.ENGINES, default='numpy',
+                        help='Allocation kernel: numpy (default), numba (JIT-compiled; falls back to numpy '
+                             'when numba is not installed) or python (the uncompiled kernel, for '
+                             'cross-checking); results are identical')
+    args = parser.parse_args()
+    alloc_kernels.select(args.engine)
+
     # --- データ読み込み ---
-    # 回答率計算用
-    responses = pd.read_csv("responses.csv", dtype={'student_id': str})
-    terms_df  = pd.read_csv("student_terms.csv", dtype={'student_id': str})
-    answered_ids = set(responses['student_id'])
-    r = len(answered_ids) / len(terms_df)
-
-    # 割当結果＋抽選順序
-    assign_df  = pd.read_csv("assignment_with_unanswered.csv", dtype={'student_id': str, 'term': int, 'assigned_department': str})
-    lottery_df = pd.read_csv("lottery_order.csv",                 dtype={'student_id': str, 'lottery_order': int})
-    assign_df['lottery_order'] = assign_df['student_id'].map(lottery_df.set_index('student_id')['lottery_order'])
-    assign_df['is_imputed'] = ~assign_df['student_id'].isin(answered_ids)
-
-    # capacity lookup: (department, term) -> slots
-    cap_df = pd.read_csv("department_capacity.csv")
-    capacity = {}
-    for _, row in cap_df.iterrows():
-        dept = row['hospital_department']
-        for col in cap_df.columns:
-            if col.startswith('term_'):
-                term = int(col.split('_')[1])
-                slots = int(row[col] if not pd.isna(row[col]) else 0)
-                capacity[(dept, term)] = slots
-
-    records = []
-    # 部門×タームで分位数計算
-    grouped = assign_df.groupby(['assigned_department', 'term'], as_index=False)
-    for (dept, term), group in grouped:
-        vals = group['lottery_order'].astype(int).to_numpy()
-        weights = np.where(group['is_imputed'], r, 1.0)
-        applicants = len(group)
-        slots = capacity.get((dept, term), 0)
-        # 分位点を定員/応募者数に合わせて動的に決定 (0〜1 に制限)
-        q_dept = min(max(slots / applicants if applicants > 0 else 0, 0), 1)
-        cutoff = weighted_quantile(vals, weights, q_dept)
-        records.append({
-            'assigned_department': dept,
-            'term': term,
-            '抽選順位推定ライン': cutoff,
-            '分位点': q_dept
-        })
+    responses, terms_df, lottery_df, cap_df = read_inputs()
+    r = answered_ratio(responses, terms_df)
 
     # 結果保存
-    pop_term_rank = pd.DataFrame(records)
-    pop_term_rank.to_csv("popular_departments_rank_by_term.csv", index=False)
-    print(f"Generated popular_departments_rank_by_term.csv with dynamic quantiles and term breakdown (r={r:.2f})")
+    pop_term_rank = popular_rank_by_term(responses, terms_df, lottery_df, cap_df,
+                                         N=args.iterations, batch_size=max(args.batch_size, 1),
+                                         seed=args.seed, workers=args.workers,
+                                         compression=args.compression)
+    publish(pop_term_rank, "popular_departments_rank_by_term.csv")
+    print(f"Generated popular_departments_rank_by_term.csv from {args.iterations} simulations "
+          f"(median and {', '.join(f'p{int(q * 100)}' for q in BANDS)}, r={r:.2f})")
 
 if __name__ == '__main__':
     main()
@@ -1,95 +1,308 @@
 #!/usr/bin/env python3
 import pandas as pd
+import numpy as np
 import argparse
 from collections import defaultdict
-from simulate_with_unanswered import run_simulation  # 関数化済みと仮定
+import alloc_kernels
+from allocation_engine import (
+    encode_cohort,
+    impute_prefs,
+    simulate_once,
+    slot_prefix,
+    impute_prefs_batch,
+    simulate_batch,
+    first_matched_hope,
+)
+from parallel_mc import run_tasks, spawn_seeds, worker_cohort
+from artifacts import publish
+from mc_stats import (
+    wilson_interval,
+    interval_width,
+    group_ids,
+    ratio_standard_error,
+    binomial_standard_error,
+)
 
-def main():
-    parser = argparse.ArgumentParser(
-        description="Monte Carlo simulation for assignment probabilities"
-    )
-    parser.add_argument(
-        '--iterations',
-        type=int,
-        default=100,
-        help='Number of Monte Carlo simulations (default: 100)'
-    )
-    args = parser.parse_args()
-    N = args.iterations
+K = 2.0  # スムージングパラメータ
+ROUND_CHUNKS = 8  # 適応モードで 1 ラウンドを分割するチャンク数（ワーカー数に依存させない）
+SE_GROUPS = 4     # 標準誤差の推定用に 1 チャンクを分ける独立グループ数（LHS の層別もグループ単位）
 
-    # --- 一度だけデータ読み込み ---
-    responses   = pd.read_csv("responses.csv", dtype={'student_id': str})
-    lottery     = pd.read_csv("lottery_order.csv", dtype={'student_id': str})
-    capacity_df = pd.read_csv("department_capacity.csv")
-    terms_df    = pd.read_csv("student_terms.csv", dtype={'student_id': str})
+def _probability_chunk(task):
+    """
+    1 チャンク分（n_reps レプリケーション）を実行し、グループ × 回答者 × 希望位置の
+    「最初に配属された希望」カウントを返す。プロセスプールのワーカーから呼ばれる。
+    """
+    n_reps, seed_seq, sampling, rows = task
+    cohort = worker_cohort()
+    rng = np.random.default_rng(seed_seq)
+    real_rows = rows if rows is not None else np.flatnonzero(~cohort.is_imputed)
+    groups = min(SE_GROUPS, n_reps)
+    prefs = impute_prefs_batch(cohort, n_reps, rng, sampling, groups)
+    dept, _ = simulate_batch(cohort, prefs)
+    first = first_matched_hope(cohort.base_prefs[real_rows], dept[:, real_rows])
+    cols = np.broadcast_to(np.arange(len(real_rows)), first.shape)
+    grp = np.broadcast_to(group_ids(n_reps, groups)[:, None], first.shape)
+    hit = first >= 0
+    flat = (grp[hit] * len(real_rows) + cols[hit]) * cohort.max_hopes + first[hit]
+    hits = np.bincount(flat, minlength=groups * len(real_rows) * cohort.max_hopes) \
+             .reshape(groups, len(real_rows), cohort.max_hopes)
+    return hits, np.bincount(group_ids(n_reps, groups), minlength=groups)
+
+def _collect(hope_idx, real_sids, hits, n, counts, total_weights, std_errors):
+    """
+    グループごとの集計（hits: グループ × 学生 × 希望位置, n: グループ × 学生）を
+    counts / total_weights / std_errors（% ポイント）に書き込む
+    """
+    se = ratio_standard_error(hits, n[:, :, None]) * 100.0
+    total_hits, total_n = hits.sum(axis=0), n.sum(axis=0)
+    for col, sid in enumerate(real_sids):
+        total_weights[sid] += float(total_n[col])
+        for j in np.flatnonzero(total_hits[col]):
+            counts[sid][int(hope_idx[j])] += float(total_hits[col, j])
+        for j, idx in enumerate(hope_idx):
+            std_errors[sid][int(idx)] = float(se[col, j])
+
+def run_batched(N, batch_size, seed, workers, responses, lottery, capacity_df, terms_df,
+                hope_cols, counts, total_weights, std_errors, sampling='iid'):
+    """
+    N 回のシミュレーションを batch_size レプリケーションずつのチャンクに分けて実行し、
+    counts / total_weights / std_errors に集計する（回答者のみ、重み 1.0）。
+    チャンクごとに独立した乱数ストリームを割り当てるので、結果は workers に依存しない。
+    """
+    cohort = encode_cohort(responses, lottery, capacity_df, terms_df)
+    # 希望位置 j (0 始まり) → 出力列番号 idx（hope_cols の並び順）
+    hope_idx = np.array([hope_cols.index(f'hope_{j}') + 1
+                         for j in range(1, cohort.max_hopes + 1)])
+    real_sids = cohort.student_ids[~cohort.is_imputed]
+
+    sizes = [min(batch_size, N - start) for start in range(0, N, batch_size)]
+    tasks = [(size, seq, sampling, None) for size, seq in zip(sizes, spawn_seeds(seed, len(sizes)))]
+    partials = run_tasks(cohort, _probability_chunk, tasks, workers)
+
+    # 部分集計（チャンク内のグループ単位）をマージ
+    if partials:
+        hits = np.concatenate([h for h, _ in partials])
+        n = np.concatenate([g for _, g in partials])[:, None].repeat(len(real_sids), axis=1)
+    else:
+        hits = np.zeros((0, len(real_sids), cohort.max_hopes), dtype=int)
+        n = np.zeros((0, len(real_sids)), dtype=int)
+    _collect(hope_idx, real_sids, hits, n, counts, total_weights, std_errors)
+
+def run_sequential(N, responses, lottery, capacity_df, terms_df, hope_cols,
+                   counts, total_weights, std_errors):
+    """
+    run_simulation と同じ 1 回ずつの逐次シミュレーション（numpy のグローバル乱数）を N 回行い、
+    結果を (グループ × 回答者 × 希望位置) の配列に直接積算する。
+    反復ごとの DataFrame は作らず、メモリは反復回数によらず一定。
+    """
+    cohort = encode_cohort(responses, lottery, capacity_df, terms_df)
+    hope_idx = np.array([hope_cols.index(f'hope_{j}') + 1
+                         for j in range(1, cohort.max_hopes + 1)])
+    real_rows = np.flatnonzero(~cohort.is_imputed)
+    real_sids = cohort.student_ids[real_rows]
+    real_prefs = cohort.base_prefs[real_rows]
+
+    groups = max(min(SE_GROUPS, N), 1)
+    hits = np.zeros((groups, len(real_rows), cohort.max_hopes), dtype=np.int64)
+    n = np.zeros((groups, len(real_rows)), dtype=np.int64)
+    cols = np.arange(len(real_rows))
+    prefix = slot_prefix(cohort)  # 決定的な先頭部分は一度だけ配属する
+    for g in group_ids(N, groups):
+        prefs = impute_prefs(cohort)
+        _, dept, _ = simulate_once(cohort, prefs, prefix)
+        first = first_matched_hope(real_prefs, dept[None, real_rows])[0]
+        hit = first >= 0
+        np.add.at(hits[g], (cols[hit], first[hit]), 1)
+        n[g] += 1
+    _collect(hope_idx, real_sids, hits, n, counts, total_weights, std_errors)
+
+def run_adaptive(target_width, max_iterations, batch_size, seed, workers,
+                 responses, lottery, capacity_df, terms_df, hope_cols, counts, total_weights,
+                 std_errors, sampling='iid'):
+    """
+    batch_size 回ずつのラウンドを繰り返し、各回答者の全希望の 95% Wilson 区間の幅が
+    target_width（%ポイント）未満になった学生から集計を打ち切る。
+    全員が収束するか max_iterations 回に達したら終了する。
+    配属は全員の希望に依存するので毎ラウンド全員を配属するが、集計は未収束の学生だけ行う。
+    """
+    cohort = encode_cohort(responses, lottery, capacity_df, terms_df)
+    hope_idx = np.array([hope_cols.index(f'hope_{j}') + 1
+                         for j in range(1, cohort.max_hopes + 1)])
+    real_rows = np.flatnonzero(~cohort.is_imputed)
+    real_sids = cohort.student_ids[real_rows]
+    valid = cohort.base_prefs[real_rows] >= 0
+
+    hits = np.zeros((len(real_rows), cohort.max_hopes), dtype=np.int64)
+    n = np.zeros(len(real_rows), dtype=np.int64)
+    group_hits, group_n = [], []  # 標準誤差用のグループ単位の集計
+    active = np.ones(len(real_rows), dtype=bool)
+    n_rounds = -(-max_iterations // batch_size)
+    chunk = -(-batch_size // ROUND_CHUNKS)
+    seeds = spawn_seeds(seed, n_rounds * ROUND_CHUNKS)
+
+    for r in range(n_rounds):
+        size = min(batch_size, max_iterations - r * batch_size)
+        sizes = [min(chunk, size - start) for start in range(0, size, chunk)]
+        rows = real_rows[active]
+        tasks = [(s, seeds[r * ROUND_CHUNKS + c], sampling, rows) for c, s in enumerate(sizes)]
+        for chunk_hits, chunk_n in run_tasks(cohort, _probability_chunk, tasks, workers):
+            for gh, gn in zip(chunk_hits, chunk_n):
+                group_hits.append(np.zeros_like(hits))
+                group_hits[-1][active] = gh
+                group_n.append(np.where(active, gn, 0))
+                hits += group_hits[-1]
+                n += group_n[-1]
+
+        width = interval_width(hits, n[:, None]) * 100.0
+        active &= (np.where(valid, width, 0.0) >= target_width).any(axis=1)
+        print(f"  round {r + 1}: {size} 回, 未収束 {active.sum()}/{len(active)} 人")
+        if not active.any():
+            break
+
+    _collect(hope_idx, real_sids, np.array(group_hits), np.array(group_n),
+             counts, total_weights, std_errors)
+
+def read_inputs(read_csv=pd.read_csv):
+    responses   = read_csv("responses.csv", dtype={'student_id': str})
+    lottery     = read_csv("lottery_order.csv", dtype={'student_id': str})
+    capacity_df = read_csv("department_capacity.csv")
+    terms_df    = read_csv("student_terms.csv", dtype={'student_id': str})
     # 追加：昨年配属結果を読み込む（将来利用）
-    hist_df     = pd.read_csv("2024配属結果.csv", dtype={'student_id': str})
+    hist_df     = read_csv("2024配属結果.csv", dtype={'student_id': str})
+    return responses, lottery, capacity_df, terms_df, hist_df
 
+def generate_probability(responses, lottery, capacity_df, terms_df, hist_df=None,
+                         N=100, batch_size=500, seed=None, workers=1,
+                         target_width=None, sampling='iid') -> pd.DataFrame:
+    """
+    回答者ごとの希望別通過確率（%）を N 回のモンテカルロで推定する。
+    target_width（%ポイント）を指定すると、N を上限に区間幅がそれ未満になるまでの適応打ち切りで回す。
+    sampling='lhs' なら未回答者の希望補完をラテン超方格で層別する。
+    各確率に 95% Wilson 区間（下限・上限）、独立グループ間のばらつきから推定した標準誤差、試行回数を添える。
+    """
     student_ids = responses['student_id'].tolist()
     hope_cols   = [c for c in responses.columns if c.startswith('hope_')]
 
     # 重みとカウント用の辞書
     counts        = {sid: defaultdict(float) for sid in student_ids}
     total_weights = {sid: 0.0 for sid in student_ids}
+    std_errors    = {sid: {} for sid in student_ids}
 
-    # 回答済/未回答者の判別
-    answered       = set(responses['student_id'])
-    answered_ratio = len(answered) / len(terms_df)
-
-    # モンテカルロシミュレーション
-    for _ in range(N):
-        assign_df = run_simulation(
-            responses,
-            lottery,
-            capacity_df,
-            terms_df,
-            hist_df  # 追加引数
-        )
-        # 各行に is_imputed フラグをセット
-        assign_df['is_imputed'] = ~assign_df['student_id'].isin(answered)
-
-        for sid in student_ids:
-            # 当該学生の全ターム配属結果
-            rows = assign_df[assign_df['student_id'] == sid]
-            if rows.empty:
-                continue
-            # 重み: 回答済は1.0、未回答は回答率
-            w = 1.0 if sid in answered else answered_ratio
-            total_weights[sid] += w
-
-            # 全タームで配属された科の集合（未配属は除外）
-            assigned_depts = set(rows['assigned_department']) - {None, '未配属'}
-
-            # 各希望順位ごとに、最初にマッチした科だけをカウント
-            for idx, col in enumerate(hope_cols, start=1):
-                val = responses.loc[responses['student_id'] == sid, col].iloc[0]
-                if pd.isna(val):
-                    continue
-                if val in assigned_depts:
-                    counts[sid][idx] += w
-                    # 最初にマッチした希望のみカウント
-                    break
+    # モンテカルロシミュレーション（集計対象は回答者のみなので重みは常に 1.0）
+    if target_width is not None:
+        run_adaptive(target_width, N, max(batch_size, 1), seed, workers,
+                     responses, lottery, capacity_df, terms_df,
+                     hope_cols, counts, total_weights, std_errors, sampling)
+    elif batch_size > 0:
+        run_batched(N, batch_size, seed, workers,
+                    responses, lottery, capacity_df, terms_df,
+                    hope_cols, counts, total_weights, std_errors, sampling)
+    else:
+        run_sequential(N, responses, lottery, capacity_df, terms_df,
+                       hope_cols, counts, total_weights, std_errors)
 
     # スムージング (ベイズ補正) を入れて確率化
-    K = 2.0  # スムージングパラメータ
     output_rows = []
     for sid in student_ids:
         tw = total_weights[sid] or 1.0
         base = {'student_id': sid}
+        nums = np.array([counts[sid][idx] for idx in range(1, len(hope_cols) + 1)])
+        lo, hi = wilson_interval(nums, total_weights[sid])
         for idx in range(1, len(hope_cols) + 1):
             num = counts[sid][idx]
             # (成功シミュレーション回数 + 1) / (重み合計 + K) * 100%
             p = (num + 1.0) / (tw + K) * 100.0
             base[f'hope_{idx}_確率'] = p
+        for idx in range(1, len(hope_cols) + 1):
+            base[f'hope_{idx}_下限'] = lo[idx - 1] * 100.0
+            base[f'hope_{idx}_上限'] = hi[idx - 1] * 100.0
+        for idx in range(1, len(hope_cols) + 1):
+            base[f'hope_{idx}_標準誤差'] = std_errors[sid].get(idx, np.nan)
+        base['試行回数'] = int(round(total_weights[sid]))
         output_rows.append(base)
 
-    df_prob = pd.DataFrame(output_rows)
-    df_prob.to_csv(
-        "probability_montecarlo_combined.csv", index=False
+    return pd.DataFrame(output_rows)
+
+def report_variance(df: pd.DataFrame) -> str:
+    """
+    推定の標準誤差の平均と、同じ試行回数の独立試行（二項分布）での標準誤差との比較。
+    分散比 < 1 なら分散低減が効いており、同じ精度に必要な試行回数はおよそその比倍で済む。
+    """
+    hope_idx = [c[len('hope_'):-len('_標準誤差')] for c in df.columns if c.endswith('_標準誤差')]
+    se = df[[f'hope_{i}_標準誤差' for i in hope_idx]].to_numpy(dtype=float)
+    n = df['試行回数'].to_numpy(dtype=float)[:, None]
+    # スムージング (num + 1) / (n + K) を戻して成功回数にする
+    num = df[[f'hope_{i}_確率' for i in hope_idx]].to_numpy(dtype=float) / 100.0 * (n + K) - 1.0
+    ref = binomial_standard_error(np.clip(np.round(num), 0, None), n) * 100.0
+    ok = np.isfinite(se) & np.isfinite(ref) & (ref > 0)
+    if not ok.any():
+        return "標準誤差: 推定できません（独立グループが 2 つ未満）"
+    ratio = (se[ok] ** 2).mean() / (ref[ok] ** 2).mean()
+    return (f"平均標準誤差 {se[ok].mean():.2f} pt（独立試行なら {ref[ok].mean():.2f} pt, "
+            f"分散比 {ratio:.2f}）")
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Monte Carlo simulation for assignment probabilities"
+    )
+    parser.add_argument(
+        '--iterations',
+        type=int,
+        default=100,
+        help='Number of Monte Carlo simulations (default: 100)'
+    )
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=500,
+        help='Replications simulated at once on stacked arrays; 0 runs run_simulation per iteration (default: 500)'
+    )
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=None,
+        help='Master random seed for the batched mode (default: random)'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help='Worker processes for the batched mode (default: 1)'
+    )
+    parser.add_argument(
+        '--target-width',
+        type=float,
+        default=None,
+        help='Adaptive mode: stop tracking a student once every 95%% interval is narrower than this '
+             '(percentage points); --iterations becomes the upper limit (default: off)'
+    )
+    parser.add_argument(
+        '--sampling',
+        choices=['iid', 'lhs'],
+        default='iid',
+        help='Imputation sampling for the batched mode: independent draws or Latin hypercube '
+             'stratified across replications (default: iid)'
+    )
+    parser.add_argument(
+        '--engine',
+        choices=alloc_kernels.ENGINES,
+        default='numpy',
+        help='Allocation kernel: numpy (default), numba (JIT-compiled; falls back to numpy when numba '
+             'is not installed) or python (the uncompiled kernel, for cross-checking); results are identical'
     )
+    args = parser.parse_args()
+    N = args.iterations
+    alloc_kernels.select(args.engine)
+
+    # --- 一度だけデータ読み込み ---
+    df_prob = generate_probability(*read_inputs(), N=N, batch_size=args.batch_size,
+                                   seed=args.seed, workers=args.workers,
+                                   target_width=args.target_width, sampling=args.sampling)
+    publish(df_prob, "probability_montecarlo_combined.csv")
     print(
         f"Generated probability_montecarlo_combined.csv with {N} simulations and Bayesian smoothing (K={K})"
     )
+    print(report_variance(df_prob))
 
 if __name__ == '__main__':
     main()
@@ -1,102 +1,83 @@
-import re, pandas as pd
-
-def parse_term_list(raw, default_terms):
-    """
-    raw: e.g. "[9, 10]" や "2;5", "", NaN
-    default_terms: [2,5,9,10] のような基本４ターム
-    戻り値: 指定タームのリスト（昇順）、指定なし or 不正入力時は None
-    """
-    if pd.isna(raw) or not str(raw).strip():
-        return None
-    # 数字をすべて抽出
-    nums = [int(n) for n in re.findall(r"\d+", str(raw))]
-    # default_terms のサブセットだけ残す
-    valid = [n for n in nums if n in default_terms]
-    return sorted(set(valid)) if valid else None
+import pandas as pd
+from artifacts import publish
+from preference_model import load_preferences
 
 # --- CSV 読み込み ---
-responses     = pd.read_csv("responses.csv",          dtype=str)
-student_terms = pd.read_csv("student_terms.csv",      dtype=str)
-capacity_df   = pd.read_csv("department_capacity.csv", dtype=str)
-
-# --- MAX_HOPES 自動検出 ---
-hope_cols = [c for c in responses.columns if c.startswith("hope_") and not c.endswith("_terms")]
-MAX_HOPES = max(int(c.split("_")[1]) for c in hope_cols)
-
-# --- student_terms_map ---
-student_terms_map = {}
-for _, row in student_terms.iterrows():
-    sid   = row["student_id"].strip()
-    terms = []
-    for i in range(1,5):
-        col = f"term_{i}"
-        if col in row and pd.notna(row[col]) and str(row[col]).strip():
-            terms.append(int(row[col]))
-    student_terms_map[sid] = sorted(terms)
-
-# --- capacities ---
-capacities = {}
-for _, row in capacity_df.iterrows():
-    dept = row["hospital_department"]
-    for col, val in row.items():
-        if not col.startswith("term_"):
-            continue
-        term_num = int(col.split("_")[1])
-        capacities.setdefault(dept, {})[term_num] = int(val) if pd.notna(val) and str(val).isdigit() else 0
-
-# --- 配属処理 ---
-assignments = []
-
-for _, row in responses.iterrows():
-    sid = row["student_id"].strip()
-    if sid not in student_terms_map:
-        print(f"Warning: student_id {sid} is missing → skip")
-        continue
-
-    default_terms = student_terms_map[sid]
-    # この学生がすでに割り当てられた科
-    used_depts = set()
-
-    # hope_n_terms をパース
-    hope_terms = {
-        i: parse_term_list(row.get(f"hope_{i}_terms",""), default_terms)
-        for i in range(1, MAX_HOPES+1)
-    }
-
-    # 各タームごとに
-    for term in sorted(default_terms):
-        assigned_dept     = None
-        matched_priority = None
-
-        for i in range(1, MAX_HOPES+1):
-            dept = row.get(f"hope_{i}", "")
-            if pd.isna(dept) or not dept.strip():
-                continue
-
-            # 同じ科は既に割当済みならスキップ
-            if dept in used_depts:
-                continue
-
-            # 指定タームがあればその中のみ、なければ全４ターム
-            term_pref = hope_terms[i]
-            if term_pref is not None and term not in term_pref:
+def read_inputs(read_csv=pd.read_csv):
+    responses     = read_csv("responses.csv",          dtype=str)
+    student_terms = read_csv("student_terms.csv",      dtype=str)
+    capacity_df   = read_csv("department_capacity.csv", dtype=str)
+    return responses, student_terms, capacity_df
+
+def initial_assignment(responses: pd.DataFrame,
+                       student_terms: pd.DataFrame,
+                       capacity_df: pd.DataFrame) -> pd.DataFrame:
+    # --- 希望・ターム（解析済みのモデル） ---
+    model     = load_preferences(responses, student_terms)
+    term_row  = model.term_row
+    MAX_HOPES = model.max_hopes
+
+    # --- capacities ---
+    capacities = {}
+    for _, row in capacity_df.iterrows():
+        dept = row["hospital_department"]
+        for col, val in row.items():
+            if not col.startswith("term_"):
                 continue
+            term_num = int(col.split("_")[1])
+            capacities.setdefault(dept, {})[term_num] = int(val) if pd.notna(val) and str(val).isdigit() else 0
 
-            # 空き枠チェック
-            if capacities.get(dept, {}).get(term, 0) > 0:
-                assigned_dept     = dept
-                matched_priority = i
-                capacities[dept][term] -= 1
-                used_depts.add(dept)  # 一度割当た科は追加
-                break
+    # --- 配属処理 ---
+    assignments = []
 
-        assignments.append({
-            "student_id": sid,
-            "term":       term,
-            "assigned_department": assigned_dept or "未配属",
-            "matched_priority":   matched_priority
-        })
+    for r, sid in enumerate(model.student_ids):
+        if sid not in term_row:
+            print(f"Warning: student_id {sid} is missing → skip")
+            continue
 
-# --- 出力 ---
-pd.DataFrame(assignments).to_csv("initial_assignment_result.csv", index=False)
-print("✅ 配属処理 完了")
+        default_terms = model.default_terms(term_row[sid])
+        # この学生がすでに割り当てられた科
+        used_depts = set()
+
+        # 各タームごとに
+        for term in sorted(default_terms):
+            assigned_dept     = None
+            matched_priority = None
+
+            for i in range(1, MAX_HOPES+1):
+                h = model.hopes[r, i-1]
+                if h < 0:
+                    continue
+                dept = model.names[h]
+
+                # 同じ科は既に割当済みならスキップ
+                if dept in used_depts:
+                    continue
+
+                # 指定タームがあればその中のみ、なければ全４ターム
+                term_pref = model.restrict[r, i-1]
+                if term_pref and not term_pref >> term & 1:
+                    continue
+
+                # 空き枠チェック
+                if capacities.get(dept, {}).get(term, 0) > 0:
+                    assigned_dept     = dept
+                    matched_priority = i
+                    capacities[dept][term] -= 1
+                    used_depts.add(dept)  # 一度割当た科は追加
+                    break
+
+            assignments.append({
+                "student_id": sid,
+                "term":       term,
+                "assigned_department": assigned_dept or "未配属",
+                "matched_priority":   matched_priority
+            })
+
+    return pd.DataFrame(assignments)
+
+
+if __name__ == "__main__":
+    # --- 出力 ---
+    publish(initial_assignment(*read_inputs()), "initial_assignment_result.csv")
+    print("✅ 配属処理 完了")
@@ -0,0 +1,164 @@
+"""
+モンテカルロ推定の統計ユーティリティ（信頼区間・収束判定・分散低減）。
+"""
+import numpy as np
+
+Z_95 = 1.959963984540054
+
+
+def wilson_interval(hits, n, z: float = Z_95):
+    """
+    二項比率 hits / n の Wilson スコア区間 (下限, 上限)。要素ごとに計算し、n = 0 は (0, 1)。
+    0 回・n 回成功でも幅がつぶれないので、少ない試行での打ち切り判定に使える。
+    """
+    hits = np.asarray(hits, dtype=float)
+    n = np.asarray(n, dtype=float)
+    safe = np.maximum(n, 1.0)
+    p = hits / safe
+    z2 = z * z
+    denom = 1.0 + z2 / safe
+    center = (p + z2 / (2 * safe)) / denom
+    half = z * np.sqrt(p * (1 - p) / safe + z2 / (4 * safe * safe)) / denom
+    lo = np.where(n > 0, np.clip(center - half, 0.0, 1.0), 0.0)
+    hi = np.where(n > 0, np.clip(center + half, 0.0, 1.0), 1.0)
+    return lo, hi
+
+
+def interval_width(hits, n, z: float = Z_95):
+    lo, hi = wilson_interval(hits, n, z)
+    return hi - lo
+
+
+# --- 分散低減（層別サンプリング）と分散の推定 ---
+
+def group_ids(n_reps: int, groups: int) -> np.ndarray:
+    """レプリケーション → グループ番号（np.array_split と同じ連続ブロック）"""
+    sizes = [len(b) for b in np.array_split(np.arange(n_reps), max(groups, 1))]
+    return np.repeat(np.arange(len(sizes)), sizes)
+
+
+def stratified_uniforms(rng: np.random.Generator, n_reps: int, shape, groups: int = 1) -> np.ndarray:
+    """
+    (n_reps,) + shape の一様乱数。レプリケーション軸を groups 個の連続ブロックに分け、
+    ブロック内では各成分をラテン超方格で層別する（m 回なら各層 [i/m, (i+1)/m) にちょうど 1 点）。
+    ブロック同士は独立なので、ブロックごとの集計のばらつきから分散を推定できる。
+    """
+    shape = tuple(shape)
+    out = np.empty((n_reps,) + shape)
+    for g in range(max(groups, 1)):
+        block = group_ids(n_reps, groups) == g
+        m = int(block.sum())
+        if not m:
+            continue
+        strata = np.broadcast_to(np.arange(m).reshape((m,) + (1,) * len(shape)), (m,) + shape)
+        out[block] = (rng.permuted(strata, axis=0) + rng.random((m,) + shape)) / m
+    return out
+
+
+def ratio_standard_error(hits, n):
+    """
+    独立なグループごとの成功数 hits と試行数 n（先頭軸がグループ）から、比率 Σhits / Σn の
+    標準誤差をグループ間のばらつき（バッチ平均法）で推定する。二項分布を仮定しないので、
+    層別サンプリングや共通乱数を使った推定にもそのまま使える。有効なグループが 2 つ未満なら NaN。
+    """
+    hits = np.asarray(hits, dtype=float)
+    n = np.broadcast_to(np.asarray(n, dtype=float), hits.shape)
+    total = n.sum(axis=0)
+    c = (n > 0).sum(axis=0)
+    p = hits.sum(axis=0) / np.maximum(total, 1.0)
+    ss = ((hits - p * n) ** 2).sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        var = c / (c - 1) * ss / total ** 2
+    return np.where(c >= 2, np.sqrt(var), np.nan)
+
+
+def binomial_standard_error(hits, n):
+    """独立試行を仮定した比率 hits / n の標準誤差（分散低減の効果を比べる基準）"""
+    hits = np.asarray(hits, dtype=float)
+    n = np.asarray(n, dtype=float)
+    p = hits / np.maximum(n, 1.0)
+    return np.where(n > 0, np.sqrt(p * (1 - p) / np.maximum(n, 1.0)), np.nan)
+
+
+# --- ストリーミング分位点（マージ可能な t-digest） ---
+
+class QuantileSketch:
+    """
+    グループ（科 × タームなど）ごとの分布を、重心 (平均, 重み) の列で近似する t-digest。
+    重心はスケール関数 k(q) = δ/(2π)·asin(2q−1) の幅 1 以内にまとめるので、1 グループの
+    重心数は compression（δ）/2 + 数個で頭打ちになり、メモリは追加した値の数によらず一定。
+    分布の両端ほど重心が細かく残るため、裾の分位点も精度を保つ。
+    全グループの重心を (グループ, 平均) 順の平坦な配列で持ち、追加・マージ・圧縮は
+    グループをまたいで一括で行う。merge できるので、チャンクやワーカーごとの部分結果を合算できる。
+    """
+
+    def __init__(self, n_groups: int, compression: float = 100.0):
+        self.n_groups = int(n_groups)
+        self.compression = float(compression)
+        self.group = np.zeros(0, dtype=np.int64)
+        self.mean = np.zeros(0)
+        self.weight = np.zeros(0)
+        self.min = np.full(self.n_groups, np.inf)
+        self.max = np.full(self.n_groups, -np.inf)
+
+    def add(self, groups, values, weights=None):
+        """groups[i] のグループに values[i] を（重み weights[i]、既定 1 で）追加する"""
+        groups = np.asarray(groups, dtype=np.int64).ravel()
+        values = np.asarray(values, dtype=float).ravel()
+        weights = np.ones(len(values)) if weights is None else np.asarray(weights, dtype=float).ravel()
+        np.minimum.at(self.min, groups, values)
+        np.maximum.at(self.max, groups, values)
+        self._compress(np.concatenate([self.group, groups]),
+                       np.concatenate([self.mean, values]),
+                       np.concatenate([self.weight, weights]))
+
+    def merge(self, other: "QuantileSketch"):
+        """同じグループ数の別スケッチの内容を取り込む"""
+        if other.n_groups != self.n_groups:
+            raise ValueError(f"グループ数が違います: {self.n_groups} != {other.n_groups}")
+        np.minimum(self.min, other.min, out=self.min)
+        np.maximum(self.max, other.max, out=self.max)
+        self._compress(np.concatenate([self.group, other.group]),
+                       np.concatenate([self.mean, other.mean]),
+                       np.concatenate([self.weight, other.weight]))
+
+    def _compress(self, group, mean, weight):
+        if not len(group):
+            return
+        order = np.lexsort((mean, group))
+        group, mean, weight = group[order], mean[order], weight[order]
+        total = np.bincount(group, weight, minlength=self.n_groups)
+        # グループ内の累積重み（各重心の中央）→ 分位 q → k(q) の整数部が同じ重心をまとめる
+        cum = np.r_[0.0, np.cumsum(weight)]
+        starts = np.searchsorted(group, np.arange(self.n_groups))
+        q = (cum[:-1] - cum[starts][group] + weight / 2) / total[group]
+        k = np.floor(self.compression / (2 * np.pi) * (np.arcsin(2 * np.clip(q, 0, 1) - 1) + np.pi / 2))
+        key = group * (int(self.compression) + 2) + k.astype(np.int64)
+        bounds = np.flatnonzero(np.r_[True, key[1:] != key[:-1]])
+        self.group = group[bounds]
+        self.weight = np.add.reduceat(weight, bounds)
+        self.mean = np.add.reduceat(weight * mean, bounds) / self.weight
+
+    def count(self) -> np.ndarray:
+        """グループごとの重み合計（重み 1 なら追加した値の数）"""
+        return np.bincount(self.group, self.weight, minlength=self.n_groups)
+
+    def quantile(self, qs) -> np.ndarray:
+        """(グループ × len(qs)) の分位点。値のないグループは NaN"""
+        qs = np.atleast_1d(np.asarray(qs, dtype=float))
+        out = np.full((self.n_groups, len(qs)), np.nan)
+        bounds = np.searchsorted(self.group, np.arange(self.n_groups + 1))
+        for g in np.flatnonzero(bounds[1:] > bounds[:-1]):
+            w = self.weight[bounds[g]:bounds[g + 1]]
+            m = self.mean[bounds[g]:bounds[g + 1]]
+            total = w.sum()
+            # 重心の中央の累積位置で平均値を線形補間し、両端は最小値・最大値に固定する
+            mid = np.cumsum(w) - w / 2
+            out[g] = np.interp(qs * total, np.r_[0.0, mid, total],
+                               np.r_[self.min[g], m, self.max[g]])
+        return out
+
+    @property
+    def nbytes(self) -> int:
+        return (self.group.nbytes + self.mean.nbytes + self.weight.nbytes
+                + self.min.nbytes + self.max.nbytes)
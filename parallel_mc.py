@@ -0,0 +1,110 @@
+"""
+Monte Carlo のプロセスプール並列実行。
+
+エンコード済みの配列（希望・許可ターム・定員・抽選順など）は共有メモリに一度だけ置き、
+各ワーカーは initializer でアタッチする（タスクごとの pickle は行わない）。
+乱数はマスターシードから SeedSequence.spawn したタスクごとの独立ストリームを使うため、
+結果はワーカー数に依存しない。
+"""
+import zlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import fields
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import alloc_kernels
+from allocation_engine import EncodedCohort
+from perf_trace import COUNTERS, counters_snapshot, merge_counters
+
+# ワーカー内でアタッチ済みの cohort と共有メモリブロック
+_WORKER = {}
+
+
+def spawn_seeds(seed, n_tasks: int) -> list:
+    """マスターシードからタスクごとの独立な SeedSequence を生成する"""
+    return np.random.SeedSequence(seed).spawn(n_tasks)
+
+
+def keyed_seeds(seed, keys) -> list:
+    """
+    キー（student_id など）ごとの SeedSequence を生成する。
+    タスクの並びや分割（シャード・再開）に関係なく、同じキーには同じストリームが割り当たる。
+    """
+    entropy = np.random.SeedSequence(seed).entropy
+    return [np.random.SeedSequence(entropy, spawn_key=(zlib.crc32(str(k).encode()),))
+            for k in keys]
+
+
+def _share_cohort(cohort: EncodedCohort):
+    blocks, meta, plain = [], {}, {}
+    for f in fields(EncodedCohort):
+        value = getattr(cohort, f.name)
+        if not isinstance(value, np.ndarray) or value.dtype == object:
+            plain[f.name] = value
+            continue
+        shm = shared_memory.SharedMemory(create=True, size=max(value.nbytes, 1))
+        np.ndarray(value.shape, dtype=value.dtype, buffer=shm.buf)[...] = value
+        blocks.append(shm)
+        meta[f.name] = (shm.name, value.shape, value.dtype.str)
+    return blocks, meta, plain
+
+
+def _init_worker(meta, plain, engine='numpy'):
+    alloc_kernels.select(engine)  # 親と同じ配属カーネルを使う
+    arrays, blocks = {}, []
+    for name, (shm_name, shape, dtype) in meta.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        arr = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+        arr.flags.writeable = False
+        arrays[name] = arr
+        blocks.append(shm)
+    _WORKER['blocks'] = blocks
+    _WORKER['cohort'] = EncodedCohort(**plain, **arrays)
+
+
+def worker_cohort() -> EncodedCohort:
+    """タスク関数から参照する、このプロセスの読み取り専用 cohort"""
+    return _WORKER['cohort']
+
+
+def _counted(func, task):
+    """ワーカー側: タスクを実行し、その間に増えた perf_trace のカウンタと一緒に返す"""
+    COUNTERS.clear()
+    result = func(task)
+    return result, counters_snapshot()
+
+
+def iter_tasks(cohort: EncodedCohort, func, tasks, workers: int = 1):
+    """
+    tasks の各要素に func を適用し、(タスク番号, 結果) を完了した順に yield する。
+    func はモジュールトップレベルの関数で、worker_cohort() から入力を読む。
+    workers <= 1 ならプロセスを起こさずに同じ関数をその場で実行する。
+    """
+    tasks = list(tasks)
+    if workers <= 1 or len(tasks) <= 1:
+        _WORKER['cohort'] = cohort
+        for idx, task in enumerate(tasks):
+            yield idx, func(task)
+        return
+
+    blocks, meta, plain = _share_cohort(cohort)
+    try:
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=_init_worker,
+                                 initargs=(meta, plain, alloc_kernels.current())) as pool:
+            futures = {pool.submit(_counted, func, task): idx for idx, task in enumerate(tasks)}
+            for fut in as_completed(futures):
+                result, counters = fut.result()
+                merge_counters(counters)
+                yield futures[fut], result
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
+
+def run_tasks(cohort: EncodedCohort, func, tasks, workers: int = 1) -> list:
+    """iter_tasks の結果をタスク順のリストで返す"""
+    results = dict(iter_tasks(cohort, func, tasks, workers))
+    return [results[idx] for idx in sorted(results)]
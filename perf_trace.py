@@ -0,0 +1,172 @@
+"""
+パイプラインの性能計測（ステージごとの実時間・CPU 時間・ピークメモリと、配属ループの作業量カウンタ）。
+
+  trace = Trace("update_all", profile=True)
+  with trace.stage("ingest"):
+      ...
+  trace.write()   # pipeline_traces/<run_id>.json（profile=True なら <run_id>/<stage>.prof も）
+
+カウンタ（count）はプロセス内の辞書に足し込むだけで、ホットループ側では呼び出しごとに
+ローカル変数で集計してから 1 回だけ足す。プロセスプールのワーカー分は parallel_mc が
+タスクの戻り値と一緒に持ち帰って親に合算する。
+"""
+import os
+import sys
+import json
+import time
+import pstats
+import cProfile
+import resource
+import contextlib
+from collections import defaultdict
+
+import alloc_kernels
+
+TRACE_DIR = "pipeline_traces"
+
+COUNTERS = defaultdict(int)
+
+
+def count(name: str, n: int = 1):
+    COUNTERS[name] += int(n)
+
+
+def counters_snapshot() -> dict:
+    return dict(COUNTERS)
+
+
+def merge_counters(delta: dict):
+    for name, n in delta.items():
+        COUNTERS[name] += n
+
+
+def counters_since(before: dict) -> dict:
+    return {k: v - before.get(k, 0) for k, v in COUNTERS.items() if v != before.get(k, 0)}
+
+
+def students_allocated(counters: dict) -> int:
+    """配属ループが処理した延べ学生数（レプリケーション × 学生、カーネルごとの .students の合計）"""
+    return sum(n for name, n in counters.items()
+               if name.startswith("alloc.") and name.endswith(".students"))
+
+
+# --- メモリ ---
+
+def reset_peak_rss() -> bool:
+    """このプロセスのピーク RSS（VmHWM）を現在値に戻す。Linux 以外や権限がなければ False"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb() -> float:
+    """ピーク RSS（MB）。reset_peak_rss 以降の値（リセットできない環境ではプロセス開始以降）"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+def _children_cpu() -> float:
+    ru = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return ru.ru_utime + ru.ru_stime
+
+
+# --- トレース ---
+
+class Trace:
+    """1 回の実行分のステージ計測を集めて JSON に書き出す"""
+
+    def __init__(self, name: str, profile: bool = False, trace_dir: str = TRACE_DIR):
+        self.name = name
+        self.profile = profile
+        self.trace_dir = trace_dir
+        self.run_id = time.strftime("%Y%m%dT%H%M%S")
+        self.started = time.time()
+        self._t0 = time.perf_counter()
+        self.stages = []
+
+    @contextlib.contextmanager
+    def stage(self, name: str, **info):
+        """with の中を 1 ステージとして計測する。yield した dict に項目を足すとトレースに残る"""
+        entry = {"name": name, **info}
+        entry["peak_rss_reset"] = reset_peak_rss()
+        before = counters_snapshot()
+        wall0, cpu0, child0 = time.perf_counter(), time.process_time(), _children_cpu()
+        prof = cProfile.Profile() if self.profile else None
+        if prof:
+            prof.enable()
+        try:
+            yield entry
+            entry.setdefault("status", "ok")
+        except BaseException as e:
+            entry["status"] = f"error: {type(e).__name__}: {e}"
+            raise
+        finally:
+            if prof:
+                prof.disable()
+                entry["profile"] = self._dump_profile(name, prof)
+            entry.update(
+                wall_s=round(time.perf_counter() - wall0, 4),
+                cpu_s=round(time.process_time() - cpu0, 4),
+                child_cpu_s=round(_children_cpu() - child0, 4),
+                peak_rss_mb=round(peak_rss_mb(), 1),
+                counters=counters_since(before),
+            )
+            allocated = students_allocated(entry["counters"])
+            if allocated:
+                entry["students_per_s"] = round(allocated / max(entry["wall_s"], 1e-9))
+            self.stages.append(entry)
+
+    def skip(self, name: str, reason: str):
+        self.stages.append({"name": name, "status": "skipped", "reason": reason})
+
+    def _dump_profile(self, name: str, prof: cProfile.Profile) -> str:
+        """<run_id>/<stage>.prof（pstats 形式。snakeviz / flameprof でフレームグラフにできる）と上位関数の一覧"""
+        out_dir = os.path.join(self.trace_dir, self.run_id)
+        os.makedirs(out_dir, exist_ok=True)
+        path = os.path.join(out_dir, f"{name}.prof")
+        prof.dump_stats(path)
+        with open(os.path.join(out_dir, f"{name}.txt"), "w", encoding="utf-8") as f:
+            pstats.Stats(prof, stream=f).sort_stats("cumulative").print_stats(40)
+        return path
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "run_id": self.run_id,
+            "argv": sys.argv,
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+            "wall_s": round(time.perf_counter() - self._t0, 4),
+            "cpu_count": os.cpu_count(),
+            "engine": alloc_kernels.current(),
+            "stages": self.stages,
+        }
+
+    def write(self) -> str:
+        os.makedirs(self.trace_dir, exist_ok=True)
+        path = os.path.join(self.trace_dir, f"{self.run_id}-{self.name}.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False, indent=2)
+            f.write("\n")
+        return path
+
+    def summary(self) -> str:
+        lines = [f"{'stage':<24}{'wall':>9}{'cpu':>9}{'child':>9}{'peak MB':>9}{'students/s':>12}  status"]
+        for s in self.stages:
+            if s["status"] == "skipped":
+                lines.append(f"{s['name']:<24}{'-':>9}{'-':>9}{'-':>9}{'-':>9}{'-':>12}  skipped")
+                continue
+            rate = f"{s['students_per_s']:>12,}" if "students_per_s" in s else f"{'-':>12}"
+            lines.append(f"{s['name']:<24}{s['wall_s']:>9.2f}{s['cpu_s']:>9.2f}"
+                         f"{s['child_cpu_s']:>9.2f}{s['peak_rss_mb']:>9.0f}{rate}  {s['status']}")
+        lines.append(f"allocation kernel: {alloc_kernels.current()}")
+        return "\n".join(lines)
@@ -0,0 +1,293 @@
+"""
+update_all.py のステージ定義（入力・出力ファイルを宣言した DAG）と増分実行。
+
+各ステージの入力（スクリプト自身と import するモジュールを含む）をコンテンツハッシュで
+指紋化し、前回実行時の指紋（pipeline_manifest.json）と一致して出力も揃っていれば
+そのステージをスキップする。上流の出力内容が変われば下流の入力指紋も変わるので、
+再実行は依存関係に沿って自動的に伝播する。
+
+ステージは同一プロセス内で関数として実行する。入力 CSV は PipelineContext が一度だけ
+読み込み、ステージの出力はメモリ上で下流に渡して、最後にまとめて書き出す。
+artifacts.SCHEMAS に宣言された出力は型付き成果物（.npz）として保存し、CSV は公開用に
+export_csv=True のときだけ書く（CSV が無ければ下流の入力は成果物から復元する）。
+"""
+import io
+import os
+import json
+import hashlib
+from dataclasses import dataclass, field
+
+import pandas as pd
+
+import artifacts
+from perf_trace import Trace
+import initial_assignment
+import generate_probability
+import generate_popular_rank
+import analyze_assignment
+import analyze_department
+import demand_cube
+import capacity_sensitivity
+
+MANIFEST_PATH = "pipeline_manifest.json"
+
+# 希望の解析（preference_model）は配属エンジンと initial_assignment / demand_cube が共有する
+PREFERENCE_MODULES = ["preference_model.py"]
+
+ENGINE_MODULES = ["allocation_engine.py", "alloc_kernels.py", "parallel_mc.py", "mc_stats.py"] + PREFERENCE_MODULES
+
+# 出力を成果物（.npz）として書くステージは形式の定義にも依存する
+ARTIFACT_MODULES = ["artifacts.py"]
+
+
+@dataclass
+class Stage:
+    name:    str
+    script:  str
+    inputs:  list            # データファイル
+    outputs: list
+    run:     object = None   # run(ctx) -> outputs の順の DataFrame（またはバイト列）リスト
+    code:    list = field(default_factory=list)  # script 以外に依存するモジュール
+
+
+STAGES = [
+    Stage("initial_assignment", "initial_assignment.py",
+          inputs=["responses.csv", "student_terms.csv", "department_capacity.csv"],
+          outputs=["initial_assignment_result.csv"],
+          run=lambda ctx: [initial_assignment.initial_assignment(
+              *initial_assignment.read_inputs(ctx.read_csv))],
+          code=PREFERENCE_MODULES + ARTIFACT_MODULES),
+    Stage("generate_probability", "generate_probability.py",
+          inputs=["responses.csv", "lottery_order.csv", "department_capacity.csv",
+                  "student_terms.csv", "2024配属結果.csv"],
+          outputs=["probability_montecarlo_combined.csv"],
+          run=lambda ctx: [generate_probability.generate_probability(
+              *generate_probability.read_inputs(ctx.read_csv))],
+          code=ENGINE_MODULES + ARTIFACT_MODULES),
+    Stage("generate_popular_rank", "generate_popular_rank.py",
+          inputs=["responses.csv", "student_terms.csv", "lottery_order.csv",
+                  "department_capacity.csv"],
+          outputs=["popular_departments_rank_by_term.csv"],
+          run=lambda ctx: [generate_popular_rank.popular_rank_by_term(
+              *generate_popular_rank.read_inputs(ctx.read_csv))],
+          code=ENGINE_MODULES + ARTIFACT_MODULES),
+    Stage("capacity_sensitivity", "capacity_sensitivity.py",
+          inputs=["responses.csv", "student_terms.csv", "lottery_order.csv",
+                  "department_capacity.csv"],
+          outputs=[capacity_sensitivity.OUTPUT],
+          run=lambda ctx: [capacity_sensitivity.capacity_sensitivity(
+              *capacity_sensitivity.read_inputs(ctx.read_csv))],
+          code=ENGINE_MODULES + ARTIFACT_MODULES),
+    Stage("analyze_assignment", "analyze_assignment.py",
+          inputs=["initial_assignment_result.csv"],
+          outputs=["assignment_matrix.csv"],
+          run=lambda ctx: [analyze_assignment.assignment_matrix(
+              analyze_assignment.read_inputs(ctx.read_csv))],
+          code=ARTIFACT_MODULES),
+    Stage("analyze_department", "analyze_department.py",
+          inputs=["initial_assignment_result.csv", "responses.csv", "student_terms.csv"],
+          outputs=["department_summary.csv"],
+          run=lambda ctx: [analyze_department.department_summary(
+              *analyze_department.read_inputs(ctx.read_csv))],
+          code=ARTIFACT_MODULES),
+    Stage("demand_cube", "demand_cube.py",
+          inputs=["responses.csv", "lottery_order.csv", "student_terms.csv"],
+          outputs=[demand_cube.CUBE_PATH],
+          run=lambda ctx: [demand_cube.build_demand_cube(
+              *demand_cube.read_inputs(ctx.read_csv)).to_bytes()],
+          code=PREFERENCE_MODULES),
+]
+
+
+class PipelineContext:
+    """
+    パイプライン 1 回分の入出力。ファイルはバイト列として一度だけ読み、
+    read_csv は読み込み条件ごとに解析結果をキャッシュする。
+    put した出力はメモリ上で後続ステージに渡り、write_outputs で初めてディスクに書かれる。
+    """
+
+    def __init__(self):
+        self._raw = {}
+        self._frames = {}
+        self._artifacts = {}
+        self._written = []
+
+    def raw(self, path: str):
+        if path not in self._raw:
+            if (path in artifacts.SCHEMAS and not artifacts.csv_matches_artifact(path)
+                    and artifacts.has_fresh_artifact(path)):
+                # CSV を書き出していない（または古い）ときだけ成果物から CSV を復元する。
+                # 成果物は conform 済みの表から書くので、復元したバイト列は書き出した CSV と一致する
+                df = artifacts.read_artifact(artifacts.artifact_path(path), mmap=False)
+                self._raw[path] = df.to_csv(index=False).encode('utf-8')
+            elif os.path.exists(path):
+                with open(path, 'rb') as f:
+                    self._raw[path] = f.read()
+            else:
+                return None
+        return self._raw[path]
+
+    def preload(self, paths, pool):
+        """paths を pool（Executor）のスレッドで並行して読み込んでおく。戻り値は Future のリスト"""
+        return [pool.submit(self.raw, path) for path in paths]
+
+    def provide(self, path: str, data: bytes):
+        """呼び出し側がすでに書いた入力ファイルの内容を渡す（ディスクから読み直さない）"""
+        self._raw[path] = data
+        self._frames = {k: v for k, v in self._frames.items() if k[0] != path}
+
+    def hash(self, path: str):
+        data = self.raw(path)
+        return None if data is None else hashlib.sha256(data).hexdigest()
+
+    def exists(self, path: str) -> bool:
+        return path in self._raw or os.path.exists(path)
+
+    def has_output(self, path: str) -> bool:
+        """出力が揃っているか。スキーマ付きの出力は成果物の有無で判断する"""
+        if path in artifacts.SCHEMAS:
+            return (path in self._artifacts
+                    or os.path.exists(artifacts.artifact_path(path)))
+        return self.exists(path)
+
+    def read_csv(self, path: str, **kwargs) -> pd.DataFrame:
+        key = (path, repr(sorted(kwargs.items())))
+        if key not in self._frames:
+            data = self.raw(path)
+            if data is None:
+                raise FileNotFoundError(path)
+            self._frames[key] = pd.read_csv(io.BytesIO(data), **kwargs)
+        return self._frames[key].copy()
+
+    def put(self, path: str, df):
+        """DataFrame は CSV として、bytes はそのまま出力に載せる"""
+        if path in artifacts.SCHEMAS:
+            df = artifacts.conform(df, artifacts.SCHEMAS[path])
+        self._raw[path] = df if isinstance(df, bytes) else df.to_csv(index=False).encode('utf-8')
+        if path in artifacts.SCHEMAS:
+            self._artifacts[path] = artifacts.artifact_bytes(df, artifacts.SCHEMAS[path])
+        self._frames = {k: v for k, v in self._frames.items() if k[0] != path}
+        if path not in self._written:
+            self._written.append(path)
+
+    def write_outputs(self, export_csv: bool = True):
+        for path in self._written:
+            if export_csv or path not in self._artifacts:
+                with open(path, 'wb') as f:
+                    f.write(self._raw[path])
+            if path in self._artifacts:
+                with open(artifacts.artifact_path(path), 'wb') as f:
+                    f.write(self._artifacts[path])
+        self._written = []
+
+
+def source_inputs(stages=STAGES) -> list:
+    """どのステージも出力しない入力ファイル（パイプラインの外から与えられるもの）"""
+    produced = {out for s in stages for out in s.outputs}
+    return list(dict.fromkeys(p for s in stages for p in s.inputs if p not in produced))
+
+
+def file_hash(path: str):
+    """ファイル内容の SHA-256。存在しなければ None"""
+    if not os.path.exists(path):
+        return None
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def fingerprint(stage: Stage, ctx: PipelineContext) -> dict:
+    """ステージのスクリプト・依存モジュール・全入力のハッシュ（入力はメモリ上の最新内容）"""
+    fp = {path: file_hash(path) for path in [stage.script] + stage.code}
+    fp.update({path: ctx.hash(path) for path in stage.inputs})
+    return fp
+
+
+def topo_order(stages) -> list:
+    """出力→入力の依存でトポロジカルソートする（同順位は宣言順）"""
+    producer = {out: s.name for s in stages for out in s.outputs}
+    deps = {s.name: {producer[i] for i in s.inputs if i in producer and producer[i] != s.name}
+            for s in stages}
+    ordered, done = [], set()
+    while len(ordered) < len(stages):
+        ready = [s for s in stages if s.name not in done and deps[s.name] <= done]
+        if not ready:
+            raise RuntimeError("ステージ定義に循環依存があります")
+        ordered.append(ready[0])
+        done.add(ready[0].name)
+    return ordered
+
+
+def load_manifest(path: str = MANIFEST_PATH) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_manifest(manifest: dict, path: str = MANIFEST_PATH):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def is_up_to_date(stage: Stage, fp: dict, manifest: dict, ctx: PipelineContext) -> bool:
+    return manifest.get(stage.name) == fp and all(ctx.has_output(p) for p in stage.outputs)
+
+
+def run_pipeline(stages=STAGES, force=False, manifest_path=MANIFEST_PATH, ctx=None,
+                 export_csv=True, trace=None):
+    """
+    各ステージを依存順に同一プロセスで実行する。入力指紋が前回と同じステージはスキップ。
+    出力とマニフェストは最後（途中で失敗した場合はそれまでに成功した分）だけ書き出す。
+    trace（perf_trace.Trace）を渡すと、各ステージと書き出しの計測をそこに記録する。
+    """
+    ctx = ctx or PipelineContext()
+    trace = trace or Trace("pipeline")
+    manifest = load_manifest(manifest_path)
+    try:
+        for stage in topo_order(stages):
+            fp = fingerprint(stage, ctx)
+            if not force and is_up_to_date(stage, fp, manifest, ctx):
+                print(f"⏭️ {stage.script} は入力に変更がないためスキップ")
+                trace.skip(stage.name, "inputs unchanged")
+                continue
+            print(f"⚙️ {stage.script} を実行中…")
+            with trace.stage(stage.name):
+                for path, df in zip(stage.outputs, stage.run(ctx)):
+                    ctx.put(path, df)
+            manifest[stage.name] = fp
+    finally:
+        with trace.stage("write_outputs", export_csv=export_csv):
+            ctx.write_outputs(export_csv)
+            save_manifest(manifest, manifest_path)
+    return ctx
+
+
+def pending_stages(stages=STAGES, manifest_path=MANIFEST_PATH) -> list:
+    """
+    いまのディスク上のファイルで run_pipeline を呼んだら実行されるステージ名（実行はしない）。
+    実行直後なら空になるはず（空でなければ、出力の読み直しで指紋が変わっている）
+    """
+    ctx = PipelineContext()
+    manifest = load_manifest(manifest_path)
+    return [stage.name for stage in topo_order(stages)
+            if not is_up_to_date(stage, fingerprint(stage, ctx), manifest, ctx)]
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Pipeline stage status")
+    parser.add_argument('--check-noop', action='store_true',
+                        help='Exit with an error if re-running now would run any stage '
+                             '(use right after update_all.py)')
+    args = parser.parse_args()
+    pending = pending_stages()
+    for stage in topo_order(STAGES):
+        print(f"{'⚙️ 要実行' if stage.name in pending else '✅ 最新'}: {stage.name}")
+    if args.check_noop and pending:
+        raise SystemExit(f"❌ 直前の実行のあとでも {len(pending)} ステージが再実行されます: "
+                         + ", ".join(pending))
@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+"""
+responses.csv / student_terms.csv を一度だけ解析した、検証済みの希望モデル。
+
+希望科は語彙番号の (回答 × 希望順位) 行列、ターム指定はビットマスク (1 << term) の行列として持つ。
+配属の各経路（allocation_engine.encode_cohort・initial_assignment・simulate_each_as_first・
+demand_cube）はここで作ったモデルを読むだけで、hope_i_terms の正規表現や iterrows を繰り返さない。
+
+不正な入力は正規化したうえで issues に記録する。
+  「第三-」のように診療科が空の希望  → 空欄（'-' と同じ）として扱う
+  同じ科の重複・自分のタームに含まれないターム指定・student_terms にない学生 → そのまま記録だけ
+
+モデルは入力の内容ハッシュをキーに CACHE_DIR へ .npz で保存し、同じ内容なら次回はそれを読む。
+"""
+import os
+import re
+import json
+import hashlib
+import argparse
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+MODEL_VERSION = 1  # 解析・正規化の規則を変えたら上げる（古いキャッシュを使わない）
+CACHE_DIR = "preference_cache"
+CACHE_KEEP = 8     # 残しておくキャッシュファイル数（新しい順）
+BLANK = '-'
+
+_MEMO = {}  # 入力ハッシュ → モデル（同じプロセス内ではファイルも読まない）
+
+
+def parse_term_list(raw, default_terms):
+    """
+    raw: e.g. "[9, 10]" や "2;5", "", NaN
+    default_terms: [2,5,9,10] のような基本４ターム
+    戻り値: 指定タームのリスト（昇順）、指定なし or 不正入力時は None
+    """
+    if pd.isna(raw) or not str(raw).strip():
+        return None
+    # 数字をすべて抽出
+    nums = [int(n) for n in re.findall(r"\d+", str(raw))]
+    # default_terms のサブセットだけ残す
+    valid = [n for n in nums if n in default_terms]
+    return sorted(set(valid)) if valid else None
+
+
+def terms_to_mask(terms) -> int:
+    """ターム番号のリストをビットマスク (1 << term) に変換する"""
+    mask = 0
+    for t in terms:
+        mask |= 1 << int(t)
+    return mask
+
+
+def mask_to_terms(mask: int) -> list:
+    return [t for t in range(int(mask).bit_length()) if mask >> t & 1]
+
+
+def normalize_hope(raw):
+    """
+    希望欄の値を「病院-診療科」に正規化する。空欄・'-' は None。
+    戻り値: (科名 or None, 不正な入力なら理由 or None)
+    """
+    if not isinstance(raw, str) or not raw.strip() or raw == BLANK:
+        return None, None
+    hospital, sep, dept = raw.partition('-')
+    if not sep or not hospital.strip() or not dept.strip():
+        return None, "診療科が空（病院名のみ）" if sep and hospital.strip() else "「病院-診療科」の形式でない"
+    return raw, None
+
+
+@dataclass
+class PreferenceModel:
+    student_ids: np.ndarray  # 回答の行 → student_id（responses.csv の行順、前後の空白は除去）
+    names:       list        # 語彙番号 → 科名（正規化済みの希望に現れたもの、初出順）
+    hopes:       np.ndarray  # (回答 × 希望順位) 語彙番号, -1 は空欄
+    restrict:    np.ndarray  # (回答 × 希望順位) hope_i_terms の有効なターム指定のマスク, 0 は指定なし
+    masks:       np.ndarray  # (回答 × 希望順位) 配属エンジン用の許可タームのマスク（下記）
+    term_ids:    np.ndarray  # student_terms の行 → student_id
+    term_labels: list        # student_terms の term_ 列名
+    slot_terms:  np.ndarray  # (学生 × スロット) ターム番号, 欠損は -1
+    issues:      list        # 不正な入力の記録 {student_id, 列, 値, 内容}
+
+    # masks: 指定のない希望は本人の全ターム。同じ科を複数回書いた場合は、最後に有効な
+    # ターム指定がその科の全ての希望に効く（配属エンジンの従来の挙動）。
+
+    @property
+    def max_hopes(self) -> int:
+        return self.hopes.shape[1]
+
+    @property
+    def term_row(self) -> dict:
+        """student_id → student_terms の行（重複は後勝ち）"""
+        return {sid: r for r, sid in enumerate(self.term_ids)}
+
+    def default_terms(self, term_row: int) -> list:
+        return [int(t) for t in self.slot_terms[term_row] if t >= 0]
+
+    def hope_names(self, row: int) -> list:
+        """回答の行の希望科（空欄を除く、希望順）"""
+        return [self.names[h] for h in self.hopes[row] if h >= 0]
+
+    def rows_of(self, student_id: str) -> np.ndarray:
+        """student_id の回答の行（重複回答なら複数）"""
+        return np.flatnonzero(self.student_ids == student_id)
+
+    def popularity(self, exclude_rows=()) -> dict:
+        """
+        科 → 人気スコア（第 i 希望に max_hopes + 1 - i 点）。科は hope_1 列の上から、hope_2 列…の
+        初出順。exclude_rows の回答の寄与は除き、スコアが 0 以下になった科は落とす。
+        """
+        weights = np.broadcast_to(self.max_hopes - np.arange(self.max_hopes), self.hopes.shape)
+        valid = self.hopes >= 0
+        valid[np.asarray(exclude_rows, dtype=np.int64)] = False
+        score = np.bincount(self.hopes[valid], weights[valid], minlength=len(self.names))
+        flat = self.hopes.T.ravel()
+        ids, first = np.unique(flat[flat >= 0], return_index=True)
+        order = ids[np.argsort(first)]
+        return {self.names[k]: int(score[k]) for k in order if score[k] > 0}
+
+
+def compile_preferences(responses: pd.DataFrame, terms_df: pd.DataFrame) -> PreferenceModel:
+    """responses / student_terms を解析して PreferenceModel を作る（キャッシュは見ない）"""
+    hope_cols = [c for c in responses.columns if c.startswith('hope_') and not c.endswith('_terms')]
+    max_hopes = max(int(c.split('_')[1]) for c in hope_cols)
+    term_labels = [c for c in terms_df.columns if c.startswith('term_')]
+    issues = []
+
+    def flag(sid, col, value, reason):
+        issues.append({'student_id': sid, '列': col, '値': '' if pd.isna(value) else str(value),
+                       '内容': reason})
+
+    # --- student_terms ---
+    term_ids = terms_df['student_id'].astype(str).str.strip().to_numpy(dtype=object)
+    slot_terms = np.full((len(term_ids), len(term_labels)), -1, dtype=np.int64)
+    for k, label in enumerate(term_labels):
+        vals = pd.to_numeric(terms_df[label], errors='coerce').to_numpy(dtype=float)
+        ok = ~np.isnan(vals)
+        slot_terms[ok, k] = vals[ok].astype(np.int64)
+        for sid, raw in zip(term_ids[~ok], terms_df[label].to_numpy()[~ok]):
+            flag(sid, label, raw, "タームが空または数値でない")
+    term_row = {sid: r for r, sid in enumerate(term_ids)}
+
+    # --- responses ---
+    student_ids = responses['student_id'].astype(str).str.strip().to_numpy(dtype=object)
+    n = len(student_ids)
+    empty = pd.Series([np.nan] * n, index=responses.index)
+    raw_hopes = [responses.get(f'hope_{i}', empty).to_numpy() for i in range(1, max_hopes + 1)]
+    raw_terms = [responses.get(f'hope_{i}_terms', empty).to_numpy() for i in range(1, max_hopes + 1)]
+    vocab = {}
+    hopes = np.full((n, max_hopes), -1, dtype=np.int64)
+    restrict = np.zeros((n, max_hopes), dtype=np.int64)
+    masks = np.zeros((n, max_hopes), dtype=np.int64)
+    seen_ids = set()
+    for r, sid in enumerate(student_ids):
+        if sid in seen_ids:
+            flag(sid, 'student_id', sid, "回答が重複している")
+        seen_ids.add(sid)
+        if sid in term_row:
+            default_terms = [int(t) for t in slot_terms[term_row[sid]] if t >= 0]
+        else:
+            default_terms = []
+            flag(sid, 'student_id', sid, "student_terms.csv にない学生")
+        default_mask = terms_to_mask(default_terms)
+        last_restrict = {}
+        for i in range(max_hopes):
+            name, problem = normalize_hope(raw_hopes[i][r])
+            if problem:
+                flag(sid, f'hope_{i + 1}', raw_hopes[i][r], problem)
+            if name is None:
+                masks[r, i] = default_mask
+                continue
+            h = hopes[r, i] = vocab.setdefault(name, len(vocab))
+            if h in last_restrict:
+                flag(sid, f'hope_{i + 1}', name, "同じ科の希望が重複している")
+            raw = raw_terms[i][r]
+            valid = parse_term_list(raw, default_terms)
+            if valid:
+                restrict[r, i] = last_restrict[h] = terms_to_mask(valid)
+            else:
+                last_restrict.setdefault(h, 0)
+                if not pd.isna(raw) and str(raw).strip():
+                    flag(sid, f'hope_{i + 1}_terms', raw, "自分のタームに含まれないターム指定（無視）")
+        for i in range(max_hopes):
+            if hopes[r, i] >= 0:
+                masks[r, i] = last_restrict[hopes[r, i]] or default_mask
+    return PreferenceModel(
+        student_ids=student_ids,
+        names=list(vocab),
+        hopes=hopes,
+        restrict=restrict,
+        masks=masks,
+        term_ids=term_ids,
+        term_labels=term_labels,
+        slot_terms=slot_terms,
+        issues=issues,
+    )
+
+
+# --- ディスクキャッシュ ---
+
+def input_digest(responses: pd.DataFrame, terms_df: pd.DataFrame) -> str:
+    """モデルが読む列の内容ハッシュ（読み込み時の dtype の違いでは変わらないよう CSV 文字列で取る）"""
+    h = hashlib.sha256(f"preference_model v{MODEL_VERSION}\n".encode())
+    cols = ['student_id'] + [c for c in responses.columns if c.startswith('hope_')]
+    h.update(responses[cols].to_csv(index=False).encode('utf-8'))
+    cols = ['student_id'] + [c for c in terms_df.columns if c.startswith('term_')]
+    h.update(terms_df[cols].to_csv(index=False).encode('utf-8'))
+    return h.hexdigest()
+
+
+def cache_path(digest: str, cache_dir: str = CACHE_DIR) -> str:
+    return os.path.join(cache_dir, f"{digest[:32]}.npz")
+
+
+def save_model(model: PreferenceModel, path: str):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'wb') as f:
+        np.savez(f,
+                 student_ids=model.student_ids.astype(str), names=np.array(model.names, dtype=str),
+                 hopes=model.hopes, restrict=model.restrict, masks=model.masks,
+                 term_ids=model.term_ids.astype(str), term_labels=np.array(model.term_labels, dtype=str),
+                 slot_terms=model.slot_terms,
+                 issues=np.array(json.dumps(model.issues, ensure_ascii=False)))
+    os.replace(tmp, path)
+
+
+def read_model(path: str) -> PreferenceModel:
+    with np.load(path) as z:
+        return PreferenceModel(
+            student_ids=z['student_ids'].astype(object),
+            names=z['names'].tolist(),
+            hopes=z['hopes'],
+            restrict=z['restrict'],
+            masks=z['masks'],
+            term_ids=z['term_ids'].astype(object),
+            term_labels=z['term_labels'].tolist(),
+            slot_terms=z['slot_terms'],
+            issues=json.loads(str(z['issues'])),
+        )
+
+
+def _prune(cache_dir: str, keep: int = CACHE_KEEP):
+    paths = sorted((os.path.join(cache_dir, p) for p in os.listdir(cache_dir) if p.endswith('.npz')),
+                   key=os.path.getmtime, reverse=True)
+    for path in paths[keep:]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def load_preferences(responses: pd.DataFrame, terms_df: pd.DataFrame,
+                     cache_dir: str = CACHE_DIR) -> PreferenceModel:
+    """
+    入力の内容ハッシュが同じならキャッシュ（プロセス内 → cache_dir の .npz）を返し、
+    無ければ解析して保存する。cache_dir=None ならディスクには読み書きしない。
+    返すモデルは共有されるので、呼び出し側で配列を書き換えないこと。
+    """
+    digest = input_digest(responses, terms_df)
+    if digest in _MEMO:
+        return _MEMO[digest]
+    path = cache_path(digest, cache_dir) if cache_dir else None
+    model = None
+    if path and os.path.exists(path):
+        try:
+            model = read_model(path)
+        except (OSError, ValueError, KeyError):
+            model = None  # 壊れたキャッシュは作り直す
+    if model is None:
+        model = compile_preferences(responses, terms_df)
+        if path:
+            try:
+                save_model(model, path)
+                _prune(cache_dir)
+            except OSError:
+                pass  # 書けない環境ではキャッシュなしで続ける
+    _MEMO.clear()
+    _MEMO[digest] = model
+    return model
+
+
+def issues_frame(model: PreferenceModel, known_departments=None) -> pd.DataFrame:
+    """issues の表。known_departments（定員表の科名）を渡すと、定員表にない希望科も加える"""
+    rows = list(model.issues)
+    if known_departments is not None:
+        known = set(known_departments)
+        for r, sid in enumerate(model.student_ids):
+            for i, h in enumerate(model.hopes[r]):
+                if h >= 0 and model.names[h] not in known:
+                    rows.append({'student_id': sid, '列': f'hope_{i + 1}', '値': model.names[h],
+                                 '内容': "定員表にない科"})
+    return pd.DataFrame(rows, columns=['student_id', '列', '値', '内容'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compile and validate the preference model")
+    parser.add_argument('--output', default=None, help='Write the flagged entries to this CSV')
+    parser.add_argument('--no-cache', action='store_true', help='Always re-parse; do not read or write the cache')
+    args = parser.parse_args()
+
+    responses = pd.read_csv("responses.csv", dtype={'student_id': str})
+    terms_df = pd.read_csv("student_terms.csv", dtype={'student_id': str})
+    capacity = pd.read_csv("department_capacity.csv")
+    model = load_preferences(responses, terms_df, None if args.no_cache else CACHE_DIR)
+    issues = issues_frame(model, capacity['hospital_department'])
+    print(f"✅ {len(model.student_ids)} 件の回答・{len(model.names)} 科を解析しました")
+    if issues.empty:
+        print("不正な入力はありません")
+    else:
+        print(f"⚠️ {len(issues)} 件の不正な入力:")
+        print(issues['内容'].value_counts().to_string())
+        if args.output:
+            issues.to_csv(args.output, index=False)
+            print(f"✅ {args.output} に保存しました")
+        else:
+            print(issues.to_string(index=False))
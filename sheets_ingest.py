@@ -0,0 +1,412 @@
+"""
+Google フォーム回答シートの増分取り込み。
+
+前回取り込んだ行数と行ごとのハッシュ（sheet_state.json）を覚えておき、通常は
+前回の最終行より後ろ（新しく追記された行）だけをページ単位で取得する。
+responses.csv / auth.csv は、行が追加・変更された学生の分だけ導出し直し、
+それ以外の学生の行は既存の CSV をそのまま使う。
+
+回答の編集（既存行の書き換え）は末尾取得では検知できないため、--full-sync 指定時と
+FULL_SYNC_EVERY 回に一度は全行をページ取得し、行ハッシュで変更行を特定する。
+
+fetch は A1 範囲文字列を受け取り、Sheets API の values（行のリスト）を返す callable。
+batch_fetch は範囲のリストを受け取り values のリストを返す callable（values.batchGet）で、
+ヘッダーと先頭ページを 1 往復で取るのに使う（無ければ fetch を順に呼ぶ）。
+本番は googleapiclient、オフラインでは http_fetcher / http_batch_fetcher + fake_sheets_server.py を使う。
+"""
+import os
+import re
+import json
+import hashlib
+import urllib.parse
+import urllib.request
+
+import pandas as pd
+
+SHEET_RANGE     = "'フォームの回答'!A1:AZ"
+STATE_PATH      = "sheet_state.json"
+FORM_CSV        = "form_responses_final.csv"
+RESPONSES_CSV   = "responses.csv"
+AUTH_CSV        = "auth.csv"
+PAGE_ROWS       = 500
+FULL_SYNC_EVERY = 20
+AUTH_COLUMNS    = ["student_id", "password_hash", "role"]
+
+
+# --- A1 範囲 ---
+
+def parse_range(range_name: str):
+    """"'シート'!A1:AZ1000" を (シート名, 先頭列, 末尾列) に分解する（行番号は無視）"""
+    sheet, _, cells = range_name.rpartition('!')
+    m = re.fullmatch(r"([A-Z]+)\d*(?::([A-Z]+)\d*)?", cells)
+    if not m:
+        raise ValueError(f"範囲の形式が不正です: {range_name}")
+    return sheet, m.group(1), m.group(2) or m.group(1)
+
+
+def a1(sheet: str, first_col: str, last_col: str, start: int, end: int) -> str:
+    return f"{sheet}!{first_col}{start}:{last_col}{end}" if sheet else f"{first_col}{start}:{last_col}{end}"
+
+
+def http_fetcher(endpoint: str, spreadsheet_id: str, token: str = None):
+    """
+    Sheets REST API（GET /v4/spreadsheets/{id}/values/{range}）を直接叩く fetch。
+    fake_sheets_server.py に向けてオフラインで取り込みを試すときに使う。
+    """
+    def fetch(range_name: str) -> list:
+        url = (f"{endpoint.rstrip('/')}/v4/spreadsheets/{urllib.parse.quote(spreadsheet_id)}"
+               f"/values/{urllib.parse.quote(range_name, safe='')}")
+        req = urllib.request.Request(url)
+        if token:
+            req.add_header("Authorization", f"Bearer {token}")
+        with urllib.request.urlopen(req) as res:
+            return json.load(res).get("values", [])
+    return fetch
+
+
+def http_batch_fetcher(endpoint: str, spreadsheet_id: str, token: str = None):
+    """
+    Sheets REST API の values.batchGet（GET /v4/spreadsheets/{id}/values:batchGet?ranges=...）を
+    直接叩く batch_fetch。戻り値は範囲ごとの values のリスト。
+    """
+    def batch_fetch(ranges: list) -> list:
+        query = urllib.parse.urlencode([("ranges", r) for r in ranges])
+        url = (f"{endpoint.rstrip('/')}/v4/spreadsheets/{urllib.parse.quote(spreadsheet_id)}"
+               f"/values:batchGet?{query}")
+        req = urllib.request.Request(url)
+        if token:
+            req.add_header("Authorization", f"Bearer {token}")
+        with urllib.request.urlopen(req) as res:
+            return [vr.get("values", []) for vr in json.load(res).get("valueRanges", [])]
+    return batch_fetch
+
+
+def batched(fetch):
+    """単一範囲の fetch を batch_fetch の形にする（範囲ごとに順に取得）"""
+    return lambda ranges: [fetch(r) for r in ranges]
+
+
+def fetch_rows(batch_fetch, range_name: str, start_row: int, page_rows: int = PAGE_ROWS,
+               pages: int = 1, extra=()):
+    """
+    シート行番号 start_row 以降のデータ行を page_rows 行ずつ、1 回の batchGet で pages ページずつ取得する。
+    API は範囲末尾の空行を返さないので、page_rows 行に満たないページで終わり。
+    extra の範囲（ヘッダーなど）は最初の batchGet に相乗りさせる。
+    戻り値: (データ行, extra の各範囲の values)
+    """
+    sheet, first_col, last_col = parse_range(range_name)
+    rows, extra_values = [], None
+    while True:
+        ranges = [a1(sheet, first_col, last_col, start_row + k * page_rows, start_row + (k + 1) * page_rows - 1)
+                  for k in range(pages)]
+        result = batch_fetch(list(extra) + ranges)
+        if extra_values is None:
+            extra_values, result = result[:len(extra)], result[len(extra):]
+            extra = ()
+        for page in result:
+            rows.extend(page)
+            if len(page) < page_rows:
+                return rows, extra_values
+        start_row += pages * page_rows
+
+
+# --- 導出（update_all.py の Step 2 / 3 と同じ変換） ---
+
+def align(row: list, ncol: int) -> list:
+    """ヘッダー列数に合わせて行をパディング or 切り詰め"""
+    return row + [""] * (ncol - len(row)) if len(row) < ncol else row[:ncol]
+
+
+def row_hash(row: list) -> str:
+    return hashlib.sha256(json.dumps(row, ensure_ascii=False).encode('utf-8')).hexdigest()[:16]
+
+
+# pd.read_csv が既定で欠損とみなす文字列（keep_default_na=True の na_values）
+CSV_NA_VALUES = {"", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND",
+                 "1.#QNAN", "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null"}
+
+
+def csv_columns(header: list) -> list:
+    """pd.read_csv と同じく重複した列名に .1, .2, … を付ける"""
+    seen, out = set(header), []
+    counts = {}
+    for name in header:
+        if name in counts:
+            while True:
+                counts[name] += 1
+                renamed = f"{name}.{counts[name]}"
+                if renamed not in seen:
+                    break
+            seen.add(renamed)
+            out.append(renamed)
+        else:
+            counts[name] = 0
+            out.append(name)
+    return out
+
+
+def form_frame(header: list, rows: list) -> pd.DataFrame:
+    """
+    揃えた行を、CSV に書いて pd.read_csv(dtype=str) で読み直したときと同じ形
+    （全列 str、空欄などは NaN、重複列名は .1 付き）の DataFrame にする。CSV は経由しない。
+    """
+    values = [[None if v in CSV_NA_VALUES else v for v in row] for row in rows]
+    return pd.DataFrame(values, columns=csv_columns(header), dtype=str)
+
+
+def row_student(row: list):
+    """行の student_id（学生番号の先頭ゼロを除いたもの）。空欄は None"""
+    return row[1].lstrip("0") if len(row) > 1 and row[1] != "" else None
+
+
+def derive_responses(df2: pd.DataFrame) -> pd.DataFrame:
+    """フォーム回答 1 行 → responses 1 行（重複排除前）"""
+    # グリッド質問の列名マッピング (第n希望 → "希望ターム [第n希望]")
+    term_columns = {
+        i: f"希望ターム [第{i}希望]"
+        for i in range(1, 21)
+        if f"希望ターム [第{i}希望]" in df2.columns
+    }
+
+    output = {
+        "student_id": df2.iloc[:, 1].str.lstrip("0"),
+        "password":   df2.iloc[:, 2]
+    }
+
+    for i in range(1, 21):
+        # 科目の読み取り（既存ロジック）
+        hcol = i * 2 + 1
+        dcol = i * 2 + 2
+        try:
+            hosp = df2.iloc[:, hcol].fillna("")
+            dept = df2.iloc[:, dcol].fillna("")
+            combined = (hosp + "-" + dept).str.strip().replace("", pd.NA)
+        except Exception:
+            combined = pd.NA
+        output[f"hope_{i}"] = combined
+
+        # グリッド回答から複数ターム番号を取り出し（リストとして保存）
+        grid_col = term_columns.get(i)
+        if grid_col:
+            raw = df2[grid_col].fillna("")  # 例: "3ターム, 5ターム"
+            term_list = raw.str.findall(r"(\d+)") \
+                           .apply(lambda lst: [int(x) for x in lst] if lst else pd.NA)
+            output[f"hope_{i}_terms"] = term_list
+        else:
+            output[f"hope_{i}_terms"] = pd.NA
+
+    return pd.DataFrame(output)
+
+
+def derive_auth(df2: pd.DataFrame, pepper: str) -> pd.DataFrame:
+    """フォーム回答 1 行 → auth 1 行（重複排除前）。パスワード空欄の行は student_id だけ残す"""
+    rows = []
+    for sid, pwd in zip(df2["学生番号"].str.lstrip("0"), df2.get("パスワード", pd.Series(index=df2.index))):
+        if pd.isna(pwd) or pwd == "":
+            rows.append({"student_id": sid})
+            continue
+        hash_hex = hashlib.sha256((pwd + pepper).encode("utf-8")).hexdigest()
+        role = "admin" if sid == "22" else "student"
+        rows.append({"student_id": sid, "password_hash": hash_hex, "role": role})
+    return pd.DataFrame(rows, columns=AUTH_COLUMNS, index=df2.index)
+
+
+# --- 状態 ---
+
+def load_state(path: str = STATE_PATH) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_state(state: dict, path: str = STATE_PATH):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False, indent=1)
+        f.write("\n")
+
+
+def _cached(path: str):
+    """既存の導出 CSV を student_id → 行 の辞書で読む。無ければ None"""
+    if not os.path.exists(path):
+        return None, None
+    df = pd.read_csv(path, dtype=str)
+    return df, {sid: i for i, sid in enumerate(df["student_id"])}
+
+
+def _merge(order, fresh: pd.DataFrame, removed: set, cached, columns) -> pd.DataFrame:
+    """
+    student_id の並び order に従い、fresh（導出し直した行）を優先、無ければ cached の行で組み立てる。
+    removed の学生は fresh に無ければ出力しない。行は 1 回の iloc でまとめて取り出す。
+    """
+    cached_df, cached_pos = cached
+    fresh_pos = {sid: i for i, sid in enumerate(fresh["student_id"])}
+    take = []
+    for sid in order:
+        if sid in fresh_pos:
+            take.append(fresh_pos[sid])
+        elif sid in removed:
+            continue
+        elif cached_pos is not None and sid in cached_pos:
+            take.append(len(fresh) + cached_pos[sid])
+    parts = [df.reindex(columns=columns) for df in (fresh, cached_df) if df is not None and len(df)]
+    if not parts:
+        return pd.DataFrame(columns=columns)
+    rows = pd.concat(parts, ignore_index=True) if len(parts) > 1 else parts[0]
+    return rows.iloc[take].reset_index(drop=True)
+
+
+# --- 取り込み ---
+
+def ingest(fetch, pepper=None, range_name: str = SHEET_RANGE, full: bool = False,
+           page_rows: int = PAGE_ROWS, state_path: str = STATE_PATH,
+           batch_fetch=None, pool=None, outputs=None) -> dict:
+    """
+    シートを取り込み、form_responses_final.csv / responses.csv / auth.csv と状態ファイルを更新する。
+    ヘッダーと取得すべき先頭ページは 1 回の batchGet（batch_fetch。無ければ fetch を順に呼ぶ）で取る。
+    pool（concurrent.futures の Executor）を渡すと、既存の responses.csv / auth.csv の読み込みを
+    シートの取得と並行して行う。outputs（dict）を渡すと、書き出した responses.csv / auth.csv の
+    バイト列を入れる（パイプラインに読み直しなしで渡す用）。
+    戻り値は取得行数や導出し直した学生数のサマリ。
+    """
+    batch_fetch = batch_fetch or batched(fetch)
+    requests = [0]
+    def counted(ranges):
+        requests[0] += 1
+        return batch_fetch(ranges)
+
+    sheet, first_col, last_col = parse_range(range_name)
+    state = load_state(state_path)
+    old_hashes = state.get("row_hashes", [])
+    old_students = state.get("row_students", [])
+    files_ok = (os.path.exists(RESPONSES_CSV)
+                and (not pepper or (state.get("auth") and os.path.exists(AUTH_CSV))))
+
+    # 既存の導出 CSV はシートの応答を待つあいだに読んでおく（使うのはキャッシュが有効なときだけ）
+    cached = {path: pool.submit(_cached, path) if pool and files_ok else None
+              for path in (RESPONSES_CSV, AUTH_CSV)}
+
+    # 前回の状態から取得範囲を見込み、ヘッダーと一緒に 1 往復で取る
+    # （全行なら前回の行数が収まるページ数をまとめて、増分なら末尾の 1 ページ）
+    full = (full or not files_ok or "header" not in state
+            or state.get("runs_since_full", 0) + 1 >= FULL_SYNC_EVERY)
+    start = 0 if full else len(old_hashes)
+    pages = len(old_hashes) // page_rows + 1 if full else 1
+    fetched, (header_rows,) = fetch_rows(counted, range_name, start + 2, page_rows, pages,
+                                         extra=[a1(sheet, first_col, last_col, 1, 1)])
+    if not header_rows:
+        raise RuntimeError("データが取得できませんでした")
+    header = header_rows[0]
+    ncol = len(header)
+
+    cache_ok = state.get("header") == header and files_ok
+    if not cache_ok:
+        if not full:
+            # ヘッダーが変わっていたので全行を取り直す
+            full, start = True, 0
+            fetched, _ = fetch_rows(counted, range_name, 2, page_rows, len(old_hashes) // page_rows + 1)
+        old_hashes, old_students = [], []
+    fetched = [align(r, ncol) for r in fetched]
+    hashes = (old_hashes[:start] if not full else []) + [row_hash(r) for r in fetched]
+    students = (old_students[:start] if not full else []) + [row_student(r) for r in fetched]
+    if not full and not fetched:
+        print("ℹ️ 新しい回答はありません")
+
+    # 変更行 = 追加行 + ハッシュが変わった行。削除された行の学生も影響を受ける
+    changed = [i for i in range(start, len(hashes))
+               if i >= len(old_hashes) or hashes[i] != old_hashes[i]]
+    affected = {students[i] for i in changed}
+    affected |= {old_students[i] for i in changed if i < len(old_students)}
+    affected |= set(old_students[len(hashes):])
+    affected.discard(None)
+
+    # 各学生の採用行 = 最後の行（drop_duplicates(keep="last") と同じ）
+    last_row = {}
+    for i, sid in enumerate(students):
+        if sid is not None:
+            last_row[sid] = i
+    order = sorted(last_row, key=last_row.get)
+    targets = sorted(last_row[sid] for sid in affected if sid in last_row)
+    delta = form_frame(header, [fetched[i - start] for i in targets])
+
+    def read_cached(path):
+        if not cache_ok:
+            return None, None
+        return cached[path].result() if cached[path] else _cached(path)
+
+    if cache_ok and not affected:
+        print("ℹ️ responses.csv / auth.csv は変更なし")
+    else:
+        _write_derived(order, affected, targets, delta, pepper, read_cached,
+                       outputs if outputs is not None else {})
+
+    form_sha = _update_form_csv(header, fetched, start, full, len(old_hashes), state.get("form_sha256"))
+
+    save_state({
+        "header":          header,
+        "row_hashes":      hashes,
+        "row_students":    students,
+        "auth":            bool(pepper) and (full or state.get("auth", False)),
+        "runs_since_full": 0 if full else state.get("runs_since_full", 0) + 1,
+        "form_sha256":     form_sha,
+    }, state_path)
+    return {"full": full, "fetched": len(fetched), "changed": len(changed),
+            "rederived": len(targets), "rows": len(hashes), "requests": requests[0]}
+
+
+def _write_derived(order, affected, targets, delta, pepper, read_cached, outputs):
+    """影響を受けた学生だけを導出し直し、残りは既存 CSV の行で responses.csv / auth.csv を組み立てる"""
+    resp_new = derive_responses(delta)
+    responses = _merge(order, resp_new, affected, read_cached(RESPONSES_CSV), resp_new.columns)
+    _write_csv(RESPONSES_CSV, responses, outputs)
+    print(f"✅ responses.csv を更新しました（{len(targets)} 人を再導出, 計 {len(responses)} 件）")
+
+    if pepper:
+        auth_new = derive_auth(delta, pepper)
+        auth_new = auth_new[auth_new["password_hash"].notna()]  # パスワード空欄の学生は出力しない
+        auth_df = _merge(order, auth_new, affected, read_cached(AUTH_CSV), AUTH_COLUMNS)
+        _write_csv(AUTH_CSV, auth_df, outputs)
+        print("✅ auth.csv を更新しました")
+    else:
+        print("⚠️ PEPPER が設定されていないため auth.csv をスキップします")
+
+
+def _write_csv(path: str, df: pd.DataFrame, outputs: dict):
+    data = df.to_csv(index=False).encode('utf-8')
+    with open(path, 'wb') as f:
+        f.write(data)
+    outputs[path] = data
+
+
+def _file_sha256(path: str):
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _update_form_csv(header, fetched, start, full, old_count, old_sha):
+    """
+    form_responses_final.csv（シートのローカル写し）を全取得時は書き直し、増分時は末尾に追記する。
+    前回書いた内容のハッシュと一致するときだけ追記する（CSV を読み直して確かめはしない）。
+    戻り値は次回の照合に使うハッシュ（追記しなかったときは前回の値のまま）
+    """
+    if full:
+        pd.DataFrame(fetched, columns=header).to_csv(FORM_CSV, index=False)
+        print(f"✅ {FORM_CSV} を保存しました")
+        return _file_sha256(FORM_CSV)
+    if not fetched:
+        return old_sha
+    current = _file_sha256(FORM_CSV)
+    if old_sha is not None:
+        consistent = current == old_sha
+    else:
+        # 前回の状態にハッシュが無い（旧形式）ときだけ中身を読んで確かめる
+        local = pd.read_csv(FORM_CSV, dtype=str) if current else None
+        consistent = local is not None and list(local.columns) == header and len(local) == old_count
+    if not consistent:
+        print(f"⚠️ {FORM_CSV} が前回の取り込みと一致しないため追記をスキップします（--full-sync で再作成）")
+        return old_sha
+    pd.DataFrame(fetched, columns=header).to_csv(FORM_CSV, mode='a', header=False, index=False)
+    print(f"✅ {FORM_CSV} に {len(fetched)} 行を追記しました")
+    return _file_sha256(FORM_CSV)
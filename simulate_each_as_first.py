@@ -1,138 +1,352 @@
+import os
+import glob
+import json
+import zlib
+import hashlib
+import argparse
 import pandas as pd
 import numpy as np
-import random
-import re
-from collections import defaultdict
+import alloc_kernels
+from allocation_engine import (
+    encode_cohort,
+    sample_weighted_hopes,
+    allocate_first_fit_batch,
+    first_fit_prefix,
+)
+from preference_model import PreferenceModel, load_preferences
+from parallel_mc import iter_tasks, keyed_seeds, worker_cohort
+from perf_trace import TRACE_DIR, Trace
+from artifacts import publish
+from mc_stats import (
+    wilson_interval,
+    interval_width,
+    group_ids,
+    stratified_uniforms,
+    ratio_standard_error,
+)
 
 N_SIMULATIONS = 20
+SE_GROUPS = 4  # 1 ラウンドの N_SIMULATIONS 回を分ける独立グループ数（標準誤差の推定・LHS の単位）
+WORLD_KEY = zlib.crc32(b"common-worlds")  # 共通乱数の世界に使う SeedSequence の spawn_key
+PARTS_DIR = "first_choice_parts"
+INPUT_FILES = ["responses.csv", "lottery_order.csv", "student_terms.csv", "department_capacity.csv"]
+OUTPUT_COLUMNS = ['student_id', '希望科', '通過確率', '下限', '上限', '標準誤差', '試行回数']
 
-def parse_term_list(raw, default_terms):
-    if pd.isna(raw) or not str(raw).strip():
-        return None
-    nums = [int(n) for n in re.findall(r"\d+", str(raw))]
-    valid = [n for n in nums if n in default_terms]
-    return sorted(set(valid)) if valid else None
+# シミュレーション設定（CLI から上書き）
+#   target_width / max_simulations: 適応モード。target_width が None なら N_SIMULATIONS 回の固定回数
+#   sampling: 未回答者の補完乱数 'iid'（独立）/ 'lhs'（ラテン超方格で層別）
+#   crn: 共通乱数。全ターゲット・全学生で同じ補完世界を使い、科どうし・学生どうしの比較を安定させる
+SIM_OPTIONS = {'target_width': None, 'max_simulations': 2000, 'sampling': 'iid', 'crn': False}
 
-def simulate_each_as_first(student_id: str) -> pd.DataFrame:
+def load_inputs():
     responses = pd.read_csv("responses.csv", dtype={'student_id': str})
     lottery = pd.read_csv("lottery_order.csv", dtype={'student_id': str, 'lottery_order': int})
     terms_df = pd.read_csv("student_terms.csv", dtype={'student_id': str})
     capacity = pd.read_csv("department_capacity.csv", dtype=str)
+    return responses, lottery, terms_df, capacity
 
-    student_terms_map = {
-        row['student_id']: [
-            int(row[f'term_{i}']) for i in range(1, 5)
-            if pd.notna(row.get(f'term_{i}')) and re.search(r'\d+', str(row[f'term_{i}']))
-        ]
-        for _, row in terms_df.iterrows()
-    }
-
-    hope_cols = [c for c in responses.columns if c.startswith('hope_') and not c.endswith('_terms')]
-    MAX_HOPES = max(int(c.split('_')[1]) for c in hope_cols)
-
-    term_prefs = {}
-    for _, row in responses.iterrows():
-        sid = row['student_id']
-        default_terms = student_terms_map.get(sid, [])
-        prefs = {}
-        for i in range(1, MAX_HOPES+1):
-            dept = row.get(f'hope_{i}')
-            raw = row.get(f'hope_{i}_terms')
-            if pd.isna(dept) or not str(dept).strip() or pd.isna(raw):
-                continue
-            valid_terms = parse_term_list(raw, default_terms)
-            if valid_terms:
-                prefs[dept] = valid_terms
-        term_prefs[sid] = prefs
-
-    me = responses.loc[responses['student_id'] == student_id]
-    if me.empty:
-        raise ValueError(f"student_id {student_id} が見つかりません。")
-    original_hopes = [h for h in me.iloc[0][hope_cols].dropna().tolist() if h and h != '-']
-
-    others = responses[responses['student_id'] != student_id]
-    answered_ids = set(others['student_id'])
-    all_ids = set(terms_df['student_id'])
-    unresp_ids = list(all_ids - answered_ids - {student_id})
-
-    pop = defaultdict(int)
-    for idx, col in enumerate(hope_cols, start=1):
-        weight = MAX_HOPES + 1 - idx
-        for d in others[col].dropna():
-            if d and d != '-':
-                pop[d] += weight
-    dept_list, counts = zip(*pop.items())
-    weights = [c / sum(counts) for c in counts]
-
-    terms_lot = terms_df.merge(lottery, on='student_id')
+def build_tasks(model: PreferenceModel, student_ids, seed=None) -> list:
+    """
+    学生ごとのタスク (student_id, 希望科リスト, 補完用の人気科, SeedSequence) を作る。
+    人気科は既存どおり「本人以外の回答」に現れた科で、{科: 本人以外の人気スコア} の dict。
+    未回答者の補完はこのスコアに比例した重みで引く（generate_probability と同じ重み付け）。
+    """
+    tasks = []
+    for sid, seed_seq in zip(student_ids, keyed_seeds(seed, student_ids)):
+        rows = model.rows_of(sid)
+        if not len(rows):
+            raise ValueError(f"student_id {sid} が見つかりません。")
+        tasks.append((sid, model.hope_names(rows[0]), model.popularity(rows), seed_seq))
+    return tasks
 
+def imputation_keys(cohort, pool, n_sims, rng, sampling='iid') -> np.ndarray:
+    """
+    未回答者の補完に使う一様乱数 (n_sims × 未回答者 × 科の語彙)。
+    列は cohort の科 ID（定員表にない pool の科はその後ろ）なので、pool が学生ごとに違っても
+    同じ乱数から同じ科の並びが決まる（共通乱数で学生をまたいで世界をそろえるため）。
+    """
+    n_imp = int((cohort.unresp_rows >= 0).sum())
+    n_cols = len(cohort.dept_names) + len(pool)
+    if sampling == 'lhs':
+        return stratified_uniforms(rng, n_sims, (n_imp, n_cols), min(SE_GROUPS, n_sims))
+    return rng.random((n_sims, n_imp, n_cols))
+
+def pool_columns(cohort, pool) -> np.ndarray:
+    """pool の各科 → imputation_keys の列番号"""
+    n_depts = len(cohort.dept_names)
+    return np.array([cohort.dept_index.get(d, n_depts + i) for i, d in enumerate(pool)], dtype=np.int64)
+
+def first_choice_hits(cohort, focal, targets, pool, n_sims, rng, keys=None) -> np.ndarray:
+    """
+    targets の各科を第1希望に繰り上げた場合に、その科に配属されたかを n_sims 回ずつ一括で判定する。
+    全ターゲット × 全シミュレーションを 1 つのレプリケーション軸にまとめて配属する。
+    keys（imputation_keys の戻り値）を渡すと、未回答者の補完をそれで行う
+    （(n_sims, …) なら全ターゲット共通、(ターゲット × n_sims, …) ならターゲットごと）。
+    戻り値: (ターゲット × n_sims) の bool 配列
+    """
+    n_targets = len(targets)
+    n_reps = n_targets * n_sims
+    target_ids = [cohort.dept_index.get(t, -1) for t in targets]
+
+    success = np.zeros((n_targets, n_sims), dtype=bool)
+    if n_reps and focal >= 0:
+        shape = (n_reps,) + cohort.base_prefs.shape
+        prefs = np.broadcast_to(cohort.base_prefs, shape).copy()
+        masks = np.broadcast_to(cohort.masks, shape).copy()
+
+        # 未回答者: 人気科から人気重み付き・重複なしで補完
+        imp = cohort.unresp_rows[cohort.unresp_rows >= 0]
+        pool_ids = np.array([cohort.dept_index.get(d, -1) for d in pool], dtype=np.int64)
+        if keys is None:
+            keys = rng.random((n_reps, len(imp), len(pool)))
+        else:
+            keys = keys[..., pool_columns(cohort, pool)]
+            if len(keys) == n_sims:
+                keys = np.tile(keys, (n_targets, 1, 1))
+        picks = sample_weighted_hopes(pool_ids, list(pool.values()), cohort.max_hopes, keys)
+        prefs[:, imp] = -1
+        prefs[:, imp, :picks.shape[-1]] = picks
+
+        # 本人: ターゲットを先頭に並べ替えたダミー希望（ターム指定は科ごとに維持）
+        mask_of = dict(zip(cohort.base_prefs[focal].tolist(), cohort.masks[focal].tolist()))
+        for t_idx, target in enumerate(targets):
+            new_hopes = [target] + [dept for dept in targets if dept != target]
+            ids = [cohort.dept_index.get(d, -1) for d in new_hopes]
+            block = slice(t_idx * n_sims, (t_idx + 1) * n_sims)
+            prefs[block, focal] = -1
+            prefs[block, focal, :len(ids)] = ids
+            masks[block, focal, :len(ids)] = [mask_of.get(d, 0) for d in ids]
+
+        # 本人と最初の未回答者より前は毎回同じなので一度だけ配属し、その残り定員から始める
+        order = np.argsort(cohort.lottery, kind='stable')
+        term_cols = cohort.term_cols()
+        m, head_cap = first_fit_prefix(cohort, order, term_cols, stop_row=focal)
+        cap = np.broadcast_to(head_cap, (n_reps,) + head_cap.shape).copy()
+        dept, _ = allocate_first_fit_batch(order[m:], prefs, masks, cohort.slot_terms, cap,
+                                           term_cols)
+        placed = dept[:, focal].reshape(n_targets, n_sims)
+        success = (placed == np.array(target_ids)[:, None]) & (np.array(target_ids)[:, None] >= 0)
+    return success
+
+def first_choice_probabilities(cohort, student_id, targets, pool, n_sims, rng,
+                               target_width=None, max_simulations=2000,
+                               sampling='iid', crn=False, world_seed=None) -> pd.DataFrame:
+    """
+    targets の各科を第1希望に繰り上げた場合の通過確率（%）と 95% Wilson 区間、標準誤差。
+    target_width（%ポイント）を指定すると n_sims 回ずつのラウンドを重ね、
+    区間幅が target_width 未満になったターゲットから打ち切る（上限 max_simulations 回）。
+    crn=True なら第 r ラウンドの補完世界を world_seed から作り、全ターゲット・全学生で共有する。
+    """
+    rows = np.flatnonzero(cohort.student_ids == student_id)
+    focal = rows[0] if len(rows) else -1
+    groups = min(SE_GROUPS, n_sims)
+    gid = group_ids(n_sims, groups)
+    group_hits, group_n = [], []  # 標準誤差用: ラウンド内のグループごとの (ターゲット,) 集計
+
+    def run_round(r, idx):
+        if crn:
+            world = np.random.default_rng(np.random.SeedSequence(world_seed.entropy,
+                                                                 spawn_key=(WORLD_KEY, r)))
+            keys = imputation_keys(cohort, pool, n_sims, world, sampling)
+        elif sampling == 'lhs':
+            keys = np.concatenate([imputation_keys(cohort, pool, n_sims, rng, sampling) for _ in idx])
+        else:
+            keys = None
+        success = first_choice_hits(cohort, focal, [targets[i] for i in idx], pool, n_sims, rng, keys)
+        for g in range(groups):
+            gh = np.zeros(len(targets), dtype=np.int64)
+            gn = np.zeros(len(targets), dtype=np.int64)
+            gh[idx] = success[:, gid == g].sum(axis=1)
+            gn[idx] = int((gid == g).sum()) if focal >= 0 else 0
+            group_hits.append(gh)
+            group_n.append(gn)
+
+    run_round(0, np.arange(len(targets)))
+    hits, n = sum(group_hits), np.full(len(targets), n_sims)
+
+    if target_width is not None and focal >= 0:
+        active = interval_width(hits, n) * 100.0 >= target_width
+        r = 1
+        while active.any() and n[active].max() < max_simulations:
+            idx = np.flatnonzero(active)
+            run_round(r, idx)
+            hits = sum(group_hits)
+            n[idx] += n_sims
+            active[idx] = interval_width(hits[idx], n[idx]) * 100.0 >= target_width
+            r += 1
+
+    lo, hi = wilson_interval(hits, n)
+    se = ratio_standard_error(np.array(group_hits), np.array(group_n)) * 100.0
     results = []
-    for target in original_hopes:
-        success = 0
-        for _ in range(N_SIMULATIONS):
-            cap = {
-                (r['hospital_department'], int(re.search(r'\d+', col).group())): int(r[col])
-                for _, r in capacity.iterrows() for col in capacity.columns[1:]
-                if re.search(r'\d+', col) and pd.notna(r[col]) and str(r[col]).isdigit()
-            }
-
-            gen_rows = []
-            for uid in unresp_ids:
-                picks = random.sample(dept_list, MAX_HOPES)
-                row = {'student_id': uid, **{f'hope_{i}': picks[i-1] for i in range(1, MAX_HOPES+1)}}
-                gen_rows.append(row)
-            gen_df = pd.DataFrame(gen_rows)
-
-            dummy = {'student_id': student_id}
-            new_hopes = [target] + [dept for dept in original_hopes if dept != target]
-            for i, dept in enumerate(new_hopes, 1):
-                dummy[f'hope_{i}'] = dept
-            for i in range(len(new_hopes)+1, MAX_HOPES+1):
-                dummy[f'hope_{i}'] = ''
-            me_dummy = pd.DataFrame([dummy])
-
-            full = pd.concat([others, gen_df, me_dummy], ignore_index=True)
-            merged = full.merge(terms_lot, on='student_id')
-            merged['_ord'] = merged['lottery_order'] + np.random.rand(len(merged))*0.01
-            merged = merged.sort_values('_ord').drop(columns=['_ord'])
-
-            assigned = defaultdict(set)  # 修正箇所: defaultdict(set) を使用
-            for _, r in merged.iterrows():
-                sid = r['student_id']
-                used = assigned[sid]  # 修正箇所: 正しくsetを初期化
-                placed = False
-
-                for ti in range(1, 5):
-                    if placed:
-                        break
-                    term_month = r.get(f'term_{ti}')
-                    if pd.isna(term_month):
-                        continue
-                    term_month = int(term_month)
-                    default_terms = student_terms_map.get(sid, [])
-                    prefs = term_prefs.get(sid, {})
-                    for i in range(1, MAX_HOPES+1):
-                        dept = r.get(f'hope_{i}', '')
-                        if not dept or dept in used:
-                            continue
-                        allowed = prefs.get(dept, default_terms)
-                        if term_month not in allowed:
-                            continue
-                        if cap.get((dept, term_month), 0) > 0:
-                            cap[(dept, term_month)] -= 1
-                            used.add(dept)
-                            if sid == student_id and dept == target:
-                                success += 1
-                            placed = True
-                            break
-
-        pct = round(success / N_SIMULATIONS * 100, 1)
-        results.append({'student_id': student_id, '希望科': target, '通過確率': pct})
-
-    return pd.DataFrame(results)
+    for i, target in enumerate(targets):
+        pct = round(int(hits[i]) / n[i] * 100, 1)
+        results.append({'student_id': student_id, '希望科': target, '通過確率': pct,
+                        '下限': round(lo[i] * 100, 1), '上限': round(hi[i] * 100, 1),
+                        '標準誤差': round(float(se[i]), 2), '試行回数': int(n[i])})
+    return pd.DataFrame(results, columns=OUTPUT_COLUMNS)
 
-if __name__ == '__main__':
+def _first_choice_task(task):
+    """プロセスプールのワーカーから呼ばれる 1 学生分のタスク"""
+    sid, targets, pool, seed_seq, options = task
+    return first_choice_probabilities(worker_cohort(), sid, targets, pool, N_SIMULATIONS,
+                                      np.random.default_rng(seed_seq), world_seed=seed_seq, **options)
+
+def simulate_each_as_first(student_id: str, seed=None) -> pd.DataFrame:
+    responses, lottery, terms_df, capacity = load_inputs()
+    cohort = encode_cohort(responses, lottery, capacity, terms_df)
+    model = load_preferences(responses, terms_df)
+    sid, targets, pool, seed_seq = build_tasks(model, [student_id], seed)[0]
+    return first_choice_probabilities(cohort, sid, targets, pool, N_SIMULATIONS,
+                                      np.random.default_rng(seed_seq), world_seed=seed_seq, **SIM_OPTIONS)
+
+# --- シャード分割・チェックポイント・ストリーミング出力 ---
+
+def parse_shard(text: str):
+    """'i/n' (0 <= i < n) を (i, n) に変換する"""
+    i, n = (int(x) for x in text.split('/'))
+    if not 0 <= i < n:
+        raise argparse.ArgumentTypeError(f"--shard は 0 <= i < n の i/n 形式で指定してください: {text}")
+    return i, n
+
+def in_shard(student_id: str, shard) -> bool:
+    """student_id のハッシュで学生をシャードに振り分ける（学生の増減で他の割当は動かない）"""
+    i, n = shard
+    return zlib.crc32(student_id.encode()) % n == i
+
+def inputs_fingerprint(seed=None) -> str:
+    """
+    入力 CSV・シミュレーション設定（sampling / crn を含む）・マスターシードのハッシュ。
+    変わったらチェックポイントは無効（別の乱数列のパートを混ぜない）
+    """
+    # 出力列と補完方法（人気重み付き Gumbel-top-k）が変わった古いパートも使わない
+    h = hashlib.sha256(f"N_SIMULATIONS={N_SIMULATIONS} {sorted(SIM_OPTIONS.items())} seed={seed} "
+                       f"{OUTPUT_COLUMNS} imputation=weighted".encode())
+    for path in INPUT_FILES:
+        with open(path, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+def shard_paths(shard):
+    i, n = shard
+    base = os.path.join(PARTS_DIR, f"shard-{i}-of-{n}")
+    return base + ".csv", base + ".done"
+
+def load_checkpoint(done_path: str, fingerprint: str) -> set:
+    """チェックポイントの完了済み student_id。入力が変わっていれば空集合"""
+    if not os.path.exists(done_path):
+        return set()
+    with open(done_path, encoding='utf-8') as f:
+        lines = f.read().splitlines()
+    if not lines or json.loads(lines[0]).get('fingerprint') != fingerprint:
+        return set()
+    return set(lines[1:])
+
+def run_shard(shard, workers=1, seed=None):
+    """
+    シャードに属する未完了の学生を計算し、終わった学生から順に
+    パートファイルへ追記してチェックポイントに記録する。
+    """
+    responses, lottery, terms_df, capacity = load_inputs()
+    fingerprint = inputs_fingerprint(seed)
+    part_path, done_path = shard_paths(shard)
+    os.makedirs(PARTS_DIR, exist_ok=True)
+
+    done = load_checkpoint(done_path, fingerprint)
+    if done and os.path.exists(part_path):
+        # 中断時の書きかけ行を捨て、チェックポイント済みの学生だけ残す
+        part = pd.read_csv(part_path, dtype={'student_id': str})
+        part[part['student_id'].isin(done)].to_csv(part_path, index=False)
+    else:
+        done = set()
+        pd.DataFrame(columns=OUTPUT_COLUMNS).to_csv(part_path, index=False)
+        with open(done_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'fingerprint': fingerprint}) + "\n")
+
+    cohort = encode_cohort(responses, lottery, capacity, terms_df)
+    model = load_preferences(responses, terms_df)
+    students = [sid for sid in pd.unique(model.student_ids)
+                if in_shard(sid, shard) and sid not in done]
+    print(f"shard {shard[0]}/{shard[1]}: {len(done)} 人完了済み, 残り {len(students)} 人")
+    tasks = [task + (dict(SIM_OPTIONS),) for task in build_tasks(model, students, seed)]
+
+    with open(part_path, 'a', encoding='utf-8', newline='') as part, \
+         open(done_path, 'a', encoding='utf-8') as ckpt:
+        for idx, result in iter_tasks(cohort, _first_choice_task, tasks, workers):
+            result.to_csv(part, header=False, index=False)
+            part.flush()
+            os.fsync(part.fileno())
+            ckpt.write(tasks[idx][0] + "\n")
+            ckpt.flush()
+
+def merge_parts(output="first_choice_probabilities.csv", seed=None):
+    """現在の入力（と同じシード）に対応する全シャードのパートを結合して最終 CSV を作る"""
     responses = pd.read_csv("responses.csv", dtype={'student_id': str})
+    fingerprint = inputs_fingerprint(seed)
+    frames, taken = [], set()
+    for part_path in sorted(glob.glob(os.path.join(PARTS_DIR, "shard-*-of-*.csv"))):
+        done = load_checkpoint(part_path[:-len(".csv")] + ".done", fingerprint) - taken
+        if not done:
+            continue
+        part = pd.read_csv(part_path, dtype={'student_id': str})
+        frames.append(part[part['student_id'].isin(done)])
+        taken |= done
+
     all_students = responses['student_id'].unique()
-    final_results = pd.concat([simulate_each_as_first(sid) for sid in all_students])
-    final_results.to_csv("first_choice_probabilities.csv", index=False)
+    missing = [sid for sid in all_students if sid not in taken]
+    if missing:
+        print(f"⚠️ 未計算の学生が {len(missing)} 人います（全シャード完了後に再実行してください）")
+
+    merged = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=OUTPUT_COLUMNS)
+    rank = {sid: i for i, sid in enumerate(all_students)}
+    merged = merged[merged['student_id'].isin(rank)]
+    merged = merged.iloc[merged['student_id'].map(rank).argsort(kind='stable')]
+    publish(merged, output)
+    print(f"✅ {output} を生成しました（{len(taken)} 人分）")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="First-choice probability precompute")
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Worker processes (default: 1)')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Master random seed; results do not depend on --workers or --shard (default: random)')
+    parser.add_argument('--shard', type=parse_shard, default=(0, 1),
+                        help='Compute only shard i of n, e.g. 0/4; rows are streamed to first_choice_parts/ (default: 0/1)')
+    parser.add_argument('--merge', action='store_true',
+                        help='Only merge finished shard parts into first_choice_probabilities.csv '
+                             '(pass the same --seed and simulation options as the shard runs)')
+    parser.add_argument('--target-width', type=float, default=None,
+                        help=f'Adaptive mode: keep adding rounds of {N_SIMULATIONS} simulations to a target until '
+                             f'its 95%% interval is narrower than this (percentage points) (default: off)')
+    parser.add_argument('--max-simulations', type=int, default=SIM_OPTIONS['max_simulations'],
+                        help='Upper limit per target in adaptive mode (default: %(default)s)')
+    parser.add_argument('--sampling', choices=['iid', 'lhs'], default=SIM_OPTIONS['sampling'],
+                        help='Imputation sampling: independent draws or Latin hypercube stratified '
+                             'across simulations (default: %(default)s)')
+    parser.add_argument('--crn', action='store_true',
+                        help='Common random numbers: reuse the same imputed worlds for every target '
+                             'and every student (requires --seed for reproducible resumes)')
+    parser.add_argument('--profile', action='store_true',
+                        help='Also dump a cProfile (.prof) per step into the trace directory')
+    parser.add_argument('--trace-dir', default=TRACE_DIR,
+                        help='Directory for the JSON timing trace (default: %(default)s)')
+    parser.add_argument('--engine', choices=alloc_kernels.ENGINES, default='numpy',
+                        help='Allocation kernel: numpy (default), numba (JIT-compiled; falls back to numpy '
+                             'when numba is not installed) or python (the uncompiled kernel, for '
+                             'cross-checking); results are identical')
+    args = parser.parse_args()
+    alloc_kernels.select(args.engine)
+    SIM_OPTIONS.update(target_width=args.target_width, max_simulations=args.max_simulations,
+                       sampling=args.sampling, crn=args.crn)
+
+    trace = Trace("first_choice", profile=args.profile, trace_dir=args.trace_dir)
+    try:
+        if not args.merge:
+            with trace.stage("shard", shard=f"{args.shard[0]}/{args.shard[1]}", workers=args.workers):
+                run_shard(args.shard, args.workers, args.seed)
+        # 単一シャード実行時はそのまま最終 CSV まで作る
+        if args.merge or args.shard[1] == 1:
+            with trace.stage("merge"):
+                merge_parts(seed=args.seed)
+    finally:
+        print(trace.summary())
+        print(f"⏱️ 計測結果を {trace.write()} に保存しました")
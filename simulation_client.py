@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+simulation_service への薄いクライアント（標準ライブラリのみ）。
+
+  import simulation_client
+  if simulation_client.available():
+      r = simulation_client.whatif("41", ["本院-麻酔科", "葛飾-産婦人科"])
+
+接続先は $SIM_SERVICE_URL（既定 http://127.0.0.1:8766）。サービスが起動していなければ
+ServiceUnavailable を送出するので、呼び出し側は手元での計算にフォールバックできる。
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import urllib.error
+import urllib.request
+
+DEFAULT_URL = "http://127.0.0.1:8766"
+
+
+class ServiceUnavailable(RuntimeError):
+    pass
+
+
+def service_url(url=None) -> str:
+    return (url or os.environ.get("SIM_SERVICE_URL") or DEFAULT_URL).rstrip('/')
+
+
+def call(endpoint: str, params=None, url=None, timeout: float = 30.0) -> dict:
+    """endpoint に params を POST（params が None なら GET）して JSON を返す"""
+    data = None if params is None else json.dumps(params, ensure_ascii=False).encode('utf-8')
+    req = urllib.request.Request(f"{service_url(url)}/{endpoint}", data=data,
+                                 headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            return json.loads(resp.read())
+    except urllib.error.HTTPError as e:
+        try:
+            message = str(json.loads(e.read())["error"])
+        except (ValueError, KeyError, TypeError):
+            message = str(e)
+        raise ValueError(message) from None
+    except (urllib.error.URLError, OSError) as e:
+        raise ServiceUnavailable(f"{service_url(url)} に接続できません: {e}") from None
+
+
+def available(url=None, timeout: float = 0.5) -> bool:
+    try:
+        return call("health", url=url, timeout=timeout).get("status") == "ok"
+    except (ServiceUnavailable, ValueError):
+        return False
+
+
+def health(url=None) -> dict:
+    return call("health", url=url)
+
+
+def whatif(student_id: str, hopes: list, lottery_number=None, budget: float = 0.2, url=None) -> dict:
+    params = {"student_id": str(student_id), "hopes": list(hopes), "budget": budget}
+    if lottery_number is not None:
+        params["lottery_number"] = int(lottery_number)
+    return call("whatif", params, url=url)
+
+
+def progressive_whatif(student_id: str, hopes: list, lottery_number=None, budget: float = 0.8,
+                       step: float = 0.2, url=None):
+    """
+    whatif を step 秒ずつ budget 秒まで繰り返す。LiveIndex.progressive と同じく
+    (希望ごとの世界数のリスト, 世界数) を返すジェネレータ。
+    """
+    deadline = time.perf_counter() + budget
+    while True:
+        start = time.perf_counter()
+        r = whatif(student_id, hopes, lottery_number, step, url)
+        yield r["hits"], r["worlds"]
+        if r["worlds"] >= r["max_worlds"] or time.perf_counter() + (time.perf_counter() - start) > deadline:
+            break
+
+
+def probability(student_id: str, budget: float = 0.2, url=None) -> dict:
+    return call("probability", {"student_id": str(student_id), "budget": budget}, url=url)
+
+
+def first_choice(student_id: str, n_sims=None, seed=None, url=None) -> dict:
+    params = {"student_id": str(student_id)}
+    if n_sims is not None:
+        params["n_sims"] = int(n_sims)
+    if seed is not None:
+        params["seed"] = int(seed)
+    return call("first_choice", params, url=url)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Query the local simulation service")
+    parser.add_argument('--url', default=None, help=f'Service URL (default: $SIM_SERVICE_URL or {DEFAULT_URL})')
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('health', help='Service status')
+    p = sub.add_parser('whatif', help='Probabilities for hypothetical hopes')
+    p.add_argument('--student', required=True)
+    p.add_argument('--hopes', nargs='+', required=True, help='"病院-診療科" hopes in order')
+    p.add_argument('--lottery', type=int, default=None, help="Lottery number (default: the student's own)")
+    p = sub.add_parser('probability', help="Probabilities for the student's current hopes")
+    p.add_argument('--student', required=True)
+    p = sub.add_parser('first-choice', help='Probability of each hope when moved to first place')
+    p.add_argument('--student', required=True)
+    p.add_argument('--n-sims', type=int, default=None)
+    p.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    try:
+        if args.command == 'health':
+            result = health(args.url)
+        elif args.command == 'whatif':
+            result = whatif(args.student, args.hopes, args.lottery, url=args.url)
+        elif args.command == 'probability':
+            result = probability(args.student, url=args.url)
+        else:
+            result = first_choice(args.student, args.n_sims, args.seed, url=args.url)
+    except (ServiceUnavailable, ValueError) as e:
+        print(f"❌ {e}")
+        sys.exit(1)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+"""
+ローカルの常駐シミュレーションサービス（localhost の HTTP + JSON）。
+
+入力 CSV を一度だけ読み込んでエンコードし、what-if 用の LiveIndex と一緒にメモリに
+保持する。Streamlit アプリやスクリプトは simulation_client から問い合わせるだけで、
+毎回 CSV を読み直してエンコードし直す必要がない。
+
+  GET  /health                      状態（世界数・入力ファイルの版・処理件数）
+  POST /whatif        {student_id, hopes, lottery_number?, budget?}
+  POST /probability   {student_id}  本人の現在の希望での確率
+  POST /first_choice  {student_id, n_sims?, seed?}  各希望を第1希望にした場合の通過確率
+
+・入力ファイル（snapshot_index.INPUT_FILES）の内容が変わっていたら次の問い合わせで読み直す
+・同じ内容の問い合わせが同時に来たら 1 回だけ計算して全員に同じ結果を返す
+"""
+import os
+import json
+import time
+import argparse
+import threading
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import numpy as np
+
+import app_data
+import simulate_each_as_first
+from allocation_engine import encode_cohort
+from mc_stats import wilson_interval
+from preference_model import load_preferences
+from snapshot_index import INPUT_FILES, LiveIndex, read_frames
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8766
+
+
+class WarmState:
+    """ある版の入力ファイルから作った常駐状態（作った後は差し替えるだけで変更しない）"""
+
+    def __init__(self, versions: tuple, seed=None, warm_worlds: int = 1000):
+        self.versions = versions
+        self.loaded_at = time.time()
+        # 入力は一度だけ読み、エンコードと希望の解析の両方に使う
+        responses, lottery, capacity_df, terms_df = read_frames()
+        self.cohort = encode_cohort(responses, lottery, capacity_df, terms_df)
+        self.engine = LiveIndex(self.cohort, seed=seed)
+        self.engine.warm(warm_worlds)
+        self.preferences = load_preferences(responses, terms_df)
+
+    def student_row(self, student_id: str) -> int:
+        rows = np.flatnonzero(self.cohort.student_ids == student_id)
+        if not len(rows):
+            raise ValueError(f"student_id {student_id} が見つかりません。")
+        return int(rows[0])
+
+
+class Coalescer:
+    """同じキーの計算が実行中なら、新たに計算せずその結果を待つ"""
+
+    def __init__(self):
+        self.lock = threading.Lock()  # 実行中の表と件数（coalesced、SimulationService.requests）を守る
+        self._running = {}
+        self.coalesced = 0
+
+    def run(self, key, func):
+        with self.lock:
+            future = self._running.get(key)
+            owner = future is None
+            if owner:
+                future = self._running[key] = Future()
+            else:
+                self.coalesced += 1
+        if not owner:
+            return future.result()
+        try:
+            future.set_result(func())
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self.lock:
+                del self._running[key]
+        return future.result()
+
+
+class SimulationService:
+    def __init__(self, seed=None, warm_worlds: int = 1000):
+        self.seed = seed
+        self.warm_worlds = warm_worlds
+        self.started = time.time()
+        self.requests = 0
+        self.reloads = 0
+        self._state = None
+        self._lock = threading.Lock()
+        self._coalescer = Coalescer()
+
+    # --- 常駐状態 ---
+
+    def state(self) -> WarmState:
+        """入力ファイルの内容が前回と同じなら今の状態を、変わっていれば読み直した状態を返す"""
+        with self._lock:
+            versions = tuple(app_data.file_version(p) for p in INPUT_FILES)
+            if self._state is None or self._state.versions != versions:
+                self._state = WarmState(versions, self.seed, self.warm_worlds)
+                self.reloads += 1
+                print(f"🔄 入力を読み込みました（{self._state.cohort.n_students} 人）", flush=True)
+            return self._state
+
+    # --- 問い合わせ ---
+
+    def handle(self, endpoint: str, params: dict) -> dict:
+        handlers = {
+            'health': self.health,
+            'whatif': self.whatif,
+            'probability': self.probability,
+            'first_choice': self.first_choice,
+        }
+        if endpoint not in handlers:
+            raise KeyError(endpoint)
+        with self._coalescer.lock:  # ハンドラはスレッドごとに走る
+            self.requests += 1
+        if endpoint == 'health':
+            return self.health()
+        state = self.state()
+        key = (state.versions, endpoint, json.dumps(params, sort_keys=True, ensure_ascii=False))
+        return self._coalescer.run(key, lambda: handlers[endpoint](state, **params))
+
+    def health(self) -> dict:
+        state = self._state
+        return {
+            "status": "ok",
+            "uptime_s": round(time.time() - self.started, 1),
+            "requests": self.requests,
+            "coalesced": self._coalescer.coalesced,
+            "reloads": self.reloads,
+            "worlds": state.engine.n_worlds if state else 0,
+            "max_worlds": state.engine.max_worlds if state else 0,
+            "inputs": dict(zip(INPUT_FILES, state.versions)) if state else {},
+        }
+
+    def whatif(self, state: WarmState, student_id: str, hopes: list,
+               lottery_number=None, budget: float = 0.2) -> dict:
+        result = None
+        for result in state.engine.progressive(str(student_id), list(hopes), lottery_number, budget):
+            pass
+        hits, n = result
+        lo, hi = wilson_interval(hits, n)
+        return {
+            "student_id": str(student_id),
+            "hopes": list(hopes),
+            "known": [h in state.cohort.dept_index for h in hopes],
+            "hits": hits.tolist(),
+            "worlds": int(n),
+            "max_worlds": state.engine.max_worlds,
+            "probability": (hits / n * 100).round(1).tolist(),
+            "lower": (lo * 100).round(1).tolist(),
+            "upper": (hi * 100).round(1).tolist(),
+        }
+
+    def probability(self, state: WarmState, student_id: str, budget: float = 0.2) -> dict:
+        row = state.student_row(str(student_id))
+        if state.cohort.is_imputed[row]:
+            raise ValueError(f"student_id {student_id} は未回答です。")
+        hopes = [state.cohort.dept_names[d] for d in state.cohort.base_prefs[row] if d >= 0]
+        result = self.whatif(state, student_id, hopes, budget=budget)
+        result["lottery_number"] = int(state.cohort.lottery[row])
+        return result
+
+    def first_choice(self, state: WarmState, student_id: str,
+                     n_sims: int = simulate_each_as_first.N_SIMULATIONS, seed=None) -> dict:
+        student_id = str(student_id)
+        [(sid, targets, pool, seed_seq)] = simulate_each_as_first.build_tasks(
+            state.preferences, [student_id], seed)
+        df = simulate_each_as_first.first_choice_probabilities(
+            state.cohort, sid, targets, pool, int(n_sims), np.random.default_rng(seed_seq))
+        return {"student_id": student_id,
+                "rows": json.loads(df.to_json(orient='records', force_ascii=False))}
+
+
+# --- HTTP ---
+
+class Handler(BaseHTTPRequestHandler):
+    service = None  # serve() が設定する
+
+    def _reply(self, status: int, body: dict):
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _dispatch(self, params: dict):
+        endpoint = urlparse(self.path).path.strip('/')
+        try:
+            self._reply(200, self.service.handle(endpoint, params))
+        except KeyError:
+            self._reply(404, {"error": f"unknown endpoint: /{endpoint}"})
+        except (TypeError, ValueError) as e:
+            self._reply(400, {"error": str(e)})
+        except Exception as e:
+            self._reply(500, {"error": f"{type(e).__name__}: {e}"})
+
+    def do_GET(self):
+        self._dispatch({})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            params = json.loads(self.rfile.read(length) or b"{}")
+        except json.JSONDecodeError as e:
+            self._reply(400, {"error": f"invalid JSON: {e}"})
+            return
+        self._dispatch(params)
+
+    def log_message(self, format, *args):
+        pass  # 問い合わせごとのアクセスログは出さない
+
+
+def serve(host: str = DEFAULT_HOST, port: int = DEFAULT_PORT, seed=None, warm_worlds: int = 1000):
+    service = SimulationService(seed, warm_worlds)
+    service.state()  # 起動時に読み込んでおく
+    Handler.service = service
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    print(f"✅ シミュレーションサービスを http://{host}:{port} で起動しました", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Long-lived local simulation service (localhost HTTP/JSON)")
+    parser.add_argument('--host', default=DEFAULT_HOST, help='Bind address (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=int(os.environ.get("SIM_SERVICE_PORT", DEFAULT_PORT)),
+                        help='Port (default: %(default)s, or $SIM_SERVICE_PORT)')
+    parser.add_argument('--seed', type=int, default=None, help='Random seed (default: random)')
+    parser.add_argument('--warm-worlds', type=int, default=1000,
+                        help='What-if worlds simulated in the background after each (re)load '
+                             '(default: %(default)s)')
+    args = parser.parse_args()
+    serve(args.host, args.port, args.seed, args.warm_worlds)
@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+"""
+抽選順位ごとの残り定員スナップショット索引。
+
+配属は抽選順のシリアル・ディクテーターシップなので、抽選順位 k の学生が見る残り定員は
+その学生や後続の学生の希望に依存しない。シミュレーションした各世界について
+「順位ごとに消費された枠」（差分）だけを保存しておけば、任意の順位の残り定員を
+再構成でき、本人の希望だけをその残り定員に対して再生すれば what-if に答えられる。
+本人を元より後ろの順位に動かす what-if では、間の学生が本人の枠の空いた状態で選び直すので、
+保存しておいた各世界の補完済み希望でその学生たちだけを再配属する（remaining_moved）。
+
+枠（セル）の単位は配属ルールによって異なる:
+  'slot'      run_simulation のルール。スロット k × 科（スロットごとに定員を張り直す）
+  'first_fit' simulate_each_as_first のルール。定員ターム列 × 科
+"""
+import time
+import argparse
+import threading
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+from allocation_engine import (
+    EncodedCohort,
+    encode_cohort,
+    impute_prefs_batch,
+    simulate_batch,
+    allocate_slot_batch,
+    allocate_first_fit_batch,
+    terms_to_mask,
+    first_matched_hope,
+)
+
+RULES = ('slot', 'first_fit')
+INPUT_FILES = ["responses.csv", "lottery_order.csv", "department_capacity.csv", "student_terms.csv"]
+
+
+@dataclass
+class SnapshotIndex:
+    rule:           str
+    n_depts:        int
+    base:           np.ndarray  # (セル,) 初期定員
+    lottery_sorted: np.ndarray  # 順位 → lottery_order
+    order:          np.ndarray  # 順位 → cohort の行番号
+    taken:          np.ndarray  # (世界 × 順位 × 配属数) 消費したセル ID, -1 はなし
+    imputed:        np.ndarray = None  # (世界 × 未回答者行 × 希望) 補完した希望（remaining_moved 用）
+
+    @property
+    def n_worlds(self) -> int:
+        return self.taken.shape[0]
+
+    def position_of(self, lottery_number: int) -> int:
+        """抽選番号 lottery_number の学生が処理される順位（それより前の学生数）"""
+        return int(np.searchsorted(self.lottery_sorted, lottery_number, side='left'))
+
+    def remaining_at(self, pos: int, exclude: int = -1) -> np.ndarray:
+        """順位 pos の学生が見る残り定員 (世界 × セル)。exclude 番目の順位の消費は数えない"""
+        n_cells = len(self.base)
+        taken = self.taken[:, :pos]
+        if 0 <= exclude < pos:
+            taken = np.delete(taken, exclude, axis=1)
+        prefix = taken.reshape(self.n_worlds, -1)
+        valid = prefix >= 0
+        flat = (np.arange(self.n_worlds)[:, None] * n_cells + prefix)[valid]
+        used = np.bincount(flat, minlength=self.n_worlds * n_cells)
+        return self.base[None, :] - used.reshape(self.n_worlds, n_cells)
+
+    def world_prefs(self, cohort: EncodedCohort) -> np.ndarray:
+        """各世界の希望テンソル (世界 × 学生 × 希望)。回答者は共通、未回答者は保存した補完"""
+        if self.imputed is None:
+            raise ValueError("この索引には補完した希望が保存されていません（作り直してください）")
+        prefs = np.broadcast_to(cohort.base_prefs, (self.n_worlds,) + cohort.base_prefs.shape).copy()
+        prefs[:, cohort.is_imputed] = self.imputed
+        return prefs
+
+    def save(self, path: str):
+        np.savez_compressed(path, rule=self.rule, n_depts=self.n_depts, base=self.base,
+                            lottery_sorted=self.lottery_sorted, order=self.order,
+                            taken=self.taken, imputed=self.imputed)
+
+    @classmethod
+    def load(cls, path: str) -> 'SnapshotIndex':
+        with np.load(path) as z:
+            return cls(rule=str(z['rule']), n_depts=int(z['n_depts']), base=z['base'],
+                       lottery_sorted=z['lottery_sorted'], order=z['order'], taken=z['taken'],
+                       imputed=z['imputed'] if 'imputed' in z.files else None)
+
+
+def build_snapshot_index(cohort: EncodedCohort, prefs: np.ndarray, rule: str = 'slot') -> SnapshotIndex:
+    """
+    prefs (世界 × 学生 × 希望) の各世界を一度だけ配属し、順位ごとの消費セルを記録する。
+    """
+    if rule not in RULES:
+        raise ValueError(f"rule は {RULES} のいずれか: {rule}")
+    n_depts = len(cohort.dept_names)
+    order = np.argsort(cohort.lottery, kind='stable')
+
+    if rule == 'slot':
+        dept, _ = simulate_batch(cohort, prefs)
+        slots = np.arange(len(cohort.term_labels))
+        cells = np.where(dept >= 0, slots * n_depts + dept, -1)
+        base = cohort.capacity[:, cohort.slot_cols].T.reshape(-1)
+    else:
+        cap = np.broadcast_to(cohort.capacity, (prefs.shape[0],) + cohort.capacity.shape).copy()
+        masks = np.broadcast_to(cohort.masks, prefs.shape)
+        term_cols = cohort.term_cols()
+        dept, slot = allocate_first_fit_batch(order, prefs, masks, cohort.slot_terms, cap, term_cols)
+        rows = np.arange(cohort.n_students)
+        col = term_cols[cohort.slot_terms[rows, np.maximum(slot, 0)]]
+        cells = np.where(dept >= 0, col * n_depts + dept, -1)[:, :, None]
+        base = cohort.capacity.T.reshape(-1)
+
+    dtype = np.int16 if len(base) < np.iinfo(np.int16).max else np.int32
+    return SnapshotIndex(
+        rule=rule,
+        n_depts=n_depts,
+        base=base.astype(np.int64),
+        lottery_sorted=cohort.lottery[order],
+        order=order,
+        taken=cells[:, order].astype(dtype),
+        imputed=prefs[:, cohort.is_imputed].astype(dtype),
+    )
+
+
+def remaining_moved(index: SnapshotIndex, cohort: EncodedCohort, pos: int, own: int) -> np.ndarray:
+    """
+    順位 own の本人を順位 pos (> own) に動かしたとき、本人が見る残り定員 (世界 × セル)。
+    own と pos の間の学生は本人の枠が空いた状態で選ぶので、順位 own の残り定員から
+    その学生たちだけを各世界の希望で配属し直す（元の世界の消費は使わない）。
+    """
+    rem = index.remaining_at(own)
+    between = index.order[own + 1:pos]
+    if not len(between):
+        return rem
+    prefs = index.world_prefs(cohort)
+    n_worlds, n_depts = index.n_worlds, index.n_depts
+    if index.rule == 'slot':
+        for k in range(len(cohort.term_labels)):
+            cap = rem[:, k * n_depts:(k + 1) * n_depts].copy()
+            allocate_slot_batch(between, prefs, cohort.masks, cohort.slot_terms[:, k], cap,
+                                cohort.is_imputed)
+            rem[:, k * n_depts:(k + 1) * n_depts] = cap
+    else:
+        cap = rem.reshape(n_worlds, -1, n_depts).transpose(0, 2, 1).copy()  # (世界 × 科 × 列)
+        masks = np.broadcast_to(cohort.masks, prefs.shape)
+        allocate_first_fit_batch(between, prefs, masks, cohort.slot_terms, cap, cohort.term_cols())
+        rem = cap.transpose(0, 2, 1).reshape(n_worlds, -1)
+    return rem
+
+
+def focal_inputs(cohort: EncodedCohort, student_id: str, hopes: list, terms=None):
+    """
+    what-if の本人入力 (科 ID, 許可タームマスク, スロットごとのターム) を作る。
+    回答済みの学生は科ごとのターム指定を引き継ぎ、それ以外は自分の全タームを許可する。
+    """
+    rows = np.flatnonzero(cohort.student_ids == student_id)
+    if terms is None:
+        if not len(rows):
+            raise ValueError(f"student_id {student_id} のタームが見つかりません。")
+        terms = cohort.slot_terms[rows[0]].tolist()
+    default = terms_to_mask(terms)
+    mask_of = {}
+    if len(rows):
+        mask_of = dict(zip(cohort.base_prefs[rows[0]].tolist(), cohort.masks[rows[0]].tolist()))
+    ids = [cohort.dept_index.get(h, -1) for h in hopes]
+    masks = [mask_of.get(d, default) for d in ids]
+    return ids, masks, list(terms)
+
+
+def query(index: SnapshotIndex, cohort: EncodedCohort, hope_ids, hope_masks, terms, pos: int,
+          exclude: int = -1):
+    """
+    順位 pos の残り定員に対して本人の希望だけを再生する。
+    exclude: 本人の元の順位（抽選番号を仮に変えたとき、元の位置での本人の消費を除く）。
+    元より後ろ（pos > exclude）に動かすときは間の学生を再配属する（remaining_moved）
+    戻り値: dept, rank の (世界 × スロット) 配列（'first_fit' はスロット 1 つ分）, 配属なしは (-1, 0)
+    """
+    if 0 <= exclude < pos:
+        rem = remaining_moved(index, cohort, pos, exclude)
+    else:
+        rem = index.remaining_at(pos, exclude)
+    n_worlds = index.n_worlds
+    n_out = len(terms) if index.rule == 'slot' else 1
+    dept = np.full((n_worlds, n_out), -1, dtype=np.int64)
+    rank = np.zeros((n_worlds, n_out), dtype=np.int64)
+    term_cols = cohort.term_cols()
+
+    todo = np.arange(n_worlds)
+    for k, t in enumerate(terms):
+        if index.rule == 'slot':
+            todo, out, offset = np.arange(n_worlds), k, k * index.n_depts
+        else:
+            c = term_cols[t] if 0 <= t < len(term_cols) else -1
+            if c < 0:
+                continue
+            out, offset = 0, c * index.n_depts
+        for i, (d, m) in enumerate(zip(hope_ids, hope_masks)):
+            if d < 0 or not m & (1 << t) or not len(todo):
+                continue
+            ok = rem[todo, offset + d] > 0
+            dept[todo[ok], out] = d
+            rank[todo[ok], out] = i + 1
+            todo = todo[~ok]
+    return dept, rank
+
+
+# --- 常駐エンジン（ダッシュボードの what-if 用） ---
+
+def read_frames():
+    """INPUT_FILES を読む。戻り値は encode_cohort の引数順 (responses, lottery, capacity_df, terms_df)"""
+    responses   = pd.read_csv("responses.csv", dtype={'student_id': str})
+    lottery     = pd.read_csv("lottery_order.csv", dtype={'student_id': str})
+    capacity_df = pd.read_csv("department_capacity.csv")
+    terms_df    = pd.read_csv("student_terms.csv", dtype={'student_id': str})
+    return responses, lottery, capacity_df, terms_df
+
+
+def read_cohort() -> EncodedCohort:
+    return encode_cohort(*read_frames())
+
+
+class LiveIndex:
+    """
+    世界を chunk 個ずつ足しながら育てる、メモリ常駐の SnapshotIndex。
+    足した世界は捨てないので、同じプロセスでの 2 回目以降の問い合わせは既存の世界で即答し、
+    残りの時間でさらに世界を足して精度を上げる。複数スレッドから共有してよい。
+    """
+
+    def __init__(self, cohort: EncodedCohort, rule: str = 'slot', seed=None,
+                 chunk: int = 100, max_worlds: int = 4000):
+        self.cohort = cohort
+        self.rule = rule
+        self.chunk = chunk
+        self.max_worlds = max_worlds
+        self.index = None
+        self._seeds = np.random.SeedSequence(seed)
+        self._lock = threading.Lock()
+
+    @property
+    def n_worlds(self) -> int:
+        index = self.index
+        return index.n_worlds if index is not None else 0
+
+    def extend(self) -> int:
+        """chunk 個の世界を足す（上限に達していれば何もしない）。戻り値は世界の総数"""
+        with self._lock:
+            n = min(self.chunk, self.max_worlds - self.n_worlds)
+            if n <= 0:
+                return self.n_worlds
+            rng = np.random.default_rng(self._seeds.spawn(1)[0])
+            part = build_snapshot_index(self.cohort, impute_prefs_batch(self.cohort, n, rng), self.rule)
+            if self.index is not None:
+                part.taken = np.concatenate([self.index.taken, part.taken])
+                part.imputed = np.concatenate([self.index.imputed, part.imputed])
+            self.index = part  # 読み手は差し替え前後のどちらかを丸ごと見る
+            return self.n_worlds
+
+    def warm(self, n_worlds: int) -> threading.Thread:
+        """n_worlds まで裏で世界を足しておく"""
+        def run():
+            while self.n_worlds < min(n_worlds, self.max_worlds):
+                self.extend()
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    def answer(self, student_id: str, hopes: list, lottery_number=None):
+        """
+        今ある世界での what-if。lottery_number を省くと本人の抽選番号を使う。
+        戻り値: (希望ごとの「最初に配属された希望」になった世界数, 世界数)
+        """
+        index = self.index
+        if index is None:
+            self.extend()
+            index = self.index
+        ids, masks, terms = focal_inputs(self.cohort, student_id, hopes)
+        rows = np.flatnonzero(self.cohort.student_ids == student_id)
+        own = int(np.flatnonzero(index.order == rows[0])[0]) if len(rows) else -1
+        if lottery_number is None:
+            if own < 0:
+                raise ValueError(f"student_id {student_id} の抽選番号が見つかりません。")
+            pos = own
+        else:
+            pos = index.position_of(int(lottery_number))
+        dept, _ = query(index, self.cohort, ids, masks, terms, pos, exclude=own)
+        first = first_matched_hope(np.array(ids)[None], dept[:, None, :])[:, 0]
+        hits = np.bincount(first[first >= 0], minlength=len(ids))[:len(ids)]
+        return hits, index.n_worlds
+
+    def progressive(self, student_id: str, hopes: list, lottery_number=None, budget: float = 0.8):
+        """
+        answer を budget 秒のあいだ、世界を足しながら繰り返し返すジェネレータ。
+        最初の 1 回は今ある世界ですぐ返す。
+        """
+        deadline = time.perf_counter() + budget
+        yield self.answer(student_id, hopes, lottery_number)
+        while self.n_worlds < self.max_worlds:
+            start = time.perf_counter()
+            self.extend()
+            result = self.answer(student_id, hopes, lottery_number)
+            yield result
+            if time.perf_counter() + (time.perf_counter() - start) > deadline:
+                break
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build a lottery-position capacity snapshot index")
+    parser.add_argument('--worlds', type=int, default=1000, help='Simulated worlds (default: 1000)')
+    parser.add_argument('--rule', choices=RULES, default='slot', help='Allocation rule (default: slot)')
+    parser.add_argument('--seed', type=int, default=None, help='Random seed (default: random)')
+    parser.add_argument('--output', default='snapshot_index.npz', help='Output file (default: snapshot_index.npz)')
+    parser.add_argument('--student', help='Answer a what-if for this student_id instead of saving')
+    parser.add_argument('--hopes', nargs='*', default=[], help='"病院-診療科" hopes for --student')
+    args = parser.parse_args()
+
+    cohort = read_cohort()
+    prefs = impute_prefs_batch(cohort, args.worlds, np.random.default_rng(args.seed))
+    index = build_snapshot_index(cohort, prefs, args.rule)
+
+    if args.student is None:
+        index.save(args.output)
+        print(f"✅ {args.output} を保存しました（{args.worlds} 世界, {index.taken.nbytes / 1e6:.1f} MB）")
+    else:
+        rows = np.flatnonzero(cohort.student_ids == args.student)
+        pos = index.position_of(int(cohort.lottery[rows[0]])) if len(rows) else 0
+        ids, masks, terms = focal_inputs(cohort, args.student, args.hopes)
+        dept, rank = query(index, cohort, ids, masks, terms, pos)
+        for i, hope in enumerate(args.hopes, start=1):
+            p = (rank == i).any(axis=1).mean() * 100
+            print(f"第{i}希望: {hope} → {p:.1f}%")
@@ -5,10 +5,14 @@ import pandas as pd
 import numpy as np
 import hashlib
 import altair as alt
-import re
 
 # Ensure current directory is in module path
 sys.path.insert(0, os.getcwd())
+import app_data
+import simulation_client
+from artifacts import artifact_path, read_table
+from demand_cube import CUBE_PATH, DemandCube, build_demand_cube, read_inputs as read_cube_inputs
+from snapshot_index import INPUT_FILES as SERVICE_INPUTS
 
 # --- 自動リフレッシュ ---
 st.markdown('<meta http-equiv="refresh" content="900">', unsafe_allow_html=True)
@@ -31,10 +35,15 @@ except:
         st.error("⚠️ Pepper が設定されていません。認証に失敗します。")
         st.stop()
 
-# --- データロード ---
-@st.cache_data(ttl=60)
+# --- データロード（app_data の共有キャッシュ。元ファイルが変わったときだけ読み直す） ---
+MAIN_FILES = [
+    "probability_montecarlo_combined.csv", "auth.csv", "popular_departments_rank_combined.csv",
+    "student_terms.csv", "responses.csv", "first_choice_probabilities.csv",
+    artifact_path("probability_montecarlo_combined.csv"), artifact_path("first_choice_probabilities.csv"),
+]
+
 def load_data():
-    prob_df      = pd.read_csv("probability_montecarlo_combined.csv", dtype={'student_id':str})
+    prob_df      = read_table("probability_montecarlo_combined.csv")
     auth_df      = pd.read_csv("auth.csv", dtype={'student_id':str,'password_hash':str,'role':str})
     rank_df      = pd.read_csv("popular_departments_rank_combined.csv")
     terms_df     = pd.read_csv(
@@ -42,7 +51,7 @@ def load_data():
         dtype={'student_id':str,'term_1':int,'term_2':int,'term_3':int,'term_4':int}
     )
     responses_df = pd.read_csv("responses.csv", dtype={'student_id':str})
-    first_choice_df = pd.read_csv("first_choice_probabilities.csv", dtype={'student_id':str})
+    first_choice_df = read_table("first_choice_probabilities.csv")
 
     # student_id の前ゼロ除去
     for df in [responses_df, prob_df, terms_df, auth_df, first_choice_df]:
@@ -57,37 +66,52 @@ def load_data():
 
     return prob_df, auth_df, rank_df, terms_df, responses_df, first_choice_df
 
-prob_df, auth_df, rank_df, terms_df, responses_df, first_choice_df = load_data()
+prob_df, auth_df, rank_df, terms_df, responses_df, first_choice_df = app_data.load(
+    'viewer_main', MAIN_FILES, load_data)
+
+# 抽選順位 × 科 × ターム の累積希望人数（パイプラインで生成。無ければその場で作る）
+def load_demand_cube():
+    if os.path.exists(CUBE_PATH):
+        return app_data.load('demand_cube', [CUBE_PATH], lambda: DemandCube.load(CUBE_PATH))
+    return app_data.load('demand_cube_built',
+                         ["responses.csv", "lottery_order.csv", "student_terms.csv"],
+                         lambda: build_demand_cube(*read_cube_inputs()))
 
 # --- 追加データロード ---
 # 初期配属結果
-assignment_df = pd.read_csv(
-    "initial_assignment_result.csv",
-    dtype={'student_id':str,'term':int,'assigned_department':str,'matched_priority':float}
-)
-assignment_df['student_id'] = assignment_df['student_id'].str.lstrip('0')
+def load_assignment():
+    return read_table("initial_assignment_result.csv")
 
 # 抽選順位
-lottery_df = pd.read_csv(
-    "lottery_order.csv",
-    dtype={'student_id':str,'lottery_order':int}
-)
-lottery_df['student_id'] = lottery_df['student_id'].str.lstrip('0')
-lottery_df.set_index('student_id', inplace=True)
+def load_lottery():
+    df = pd.read_csv(
+        "lottery_order.csv",
+        dtype={'student_id':str,'lottery_order':int}
+    )
+    df['student_id'] = df['student_id'].str.lstrip('0')
+    df.set_index('student_id', inplace=True)
+    return df
 
 # department_capacity
-capacity_df = pd.read_csv(
-    "department_capacity.csv",
-    dtype=str
-)
-# 数値型に変換 (term_ 列のみ)
-for col in capacity_df.columns:
-    if col.startswith('term_'):
-        # 数字部分を抽出し、欠損は0で埋めてから int 型に
-        extracted = capacity_df[col].str.extract(r"(\d+)")
-        capacity_df[col] = extracted.iloc[:, 0].fillna('0').astype(int)
-# hospital_department 列はそのまま文字列として扱う
-capacity_df['hospital_department'] = capacity_df['hospital_department'].astype(str)
+def load_capacity():
+    df = pd.read_csv(
+        "department_capacity.csv",
+        dtype=str
+    )
+    # 数値型に変換 (term_ 列のみ)
+    for col in df.columns:
+        if col.startswith('term_'):
+            # 数字部分を抽出し、欠損は0で埋めてから int 型に
+            extracted = df[col].str.extract(r"(\d+)")
+            df[col] = extracted.iloc[:, 0].fillna('0').astype(int)
+    # hospital_department 列はそのまま文字列として扱う
+    df['hospital_department'] = df['hospital_department'].astype(str)
+    return df
+
+assignment_df = app_data.load('viewer_assignment', ["initial_assignment_result.csv",
+                              artifact_path("initial_assignment_result.csv")], load_assignment)
+lottery_df    = app_data.load('viewer_lottery', ["lottery_order.csv"], load_lottery)
+capacity_df   = app_data.load('viewer_capacity', ["department_capacity.csv"], load_capacity)
 
 # --- 認証関数 ---
 def verify_user(sid, pwd):
@@ -135,12 +159,64 @@ if not my_assign.empty:
 else:
     st.info("初期配属結果が見つかりません。")
 
+# --- 現在の希望での通過確率 ---
+# simulation_service が起動していれば最新の回答で問い合わせ、止まっていれば（または失敗したら）
+# パイプラインが事前計算した probability_montecarlo_combined を表示する。
+# サービスの有無はセッションごとに一度だけ確かめ、答えは (学生, 入力ファイルの版) ごとに
+# 共有キャッシュに置く（ウィジェット操作のたびに問い合わせ直さない）
+st.subheader("🎯 現在の希望での通過確率")
+if 'sim_service' not in st.session_state:
+    st.session_state['sim_service'] = simulation_client.available()
+
+def service_probability(sid):
+    """サービスの答え。失敗はキャッシュせず例外のまま返す"""
+    return app_data.load(('viewer_probability', sid), SERVICE_INPUTS,
+                         lambda: simulation_client.probability(sid))
+
+def probability_table(sid):
+    """(表, 説明) を返す。どちらのデータも無ければ (None, None)"""
+    if st.session_state['sim_service']:
+        try:
+            r = service_probability(sid)
+            table = pd.DataFrame({'希望': r['hopes'], '通過確率': r['probability'],
+                                  '下限': r['lower'], '上限': r['upper']})
+            return table, f"{r['worlds']} 回のシミュレーションに基づく最新の推定（95% 区間）"
+        except simulation_client.ServiceUnavailable:
+            st.session_state['sim_service'] = False  # 止まったらこのセッションでは事前計算に切り替える
+        except ValueError:
+            pass
+    if sid not in prob_df.index or sid not in responses_df.index:
+        return None, None
+    prob_row, hope_row = prob_df.loc[sid], responses_df.loc[sid]
+    rows = []
+    for col in [c for c in prob_row.index if c.endswith('_確率')]:
+        hope_col = col[:-len('_確率')]
+        hope = hope_row.get(hope_col)
+        if pd.isna(hope) or not str(hope).strip():
+            continue
+        # 95% 区間（下限・上限）は新しい出力にだけある
+        row = {'希望': hope, '通過確率': round(float(prob_row[col]), 1)}
+        for label in ['下限', '上限']:
+            if f'{hope_col}_{label}' in prob_row.index:
+                row[label] = round(float(prob_row[f'{hope_col}_{label}']), 1)
+        rows.append(row)
+    return pd.DataFrame(rows), "最新のデータ更新時点の推定"
+
+my_prob, caption = probability_table(sid)
+if my_prob is not None and not my_prob.empty:
+    st.dataframe(my_prob, use_container_width=True)
+    st.caption(caption)
+else:
+    st.info("通過確率のデータがありません。")
+
 # --- 機能2: 第1希望通過確率 ---
 st.subheader("📈 第1希望通過確率")
 if sid in first_choice_df.index:
     my_first = first_choice_df.loc[[sid]]
+    # 95% 区間（下限・上限）は新しい出力にだけある
+    cols = [c for c in ['希望科','通過確率','下限','上限'] if c in my_first.columns]
     st.dataframe(
-        my_first[['希望科','通過確率']],
+        my_first[cols],
         use_container_width=True
     )
 else:
@@ -149,29 +225,10 @@ else:
 # --- 機能3: 第1～5希望人数表示（自分より抽選順位が高い学生のみ） ---
 st.subheader("📊 第1～5希望人数 (科ごと・Term1～Term11) - 自分より抽選順位が高い学生のみ")
 my_order = lottery_df.loc[sid, 'lottery_order']
-higher = lottery_df[lottery_df['lottery_order'] < my_order].index.tolist()
-
-counts = {}
-for uid in higher:
-    if uid not in responses_df.index:
-        continue
-    default_terms = terms_df.loc[uid, ['term_1','term_2','term_3','term_4']].tolist()
-    for i in range(1, 6):
-        dept = responses_df.loc[uid].get(f'hope_{i}')
-        if pd.isna(dept) or not dept or dept == '-':
-            continue
-        raw = responses_df.loc[uid].get(f'hope_{i}_terms', '')
-        nums = [int(n) for n in re.findall(r"\d+", str(raw))]
-        term_list = [t for t in nums if t in default_terms]
-        use_terms = term_list if term_list else default_terms
-        for t in use_terms:
-            counts[(dept, t)] = counts.get((dept, t), 0) + 1
-rows = [{'診療科': dept, 'Term': term, '人数': cnt} for (dept, term), cnt in counts.items()]
-cnt_df = pd.DataFrame(rows)
-if cnt_df.empty:
+pivot = load_demand_cube().table(my_order)
+if pivot.empty:
     st.info("該当するデータがありません。")
 else:
-    pivot = cnt_df.pivot(index='診療科', columns='Term', values='人数').fillna(0).astype(int)
     st.dataframe(pivot, use_container_width=True)
 
 # --- 枠埋まり科（科単位集計）とその科に配属される最大抽選順位 ---
@@ -245,24 +302,29 @@ st.dataframe(dept_summary[["科名", "配属人数合計", "受入人数合計",
 
 # --- 昨年：一定割合以上配属された科の最大通過順位 ---
 st.subheader("🔖 昨年：一定割合以上配属された科の最大通過順位")
-# データ読み込み
-hist_df = pd.read_csv("2024配属結果.csv", dtype={'student_id':str, 'lottery_order':int})
-cap_df  = pd.read_csv("department_capacity2024.csv")
-# 長い形式に変換
-records = []
-term_cols = [c for c in hist_df.columns if c.startswith('term_')]
-for _, r in hist_df.iterrows():
-    rank = r['lottery_order']
-    for term in term_cols:
-        dept = r[term]
-        if pd.notna(dept) and dept not in ('','-'):
-            records.append({'department':dept,'lottery_order':rank})
-df_long2 = pd.DataFrame(records)
-# 部門ごと配属数
-assign_dept = df_long2.groupby('department',as_index=False).size().rename(columns={'size':'assigned_count'})
-# capacity合計
-cap_dept = (cap_df.melt(id_vars=['hospital_department'], value_vars=[c for c in cap_df.columns if c.startswith('term_')], var_name='term', value_name='capacity')
-                .groupby('hospital_department',as_index=False).agg({'capacity':'sum'}).rename(columns={'hospital_department':'department'}))
+# データ読み込み（長い形式・科ごとの集計まで共有キャッシュ）
+def load_history():
+    hist_df = pd.read_csv("2024配属結果.csv", dtype={'student_id':str, 'lottery_order':int})
+    cap_df  = pd.read_csv("department_capacity2024.csv")
+    # 長い形式に変換
+    records = []
+    term_cols = [c for c in hist_df.columns if c.startswith('term_')]
+    for _, r in hist_df.iterrows():
+        rank = r['lottery_order']
+        for term in term_cols:
+            dept = r[term]
+            if pd.notna(dept) and dept not in ('','-'):
+                records.append({'department':dept,'lottery_order':rank})
+    df_long2 = pd.DataFrame(records)
+    # 部門ごと配属数
+    assign_dept = df_long2.groupby('department',as_index=False).size().rename(columns={'size':'assigned_count'})
+    # capacity合計
+    cap_dept = (cap_df.melt(id_vars=['hospital_department'], value_vars=[c for c in cap_df.columns if c.startswith('term_')], var_name='term', value_name='capacity')
+                    .groupby('hospital_department',as_index=False).agg({'capacity':'sum'}).rename(columns={'hospital_department':'department'}))
+    return df_long2, assign_dept, cap_dept
+
+df_long2, assign_dept, cap_dept = app_data.load(
+    'viewer_history', ["2024配属結果.csv", "department_capacity2024.csv"], load_history)
 # 配属率閾値
 threshold = st.slider('配属枠の何%以上が埋まった科を表示するか', min_value=0.0, max_value=1.0, value=0.7, step=0.05)
 # 合致科抽出
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+ベンチマーク用の合成コホート生成。
+
+実データと同じ形式の responses.csv / student_terms.csv / lottery_order.csv /
+department_capacity.csv（と generate_probability が読む 2024配属結果.csv）を、
+学生数・科数・ターム数・希望数・回答率・人気の偏りを指定して作る。
+乱数は seed だけで決まるので、同じ指定なら同じファイルになる。
+"""
+import os
+import argparse
+from dataclasses import dataclass, asdict
+
+import numpy as np
+import pandas as pd
+
+from allocation_engine import sample_weighted_hopes
+
+HOSPITALS = ["本院", "葛飾", "第三", "柏"]
+SLOTS = 4  # 1 学生あたりの実習ターム数（student_terms の term_1〜term_4）
+
+
+@dataclass
+class CohortSpec:
+    students:      int = 110
+    departments:   int = 92
+    terms:         int = 11
+    hopes:         int = 20
+    response_rate: float = 0.8
+    skew:          float = 1.0   # 人気の偏り（Zipf の指数。0 で一様）
+    capacity_slack: float = 3.0  # ターム当たり定員合計 / ターム当たり学生数（実データはおよそ 3）
+    term_pref_rate: float = 0.17  # 希望にターム指定を付ける割合
+    seed:          int = 0
+
+    def label(self) -> str:
+        return f"{self.students}x{self.departments}x{self.terms}"
+
+
+def department_names(n: int) -> list:
+    """「病院-診療科」形式の科名（病院を順に回す）"""
+    return [f"{HOSPITALS[k % len(HOSPITALS)]}-診療科{k // len(HOSPITALS) + 1:03d}" for k in range(n)]
+
+
+def term_patterns(rng: np.random.Generator, n_patterns: int, terms: int) -> np.ndarray:
+    """ローテーション（重複なし・昇順の 4 ターム）を n_patterns 通り作る"""
+    keys = rng.random((n_patterns, terms))
+    return np.sort(np.argsort(keys, axis=1)[:, :SLOTS], axis=1) + 1
+
+
+def generate_cohort(spec: CohortSpec) -> dict:
+    """spec に従った入力表 {ファイル名: DataFrame} を返す"""
+    if spec.terms < SLOTS:
+        raise ValueError(f"terms は {SLOTS} 以上にしてください: {spec.terms}")
+    rng = np.random.default_rng(spec.seed)
+    n, d = spec.students, spec.departments
+    names = np.array(department_names(d), dtype=object)
+    student_ids = [str(i) for i in range(1, n + 1)]
+
+    # --- student_terms: 約 11 人ずつ同じローテーション ---
+    patterns = term_patterns(rng, max(1, -(-n // 11)), spec.terms)
+    slot_terms = patterns[rng.integers(len(patterns), size=n)]
+    student_terms = pd.DataFrame(slot_terms, columns=[f"term_{k}" for k in range(1, SLOTS + 1)])
+    student_terms.insert(0, "student_id", student_ids)
+
+    # --- lottery_order: 1..n のランダムな並び ---
+    lottery = pd.DataFrame({"student_id": student_ids,
+                            "lottery_order": rng.permutation(n) + 1})
+
+    # --- department_capacity: 人気と無関係に 0〜数人、一部は空欄 ---
+    popularity = 1.0 / np.arange(1, d + 1) ** spec.skew
+    popularity = popularity[rng.permutation(d)]
+    per_term = n * SLOTS / spec.terms * spec.capacity_slack
+    cap = rng.poisson(per_term / d, size=(d, spec.terms)).astype(object)
+    cap[rng.random(cap.shape) < 0.07] = ""
+    capacity = pd.DataFrame(cap, columns=[f"term_{t}" for t in range(1, spec.terms + 1)])
+    capacity.insert(0, "hospital_department", names)
+
+    # --- responses: 回答者だけ、人気重み付き・重複なしの希望（残りは '-'） ---
+    answered = np.sort(rng.choice(n, size=int(round(n * spec.response_rate)), replace=False))
+    m = len(answered)
+    k = min(spec.hopes, d)
+    picks = sample_weighted_hopes(np.arange(d), popularity, k, rng.random((m, d)))
+    filled = np.minimum(rng.integers(min(7, k), k + 1, size=m), k)
+    hopes = np.full((m, spec.hopes), "-", dtype=object)
+    for row in range(m):
+        hopes[row, :filled[row]] = names[picks[row, :filled[row]]]
+    rows = {"student_id": [student_ids[i] for i in answered],
+            "password": [f"{v:06d}" for v in rng.integers(0, 10**6, size=m)]}
+    for i in range(spec.hopes):
+        rows[f"hope_{i + 1}"] = hopes[:, i]
+        with_terms = (rng.random(m) < spec.term_pref_rate) & (i < filled)
+        sub = [sorted(rng.choice(slot_terms[s], size=rng.integers(1, SLOTS + 1), replace=False).tolist())
+               if w else None for s, w in zip(answered, with_terms)]
+        rows[f"hope_{i + 1}_terms"] = [str(t) if t else "" for t in sub]
+    responses = pd.DataFrame(rows)
+
+    # --- 2024配属結果: generate_probability.read_inputs が読むだけなので形式だけ合わせる ---
+    hist = pd.DataFrame({"student_id": student_ids, "lottery_order": lottery["lottery_order"]})
+    for t in range(1, spec.terms + 1):
+        hist[f"term_{t}"] = ""
+
+    return {
+        "responses.csv": responses,
+        "student_terms.csv": student_terms,
+        "lottery_order.csv": lottery,
+        "department_capacity.csv": capacity,
+        "2024配属結果.csv": hist,
+    }
+
+
+def write_cohort(frames: dict, out_dir: str):
+    os.makedirs(out_dir, exist_ok=True)
+    for name, df in frames.items():
+        df.to_csv(os.path.join(out_dir, name), index=False)
+
+
+if __name__ == "__main__":
+    defaults = CohortSpec()
+    parser = argparse.ArgumentParser(description="Generate a synthetic cohort in the pipeline's input format")
+    parser.add_argument("--out", default="synthetic_cohort", help="Output directory (default: %(default)s)")
+    for field_name, value in asdict(defaults).items():
+        parser.add_argument("--" + field_name.replace("_", "-"), type=type(value), default=value,
+                            help="(default: %(default)s)")
+    args = parser.parse_args()
+    spec = CohortSpec(**{f: getattr(args, f) for f in asdict(defaults)})
+    write_cohort(generate_cohort(spec), args.out)
+    print(f"✅ {args.out}/ に合成コホート {spec.label()} を生成しました")
@@ -1,11 +1,36 @@
 #!/usr/bin/env python3
 import os
-import json
-import hashlib
-import pandas as pd
-import subprocess
-from google.auth import default
-from googleapiclient.discovery import build
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import alloc_kernels
+from pipeline import PipelineContext, run_pipeline, source_inputs
+from perf_trace import TRACE_DIR, Trace
+from sheets_ingest import RESPONSES_CSV, SHEET_RANGE, http_fetcher, http_batch_fetcher, ingest
+
+# --- 引数 ---
+parser = argparse.ArgumentParser(description="Fetch form responses and update all derived data")
+parser.add_argument("--light", action="store_true",
+                    help="Light update triggered by a form submission (same stages, run incrementally)")
+parser.add_argument("--force", action="store_true",
+                    help="Re-run every stage even if its inputs are unchanged")
+parser.add_argument("--no-csv", action="store_true",
+                    help="Write only the typed .npz artifacts, skip publishing the CSV copies")
+parser.add_argument("--full-sync", action="store_true",
+                    help="Re-read every sheet row to pick up edited responses (default: new rows only)")
+parser.add_argument("--profile", action="store_true",
+                    help="Also dump a cProfile (.prof, viewable with snakeviz/flameprof) per stage")
+parser.add_argument("--trace-dir", default=TRACE_DIR,
+                    help="Directory for the per-run JSON timing trace (default: %(default)s)")
+parser.add_argument("--engine", choices=alloc_kernels.ENGINES, default="numpy",
+                    help="Allocation kernel: numpy (default), numba (JIT-compiled; falls back to numpy "
+                         "when numba is not installed) or python (the uncompiled kernel, for cross-checking)")
+args = parser.parse_args()
+alloc_kernels.select(args.engine)
+trace = Trace("update_all", profile=args.profile, trace_dir=args.trace_dir)
+
+def finish_trace():
+    print(trace.summary())
+    print(f"⏱️ 計測結果を {trace.write()} に保存しました")
 
 # --- 環境変数 & st.secrets から Pepper 取得 ---
 try:
@@ -22,138 +47,64 @@ SPREADSHEET_ID = os.environ.get("SPREADSHEET_ID")
 if not SPREADSHEET_ID:
     raise RuntimeError("環境変数 SPREADSHEET_ID が設定されていません。")
 
-# --- シート範囲設定 ---
-RANGE_NAME = os.environ.get("RANGE_NAME", "'フォームの回答'!A1:AZ1000")
+# --- シート範囲設定（行番号は無視し、ページ単位で最終行まで読む） ---
+RANGE_NAME = os.environ.get("RANGE_NAME", SHEET_RANGE)
 
-# --- Google API 認証 ---
-creds, _ = default(scopes=[
-    "https://www.googleapis.com/auth/spreadsheets",
-    "https://www.googleapis.com/auth/drive"
-])
-service = build("sheets", "v4", credentials=creds)
-
-# --- Step 1: フォーム回答取得 ---
+# --- Sheets API（SHEETS_ENDPOINT 指定時は fake_sheets_server.py などに直接つなぐ） ---
+SHEETS_ENDPOINT = os.environ.get("SHEETS_ENDPOINT")
+if SHEETS_ENDPOINT:
+    fetch = http_fetcher(SHEETS_ENDPOINT, SPREADSHEET_ID)
+    batch_fetch = http_batch_fetcher(SHEETS_ENDPOINT, SPREADSHEET_ID)
+else:
+    from google.auth import default
+    from googleapiclient.discovery import build
+
+    creds, _ = default(scopes=[
+        "https://www.googleapis.com/auth/spreadsheets",
+        "https://www.googleapis.com/auth/drive"
+    ])
+    service = build("sheets", "v4", credentials=creds)
+
+    def fetch(range_name):
+        return service.spreadsheets().values().get(
+            spreadsheetId=SPREADSHEET_ID,
+            range=range_name
+        ).execute().get("values", [])
+
+    def batch_fetch(ranges):
+        return [vr.get("values", []) for vr in service.spreadsheets().values().batchGet(
+            spreadsheetId=SPREADSHEET_ID,
+            ranges=ranges
+        ).execute().get("valueRanges", [])]
+
+# --- Step 1〜3: フォーム回答の増分取得 → responses.csv / auth.csv 更新 ---
+# シートの取得（batchGet）を待つあいだに、パイプラインの他の入力（student_terms.csv など）と
+# 既存の responses.csv / auth.csv をスレッドで読み込んでおく。
+# 取り込みで書いた responses.csv / auth.csv はそのままパイプラインに渡す（読み直さない）
 print("📥 Googleフォーム回答を取得中...")
-result = service.spreadsheets().values().get(
-    spreadsheetId=SPREADSHEET_ID,
-    range=RANGE_NAME
-).execute()
-values = result.get("values", [])
-if not values:
-    print("❌ データが取得できませんでした")
-    exit(1)
-# ヘッダー列数に合わせて各行をパディング or 切り詰め
-header = values[0]
-rows = values[1:]
-ncol = len(header)
-aligned = []
-for row in rows:
-    if len(row) < ncol:
-        aligned.append(row + [""] * (ncol - len(row)))
-    else:
-        aligned.append(row[:ncol])
-df = pd.DataFrame(aligned, columns=header)
-df.to_csv("form_responses_final.csv", index=False)
-print("✅ form_responses_final.csv を保存しました")
-
-# --- Step 2: responses.csv 生成 ---
-print("🔄 responses.csv に変換中...")
+ctx = PipelineContext()
 try:
-    df2 = pd.read_csv("form_responses_final.csv", dtype=str)
-
-    # グリッド質問の列名マッピング (第n希望 → "希望ターム [第n希望]")
-    term_columns = {
-        i: f"希望ターム [第{i}希望]"
-        for i in range(1, 21)
-        if f"希望ターム [第{i}希望]" in df2.columns
-    }
-
-    output = {
-        "student_id": df2.iloc[:, 1].str.lstrip("0"),
-        "password":   df2.iloc[:, 2]
-    }
-
-    for i in range(1, 21):
-        # 科目の読み取り（既存ロジック）
-        hcol = i * 2 + 1
-        dcol = i * 2 + 2
-        try:
-            hosp = df2.iloc[:, hcol].fillna("")
-            dept = df2.iloc[:, dcol].fillna("")
-            combined = (hosp + "-" + dept).str.strip().replace("", pd.NA)
-        except Exception:
-            combined = pd.NA
-        output[f"hope_{i}"] = combined
-
-        # グリッド回答から複数ターム番号を取り出し（リストとして保存）
-        grid_col = term_columns.get(i)
-        if grid_col:
-            raw = df2[grid_col].fillna("")  # 例: "3ターム, 5ターム"
-            term_list = raw.str.findall(r"(\d+)") \
-                           .apply(lambda lst: [int(x) for x in lst] if lst else pd.NA)
-            output[f"hope_{i}_terms"] = term_list
-        else:
-            output[f"hope_{i}_terms"] = pd.NA
-
-    # DataFrame 化＋重複削除
-    responses = pd.DataFrame(output)
-    before = len(responses)
-    responses = responses.drop_duplicates(subset="student_id", keep="last")
-    deleted = before - len(responses)
-    print(f"✅ 重複排除: {deleted} 件削除, 残り {len(responses)} 件")
-
-    # CSV 出力
-    responses.to_csv("responses.csv", index=False)
-    print("✅ responses.csv を生成しました")
+    with trace.stage("ingest") as entry, ThreadPoolExecutor(max_workers=4) as pool:
+        local = ctx.preload([p for p in source_inputs() if p != RESPONSES_CSV], pool)
+        written = {}
+        summary = ingest(fetch, PEPPER, RANGE_NAME, full=args.full_sync,
+                         batch_fetch=batch_fetch, pool=pool, outputs=written)
+        for future in local:
+            future.result()
+        for path, data in written.items():
+            ctx.provide(path, data)
+        entry.update(summary)
 except Exception as e:
-    print("❌ responses.csv への変換に失敗:", e)
+    print("❌ フォーム回答の取り込みに失敗:", e)
+    finish_trace()
     exit(1)
+mode = "全行" if summary["full"] else "追加分"
+print(f"✅ {mode}を取得: {summary['fetched']} 行（変更 {summary['changed']} 行, 全 {summary['rows']} 行）")
 
-# --- Step 3: auth.csv 生成（PEPPER 必要） ---
-if PEPPER:
-    print("🔐 auth.csv を生成中…")
-    auth_src = pd.read_csv("form_responses_final.csv", dtype=str)
-    auth_src["student_id"] = auth_src["学生番号"].str.lstrip("0")
-    auth_src = auth_src.drop_duplicates(subset="student_id", keep="last")
-    rows = []
-    for _, row in auth_src.iterrows():
-        sid = row["student_id"]
-        pwd = row.get("パスワード", "")
-        if pd.isna(pwd) or pwd == "":
-            continue
-        hash_hex = hashlib.sha256((pwd + PEPPER).encode("utf-8")).hexdigest()
-        role = "admin" if sid == "22" else "student"
-        rows.append({"student_id": sid, "password_hash": hash_hex, "role": role})
-    auth_df = pd.DataFrame(rows, columns=["student_id", "password_hash", "role"])
-    auth_df.to_csv("auth.csv", index=False)
-    print("✅ auth.csv を生成しました")
-else:
-    print("⚠️ PEPPER が設定されていないため auth.csv をスキップします")
-
-# --- Step 4: その他スクリプト実行 ---
-scripts = [
-    "initial_assignment.py",
-    "simulate_with_unanswered.py",
-    "generate_probability.py",
-    "generate_popular_rank.py",
-    "analyze_assignment.py",
-    "analyze_department.py"
-]
-
-for script in scripts:
-    if script == "generate_probability.py":
-        print(f"⚙️ {script} をデフォルト呼び出し（20 iterations）で実行中…")
-        subprocess.run(["python", script], check=True)
-    elif script == "simulate_with_unanswered.py":
-        print(f"⚙️ {script} をサイレント実行中…")
-        subprocess.run(
-            ["python", script],
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL,
-            check=True
-        )
-    else:
-        print(f"⚙️ {script} を実行中…")
-        subprocess.run(["python", script], check=True)
+# --- Step 4: その他スクリプトを同一プロセスで実行（入力が変わったステージのみ） ---
+try:
+    run_pipeline(force=args.force, export_csv=not args.no_csv, trace=trace, ctx=ctx)
+finally:
+    finish_trace()
 
 print("\n✅ 全パイプライン実行完了！")